@@ -1,22 +1,379 @@
 import os, json
+import re
+import time
+import random
+import hashlib
+import asyncio
+import threading
+import unicodedata
+from functools import lru_cache
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
 
 # DEMO / fallback: niente chiamate API se non vuoi o non puoi usare i crediti
 DEMO_MODE = os.getenv("DEMO_MODE", "false").lower() == "true"
 
 # Importa OpenAI solo se non siamo in demo
-client = None
+aclient = None
 if not DEMO_MODE:
-    from openai import OpenAI, OpenAIError
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    from openai import AsyncOpenAI
+    aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)  # retry gestiti da _call
 
-from prompts import PLAN_PROMPT, TUTOR_PROMPT, EXERCISE_PROMPT, EXPLAIN_PROMPT
+from prompts import (
+    PROMPTS_VERSION, PLAN_PROMPT, TUTOR_PROMPT, EXERCISE_PROMPT, EXPLAIN_PROMPT, FIX_FRAGMENT_PROMPT,
+    BATCH_EXPLAIN_PROMPT, BATCH_EXERCISE_PROMPT, EXPLAIN_OUTPUT_TOKENS, EXERCISES_OUTPUT_TOKENS,
+    TEXTBOOK_SECTION, TEXTBOOK_PROMPT_TOKENS, SOURCES_SECTION, SOURCE_PROMPT_TOKENS, SOURCE_TOP_K,
+    TUTOR_SUMMARY_PROMPT, TUTOR_HISTORY_TOKENS, TUTOR_SUMMARY_TOKENS,
+    PROMPT_TOKEN_BUDGET, estimate_tokens, context_budget
+)
+from schemas import Schema, PLAN, EXERCISES, repair_json, fragment_path, format_path, get_at, set_at
+from db import (
+    get_llm_cache, set_llm_cache, search_textbook, get_tutor_answer, tutor_questions, set_tutor_answer,
+    get_tutor_session, add_tutor_turn, set_tutor_summary
+)
+from concept_map import plan_graph
+
+# ========================= ENGINE ASYNC =========================
+# Tutte le chiamate passano da AsyncOpenAI su un unico event loop di processo (thread dedicato):
+# le funzioni sincrone restano wrapper sottili, le varianti a* possono essere lanciate in parallelo.
+MODEL = "gpt-4o-mini"
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="ai-loop", daemon=True).start()
+_sem = asyncio.Semaphore(LLM_CONCURRENCY)  # limite globale di richieste in volo
+
+def run_sync(coro):
+    """Esegue una coroutine sul loop condiviso e ne attende il risultato (per chiamanti sincroni)."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+# ========================= POLICY CHIAMATE =========================
+# Scadenza complessiva (s) per tipo di richiesta, retry inclusi
+LLM_DEADLINES = {"plan": 90.0, "exercises": 60.0, "explain": 60.0, "tutor": 30.0, "fix": 30.0, "batch": 150.0,
+                 "summary": 30.0}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+class LLMUnavailable(Exception):
+    """Provider non utilizzabile (circuito aperto, scadenza, errori ripetuti): usare i fallback demo."""
+
+class _CircuitBreaker:
+    """Dopo `threshold` fallimenti consecutivi blocca le chiamate per `cooldown` secondi,
+    poi lascia passare una sola chiamata di prova (half-open): se riesce si richiude, se fallisce
+    si riapre per un altro `cooldown`. Le altre chiamate restano bloccate finché la prova è in corso
+    (una prova senza esito da più di `probe_timeout` secondi si considera persa)."""
+
+    def __init__(self, threshold: int, cooldown: float, probe_timeout: float):
+        self.threshold, self.cooldown, self.probe_timeout = threshold, cooldown, probe_timeout
+        self.failures, self.opened_at, self.probe_at = 0, None, None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        if self.probe_at is not None and now - self.probe_at < self.probe_timeout:
+            return False
+        self.probe_at = now
+        return True
+
+    def success(self):
+        self.failures, self.opened_at, self.probe_at = 0, None, None
+
+    def failure(self):
+        self.failures += 1
+        if self.probe_at is not None or self.failures >= self.threshold:
+            self.opened_at, self.probe_at = time.monotonic(), None
+
+_breaker = _CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN, max(LLM_DEADLINES.values()))  # solo dal thread del loop
+
+def _retryable(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, (asyncio.TimeoutError, TimeoutError)) or type(e).__name__ in ("APITimeoutError", "APIConnectionError")
+
+async def _call(kind: str, deadline: float | None = None, **kwargs):
+    """Unico punto di uscita verso il provider: scadenza per tipo, backoff esponenziale con jitter
+    su 429/5xx/timeout e circuit breaker. Ogni fallimento definitivo diventa LLMUnavailable."""
+    if aclient is None:
+        raise LLMUnavailable("client AI non configurato")
+    if not _breaker.allow():
+        raise LLMUnavailable("servizio AI temporaneamente disabilitato (circuit breaker aperto)")
+    deadline = deadline or time.monotonic() + LLM_DEADLINES.get(kind, 60.0)
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            resp = await asyncio.wait_for(aclient.chat.completions.create(timeout=remaining, **kwargs), remaining)
+            _breaker.success()
+            return resp
+        except Exception as e:
+            attempt += 1
+            delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            retry = _retryable(e)
+            if not retry or attempt > LLM_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                if retry:
+                    _breaker.failure()
+                else:  # il provider ha risposto: errore della richiesta, non del servizio
+                    _breaker.success()
+                raise LLMUnavailable(f"{kind}: {type(e).__name__} {e}") from e
+            await asyncio.sleep(delay)
+
+def _cache_key(prompt: str, temperature: float, json_mode: bool = False) -> str:
+    """Chiave della cache LLM condivisa: stessa richiesta = stessa risposta, per qualsiasi piano/utente."""
+    raw = json.dumps([PROMPTS_VERSION, prompt, MODEL, temperature] + (["json"] if json_mode else []), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+_inflight: dict[str, asyncio.Task] = {}  # chiave cache -> richiesta in volo (solo sul thread del loop)
+
+async def _achat(prompt: str, temperature: float, use_cache: bool = True, json_mode: bool = False,
+                 kind: str = "default", max_tokens: int | None = None) -> str:
+    """Single-flight: richieste identiche concorrenti attendono la stessa chiamata al provider."""
+    key = _cache_key(prompt, temperature, json_mode)
+    if not use_cache:
+        return await _achat_once(key, prompt, temperature, json_mode, kind, max_tokens)
+    cached = await asyncio.to_thread(get_llm_cache, key)
+    if cached is not None:
+        return cached
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_achat_once(key, prompt, temperature, json_mode, kind, max_tokens))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+    # shield: se un chiamante viene annullato la chiamata condivisa prosegue per gli altri
+    return await asyncio.shield(task)
+
+async def _achat_once(key: str, prompt: str, temperature: float, json_mode: bool, kind: str,
+                      max_tokens: int | None = None) -> str:
+    extra = {"response_format": {"type": "json_object"}} if json_mode else {}
+    if max_tokens:
+        extra["max_tokens"] = max_tokens
+    async with _sem:
+        resp = await _call(
+            kind,
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            **extra
+        )
+    text = resp.choices[0].message.content
+    if text:
+        await asyncio.to_thread(set_llm_cache, key, text, MODEL)
+    return text
+
+async def _astream(prompt: str, temperature: float, kind: str = "default"):
+    """Async generator dei delta di testo; lo slot del semaforo resta occupato per tutto lo stream.
+
+    Con un hit nella cache LLM il testo arriva in un unico delta; altrimenti viene salvato a fine stream.
+    Anche la lettura dello stream rispetta la scadenza del tipo di richiesta.
+    """
+    key = _cache_key(prompt, temperature)
+    cached = await asyncio.to_thread(get_llm_cache, key)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    deadline = time.monotonic() + LLM_DEADLINES.get(kind, 60.0)
+    async with _sem:
+        stream = await _call(
+            kind,
+            deadline,
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            stream=True
+        )
+        chunks = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                if _retryable(e):
+                    _breaker.failure()
+                raise LLMUnavailable(f"{kind}: stream interrotto ({type(e).__name__} {e})") from e
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    if parts:
+        await asyncio.to_thread(set_llm_cache, key, "".join(parts), MODEL)
+
+def _iter_sync(agen):
+    """Consuma un async generator dal loop condiviso come generatore sincrono."""
+    try:
+        while True:
+            try:
+                yield run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(agen.aclose())
+
+async def _structured(text: str, schema: Schema, hint: str) -> dict:
+    """Valida una risposta JSON contro lo schema.
+
+    Prima ripara in locale (prosa, virgole, troncamenti); se restano errori chiede al modello
+    solo i frammenti non validi (in parallelo) e li reinserisce. Solleva ValueError se non basta.
+    """
+    doc = repair_json(text)
+    if not isinstance(doc, dict):
+        raise ValueError("risposta del modello non in formato JSON")
+    errors = schema.validate(doc)
+    if not errors:
+        return doc
+    fragments: dict[tuple, list[str]] = {}
+    for path, msg in errors:
+        fragments.setdefault(fragment_path(path), []).append(f"{format_path(path)}: {msg}")
+    if () not in fragments:
+        fixes = await agather([_reask_fragment(doc, p, schema.at(p), msgs, hint) for p, msgs in fragments.items()])
+        for p, fix in zip(fragments, fixes):
+            if fix is not None and not isinstance(fix, Exception):
+                set_at(doc, p, fix)
+        errors = schema.validate(doc)
+    if errors:
+        raise ValueError("JSON non valido: " + "; ".join(f"{format_path(p)}: {m}" for p, m in errors[:5]))
+    return doc
+
+async def _reask_fragment(doc: dict, path: tuple, sub: Schema, errors: list[str], hint: str):
+    prompt = FIX_FRAGMENT_PROMPT.format(
+        path=format_path(path),
+        schema=json.dumps(sub.spec, ensure_ascii=False),
+        fragment=json.dumps(get_at(doc, path), ensure_ascii=False),
+        errors="; ".join(errors),
+        context=hint
+    )
+    fixed = repair_json(await _achat(prompt, 0.2, json_mode=True, kind="fix"))
+    value = fixed.get("value") if isinstance(fixed, dict) else None
+    return value if not sub.validate(value) else None
+
+async def agather(coros, return_exceptions: bool = True) -> list:
+    """Lancia più generazioni insieme; la concorrenza effettiva è limitata da LLM_CONCURRENCY."""
+    return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+def run_batch(coros, return_exceptions: bool = True) -> list:
+    """Versione sincrona di agather: es. run_batch([aexplain_step_ai(pj, i, lvl, gm) for i in ...])."""
+    return run_sync(agather(list(coros), return_exceptions))
+
+# ========================= CONTESTO COMPATTO =========================
+CONTEXT_NEIGHBOURS = int(os.getenv("CONTEXT_NEIGHBOURS", "1"))
+
+def build_step_context(plan_context: dict, step_idx: int | None, budget: int,
+                       neighbours: int = CONTEXT_NEIGHBOURS) -> str:
+    """JSON di contesto per un prompt su un singolo step, entro `budget` token stimati.
+
+    Step target e vicini (±neighbours) completi, degli altri solo il titolo. Se non basta riduce
+    in ordine: vicini a titolo/obiettivo/outline, vicini al solo titolo, titoli più lontani,
+    overview, infine il target stesso a titolo/obiettivo/outline. Con step_idx=None (tutor)
+    include overview e titoli.
+    """
+    steps = plan_context.get("steps") or []
+    overview = plan_context.get("overview") or ""
+    has_target = step_idx is not None and 0 <= step_idx < len(steps)
+    near = [i for i in range(len(steps))
+            if has_target and i != step_idx and abs(i - step_idx) <= neighbours]
+    detail = {i: 0 for i in range(len(steps))}  # 2 completo, 1 compatto, 0 solo titolo
+    for i in near:
+        detail[i] = 2
+    if has_target:
+        detail[step_idx] = 2
+    keep = list(range(len(steps)))
+
+    def entry(i):
+        s = steps[i] if isinstance(steps[i], dict) else {}
+        if detail[i] == 2:
+            return {"idx": i, **s}
+        if detail[i] == 1:
+            return {"idx": i, **{k: s[k] for k in ("title", "objective", "theory_outline") if k in s}}
+        return {"idx": i, "title": s.get("title", "")}
+
+    def render():
+        return json.dumps({"overview": overview, "steps": [entry(i) for i in keep]}, ensure_ascii=False)
+
+    ctx = render()
+    if estimate_tokens(ctx) <= budget:
+        return ctx
+    for level in (1, 0):
+        for i in near:
+            detail[i] = level
+        ctx = render()
+        if estimate_tokens(ctx) <= budget:
+            return ctx
+    # titoli lontani: dal più distante dal target (o dalla fine, per il tutor)
+    anchor = step_idx if has_target else 0
+    for i in sorted((i for i in keep if not has_target or i != step_idx), key=lambda i: -abs(i - anchor)):
+        keep.remove(i)
+        ctx = render()
+        if estimate_tokens(ctx) <= budget:
+            return ctx
+    excess = estimate_tokens(ctx) - budget
+    if overview and excess > 0:
+        overview = overview[: max(0, len(overview) - excess * 4)] + "…"
+        ctx = render()
+    if has_target and estimate_tokens(ctx) > budget:
+        detail[step_idx] = 1
+        ctx = render()
+    return ctx
+
+# ========================= ESTRATTI DAL LIBRO =========================
+# Con un libro associato (plan_context["textbook_hash"]) i prompt ricevono solo i blocchi più
+# pertinenti recuperati dall'indice locale (db.search_textbook), in aggiunta al budget del contesto.
+PLAN_SOURCE_TOP_K = int(os.getenv("PLAN_SOURCE_TOP_K", "12"))
+
+def _clip_tokens(text: str, budget: int) -> str:
+    """Taglia il testo a circa `budget` token stimati (su un confine di riga quando possibile)."""
+    if estimate_tokens(text) <= budget:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:  # ricerca binaria sulla lunghezza: la stima non è lineare nei caratteri
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text.rfind("\n", 0, lo)
+    return text[: cut if cut > lo // 2 else lo]
+
+def textbook_excerpts(textbook_hash: str | None, query: str, budget: int = SOURCE_PROMPT_TOKENS,
+                      k: int = SOURCE_TOP_K) -> str:
+    """I blocchi del libro più pertinenti per `query`, in ordine di pagina, entro `budget` token stimati.
+
+    Ritorna "" senza libro, senza indice o senza risultati. Se il budget non basta restano fuori
+    i blocchi meno pertinenti (l'ultimo ammesso può essere tagliato).
+    """
+    if not textbook_hash:
+        return ""
+    picked, used = [], 0
+    for hit in search_textbook(textbook_hash, query, k):
+        piece = f"[p. {hit['page']}] {hit['text']}"
+        cost = estimate_tokens(piece) + 1
+        if used + cost > budget:
+            if budget - used < 50:
+                break
+            piece, cost = _clip_tokens(piece, budget - used), budget - used
+        picked.append((hit["chunk_idx"], piece))
+        used += cost
+    return "\n\n".join(piece for _, piece in sorted(picked))
+
+def _step_query(step: dict) -> str:
+    return " ".join([step.get("title", ""), step.get("objective", ""), *map(str, step.get("theory_outline") or [])])
+
+def _with_sources(prompt: str, plan_context: dict, query: str, budget: int = SOURCE_PROMPT_TOKENS,
+                  k: int = SOURCE_TOP_K) -> str:
+    """`prompt` più gli estratti pertinenti del libro del piano (se ce n'è uno)."""
+    excerpts = textbook_excerpts((plan_context or {}).get("textbook_hash"), query, budget, k)
+    return prompt + SOURCES_SECTION.format(sources=excerpts) if excerpts else prompt
 
 def _fallback_plan(topic: str, level: str, time_per_day: int, goal_mode: str = "misto") -> dict:
     level_note = {
@@ -107,58 +464,244 @@ def _fallback_plan(topic: str, level: str, time_per_day: int, goal_mode: str = "
         "_meta": {"source": "fallback", "lang": "it"}
     }
 
-def generate_plan(topic: str, level: str = "beginner", time_per_day: int = 30, goal_mode: str = "misto") -> dict:
-    if DEMO_MODE or client is None:
+async def agenerate_plan(topic: str, level: str = "beginner", time_per_day: int = 30, goal_mode: str = "misto",
+                         use_cache: bool = True, source_text: str | None = None,
+                         textbook_hash: str | None = None) -> dict:
+    """Libro caricato (ingest.py): con textbook_hash il prompt riceve i blocchi indicizzati più pertinenti
+    all'argomento, altrimenti l'inizio di source_text; in entrambi i casi entro TEXTBOOK_PROMPT_TOKENS."""
+    if DEMO_MODE or aclient is None:
         return _fallback_plan(topic, level, time_per_day, goal_mode)
     try:
         # chiamata reale (funzionerà quando avrai credito)
         prompt = PLAN_PROMPT.format(topic=topic, level=level, time_per_day=time_per_day, goal_mode=goal_mode)
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        text = resp.choices[0].message.content
-        try:
-            return json.loads(text)
-        except Exception:
-            start, end = text.find("{"), text.rfind("}")
-            return json.loads(text[start:end+1]) if start != -1 and end != -1 else {"raw": text}
+        excerpts = await asyncio.to_thread(textbook_excerpts, textbook_hash, topic, TEXTBOOK_PROMPT_TOKENS,
+                                           PLAN_SOURCE_TOP_K)
+        if not excerpts and source_text:  # libro non indicizzato (SQLite senza FTS5) o nessun blocco pertinente
+            excerpts = _clip_tokens(source_text.strip(), TEXTBOOK_PROMPT_TOKENS)
+        if excerpts:
+            prompt += TEXTBOOK_SECTION.format(textbook=excerpts)
+        text = await _achat(prompt, 0.3, use_cache, json_mode=True, kind="plan")
+        return await _structured(text, PLAN, f"Piano di studio su '{topic}' (livello {level}, modalità {goal_mode})")
     except Exception as e:  # include insufficient_quota
         plan = _fallback_plan(topic, level, time_per_day, goal_mode)
         plan["_error"] = str(e)
         return plan
 
-def tutor_answer(plan_context: dict, question: str) -> str:
-    if DEMO_MODE or client is None:
-        return (
-            f"Modalità demo – nessuna chiamata API.\n"
-            f"Domanda: {question}\n"
-            f"Suggerimento: passa al prossimo passo del piano, svolgi una micro‑attività, "
-            f"e annota la più piccola domanda che ti blocca."
-        )
-    ctx = json.dumps({k: plan_context.get(k) for k in ("overview", "steps")})
-    prompt = TUTOR_PROMPT.format(plan_context=ctx, question=question)
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2
+def generate_plan(topic: str, level: str = "beginner", time_per_day: int = 30, goal_mode: str = "misto",
+                  use_cache: bool = True, source_text: str | None = None, textbook_hash: str | None = None) -> dict:
+    """use_cache=False forza una nuova generazione (es. per espandere un piano già esistente)."""
+    return run_sync(agenerate_plan(topic, level, time_per_day, goal_mode, use_cache, source_text, textbook_hash))
+
+def _demo_tutor_answer(question: str) -> str:
+    return (
+        f"Modalità demo – nessuna chiamata API.\n"
+        f"Domanda: {question}\n"
+        f"Suggerimento: passa al prossimo passo del piano, svolgi una micro‑attività, "
+        f"e annota la più piccola domanda che ti blocca."
     )
-    return resp.choices[0].message.content.strip()
+
+# Cache del tutor: risposte salvate per piano (tutor_qa) e riusate per la stessa domanda normalizzata o
+# per una quasi identica: similarità di Jaccard sui trigrammi di caratteri sopra la soglia.
+TUTOR_DEDUP_THRESHOLD = float(os.getenv("TUTOR_DEDUP_THRESHOLD", "0.85"))
+_NUM_RE = re.compile(r"\d+")
+
+def normalize_question(question: str) -> str:
+    """Minuscole, senza accenti né punteggiatura, spazi compattati: "Cos'è l'Entropia?" -> "cos e l entropia"."""
+    text = unicodedata.normalize("NFKD", question or "").lower()
+    text = "".join(ch if ch.isalnum() else " " for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.split())
+
+@lru_cache(maxsize=4096)
+def _trigrams(qkey: str) -> frozenset:
+    padded = f" {qkey} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def cached_tutor_answer(plan_id: int, question: str) -> str | None:
+    """Risposta già data sul piano alla stessa domanda (o a una quasi identica), None se non c'è.
+
+    Due domande con numeri diversi ("esercizio 3" / "esercizio 4") non sono mai considerate uguali.
+    """
+    qkey = normalize_question(question)
+    if not qkey:
+        return None
+    hit = get_tutor_answer(plan_id, qkey)
+    if hit is not None:
+        return hit
+    grams, nums = _trigrams(qkey), _NUM_RE.findall(qkey)
+    best, best_sim = None, TUTOR_DEDUP_THRESHOLD
+    for other in tutor_questions(plan_id):
+        other_grams = _trigrams(other)
+        # limite superiore della Jaccard: scarta subito le domande di lunghezza troppo diversa
+        if min(len(grams), len(other_grams)) < best_sim * max(len(grams), len(other_grams)):
+            continue
+        sim = len(grams & other_grams) / len(grams | other_grams)
+        if sim >= best_sim and _NUM_RE.findall(other) == nums:
+            best, best_sim = other, sim
+    return get_tutor_answer(plan_id, best) if best else None
+
+def _remember_tutor_answer(plan_id: int, question: str, answer: str):
+    qkey = normalize_question(question)
+    if qkey and answer.strip():
+        set_tutor_answer(plan_id, qkey, question, answer.strip())
+
+# Conversazione: gli ultimi TUTOR_KEEP_TURNS turni restano nel prompt per intero, i precedenti vengono
+# piegati in un riassunto aggiornato in background (una chiamata ogni TUTOR_FOLD_EVERY turni), così
+# il prompt resta entro TUTOR_HISTORY_TOKENS qualunque sia la lunghezza della conversazione.
+TUTOR_KEEP_TURNS = int(os.getenv("TUTOR_KEEP_TURNS", "3"))
+TUTOR_FOLD_EVERY = int(os.getenv("TUTOR_FOLD_EVERY", "2"))
+_TURN_ANSWER_TOKENS = 300  # per risposta, nel materiale da riassumere
+_folding: set[tuple[int, int]] = set()  # sessioni con un riassunto in corso (solo dal loop)
+
+def _turn_text(turn: dict, answer_budget: int) -> str:
+    return f"Studente: {turn['question']}\nSynapse: {_clip_tokens(turn['answer'], answer_budget)}"
+
+def _conversation(session: dict | None) -> str:
+    """Riassunto + turni più recenti entro TUTOR_HISTORY_TOKENS: i turni più vecchi escono per primi."""
+    if not session or not (session["summary"] or session["turns"]):
+        return "(nessuna: è la prima domanda)"
+    parts, budget = [], TUTOR_HISTORY_TOKENS
+    if session["summary"]:
+        parts.append("Riassunto dei turni precedenti: " + _clip_tokens(session["summary"], TUTOR_SUMMARY_TOKENS))
+        budget -= estimate_tokens(parts[0])
+    recent = []
+    for turn in reversed(session["turns"]):
+        text = _turn_text(turn, max(50, budget // 2))
+        cost = estimate_tokens(text)
+        if cost > budget:
+            break
+        recent.append(text)
+        budget -= cost
+    return "\n\n".join(parts + recent[::-1])
+
+def _local_fold(summary: str, turns: list[dict]) -> str:
+    """Riassunto senza modello (provider non disponibile): accoda le domande, tiene le più recenti."""
+    text = (summary + " " if summary else "") + "Domande successive: " + "; ".join(t["question"] for t in turns)
+    while estimate_tokens(text) > TUTOR_SUMMARY_TOKENS and "; " in text:
+        text = text[text.index("; ") + 2:]
+    return _clip_tokens(text, TUTOR_SUMMARY_TOKENS)
+
+async def _afold(plan_id: int, user_id: int):
+    """Piega nel riassunto i turni usciti dalla finestra (se sono almeno TUTOR_FOLD_EVERY)."""
+    key = (plan_id, user_id)
+    if key in _folding:
+        return
+    _folding.add(key)
+    try:
+        session = await asyncio.to_thread(get_tutor_session, plan_id, user_id)
+        old = session["turns"][:max(0, len(session["turns"]) - TUTOR_KEEP_TURNS)]
+        if len(old) < TUTOR_FOLD_EVERY:
+            return
+        prompt = TUTOR_SUMMARY_PROMPT.format(
+            summary=session["summary"] or "(vuoto)",
+            turns="\n\n".join(_turn_text(t, _TURN_ANSWER_TOKENS) for t in old),
+            max_words=TUTOR_SUMMARY_TOKENS * 3 // 4,
+        )
+        try:
+            summary = (await _achat(prompt, 0.1, kind="summary")).strip()
+        except LLMUnavailable:
+            summary = _local_fold(session["summary"], old)
+        await asyncio.to_thread(set_tutor_summary, plan_id, user_id,
+                                _clip_tokens(summary, TUTOR_SUMMARY_TOKENS), old[-1]["id"], session["upto"])
+    finally:
+        _folding.discard(key)
+
+def _tutor_session(plan_id: int | None, user_id: int | None) -> dict | None:
+    return get_tutor_session(plan_id, user_id) if plan_id is not None and user_id is not None else None
+
+def _first_turn(session: dict | None) -> bool:
+    return not session or not (session["summary"] or session["turns"])
+
+def _after_tutor_answer(plan_id: int | None, user_id: int | None, question: str, answer: str, cacheable: bool):
+    """Salva la risposta: in cache solo se indipendente dalla conversazione, nella sessione se c'è."""
+    if plan_id is None or not answer.strip():
+        return
+    if cacheable:
+        _remember_tutor_answer(plan_id, question, answer)
+    if user_id is not None:
+        add_tutor_turn(plan_id, user_id, question, answer.strip())
+        asyncio.run_coroutine_threadsafe(_afold(plan_id, user_id), _loop)  # fuori dal percorso della risposta
+
+async def _astore_tutor(agen, plan_id: int | None, user_id: int | None, question: str, cacheable: bool):
+    """Inoltra lo stream e salva la risposta solo se è arrivata per intero."""
+    parts = []
+    async for delta in agen:
+        parts.append(delta)
+        yield delta
+    await asyncio.to_thread(_after_tutor_answer, plan_id, user_id, question, "".join(parts), cacheable)
+
+def _tutor_prompt(plan_context: dict, question: str, session: dict | None = None) -> str:
+    conversation = _conversation(session)
+    ctx = build_step_context(plan_context, None,
+                             context_budget(TUTOR_PROMPT, question=question, conversation=conversation))
+    prompt = TUTOR_PROMPT.format(plan_context=ctx, question=question, conversation=conversation)
+    # le domande di seguito ("e poi?") cercano nel libro anche con la domanda precedente
+    query = " ".join([question] + [t["question"] for t in (session or {}).get("turns", [])[-1:]])
+    return _with_sources(prompt, plan_context, query)
+
+async def atutor_answer(plan_context: dict, question: str, fallback: bool = True, plan_id: int | None = None,
+                        user_id: int | None = None) -> str:
+    """Con plan_id le risposte alla prima domanda sono lette/salvate nella cache del piano; con anche
+    user_id la domanda continua la conversazione salvata (le risposte demo non vengono salvate)."""
+    if DEMO_MODE or aclient is None:
+        return _demo_tutor_answer(question)
+    session = await asyncio.to_thread(_tutor_session, plan_id, user_id)
+    cacheable = _first_turn(session)
+    if plan_id is not None and cacheable:
+        cached = await asyncio.to_thread(cached_tutor_answer, plan_id, question)
+        if cached is not None:
+            await asyncio.to_thread(_after_tutor_answer, plan_id, user_id, question, cached, False)
+            return cached
+    try:
+        prompt = await asyncio.to_thread(_tutor_prompt, plan_context, question, session)
+        answer = (await _achat(prompt, 0.2, kind="tutor")).strip()
+    except LLMUnavailable:
+        if not fallback:
+            raise
+        return _demo_tutor_answer(question)
+    await asyncio.to_thread(_after_tutor_answer, plan_id, user_id, question, answer, cacheable)
+    return answer
+
+def tutor_answer(plan_context: dict, question: str, fallback: bool = True, plan_id: int | None = None,
+                 user_id: int | None = None) -> str:
+    return run_sync(atutor_answer(plan_context, question, fallback, plan_id, user_id))
+
+def _stream_or_fallback(agen, demo, fallback: bool):
+    """Stream sincrono con failover: se il provider non risponde prima del primo delta usa `demo()`."""
+    started = False
+    try:
+        for delta in _iter_sync(agen):
+            started = True
+            yield delta
+    except LLMUnavailable:
+        if started or not fallback:
+            raise
+        yield demo()
+
+def tutor_answer_stream(plan_context: dict, question: str, fallback: bool = True, plan_id: int | None = None,
+                        user_id: int | None = None):
+    """Come tutor_answer ma restituisce un generatore di delta di testo (per st.write_stream)."""
+    if DEMO_MODE or aclient is None:
+        yield _demo_tutor_answer(question)
+        return
+    session = _tutor_session(plan_id, user_id)
+    cacheable = _first_turn(session)
+    if plan_id is not None and cacheable:
+        cached = cached_tutor_answer(plan_id, question)
+        if cached is not None:
+            _after_tutor_answer(plan_id, user_id, question, cached, False)
+            yield cached
+            return
+    agen = _astream(_tutor_prompt(plan_context, question, session), 0.2, kind="tutor")
+    if plan_id is not None:
+        agen = _astore_tutor(agen, plan_id, user_id, question, cacheable)
+    yield from _stream_or_fallback(agen, lambda: _demo_tutor_answer(question), fallback)
 
 def generate_concept_map(plan_json, step_idx=None, textbook_text=None):
     """
-    Return a simple dict representing a concept map (nodes & edges).
-    Replace with your LLM call; this is a placeholder structure.
+    Return a dict representing a concept map (nodes & edges): the step sequence plus links
+    between non-consecutive steps sharing key terms (see concept_map.plan_graph).
     """
-    title = plan_json.get("overview","Concetti")
-    steps = plan_json.get("steps", [])
-    nodes = [{"id": f"s{i}", "label": s.get("title","")} for i,s in enumerate(steps)]
-    edges = [{"from": f"s{i}", "to": f"s{i+1}"} for i in range(max(0,len(steps)-1))]
-    if step_idx is not None:
-        # emphasize selected step
-        nodes[step_idx]["label"] = "⭐ " + nodes[step_idx]["label"]
-    return {"title": title, "nodes": nodes, "edges": edges}
+    return {"title": plan_json.get("overview", "Concetti"), **plan_graph(plan_json, step_idx)}
 
 def propose_exercises_for_step(step):
     """Return a short list of exercises for the given step. Placeholder."""
@@ -169,98 +712,206 @@ def propose_exercises_for_step(step):
         "Esercizio 3: crea un riassunto di 150 parole"
     ]
 
-def generate_exercises_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str) -> dict:
-    if DEMO_MODE or client is None:
-        step = (plan_context.get("steps") or [{}])[step_idx] if step_idx < len(plan_context.get("steps",[])) else {}
-        # Fallback più ricco ma locale
-        guided = {
-            "title": f"Esercizio guidato: {step.get('title','Concetto')}",
-            "steps": [
-                "Prepara una scheda con definizioni e un esempio reale",
-                "Applica il concetto a un caso scolastico (3 passaggi)",
-                "Confronta con un controesempio e spiega la differenza",
-                "Scrivi una conclusione di 120–150 parole"
-            ]
-        }
-        quiz = [
-            {"q":"Individua l'idea centrale dello step.","opts":["Definizioni isolate","Idea con relazioni","Solo applicazioni","Solo storia"],"a":1,"why":"Serve collegare definizione-relazioni"},
-            {"q":"Cosa fare se trovi una contraddizione?","opts":["Ignorarla","Considerarla motore dell'analisi","Scartare il problema","Memorizzare regole"],"a":1,"why":"Analizzare e integrare"},
-            {"q":"Quale elemento non fa parte di un esempio ben costruito?","opts":["Contesto","Passi","Verifica","Abbellimenti irrilevanti"],"a":3,"why":"Rilevanza prima di tutto"},
-            {"q":"Quanto deve essere lungo un riassunto efficace?","opts":["> 500 parole","120–180 parole","Una parola","Nessun limite"],"a":1,"why":"Sintesi densa"},
-            {"q":"Per la verifica è utile…","opts":["Solo leggere","Fare quiz mirati","Saltare esercizi","Rinunciare"],"a":1,"why":"Pratica mirata"},
+def demo_exercises(plan_context: dict, step_idx: int) -> dict:
+    """Esercizi locali (modalità demo o provider non disponibile)."""
+    step = (plan_context.get("steps") or [{}])[step_idx] if step_idx < len(plan_context.get("steps",[])) else {}
+    # Fallback più ricco ma locale
+    guided = {
+        "title": f"Esercizio guidato: {step.get('title','Concetto')}",
+        "steps": [
+            "Prepara una scheda con definizioni e un esempio reale",
+            "Applica il concetto a un caso scolastico (3 passaggi)",
+            "Confronta con un controesempio e spiega la differenza",
+            "Scrivi una conclusione di 120–150 parole"
         ]
-        writing = {"prompt": f"Scrivi un saggio breve (120–180 parole) che spieghi '{step.get('title','il concetto')}' con un esempio e un controesempio.", "min":120, "max":180, "rubric":["Definizione corretta","Esempio e controesempio","Chiarezza e lessico", "Collegamenti"]}
-        return {"guided": guided, "quiz": quiz, "writing": writing}
+    }
+    quiz = [
+        {"q":"Individua l'idea centrale dello step.","opts":["Definizioni isolate","Idea con relazioni","Solo applicazioni","Solo storia"],"a":1,"why":"Serve collegare definizione-relazioni"},
+        {"q":"Cosa fare se trovi una contraddizione?","opts":["Ignorarla","Considerarla motore dell'analisi","Scartare il problema","Memorizzare regole"],"a":1,"why":"Analizzare e integrare"},
+        {"q":"Quale elemento non fa parte di un esempio ben costruito?","opts":["Contesto","Passi","Verifica","Abbellimenti irrilevanti"],"a":3,"why":"Rilevanza prima di tutto"},
+        {"q":"Quanto deve essere lungo un riassunto efficace?","opts":["> 500 parole","120–180 parole","Una parola","Nessun limite"],"a":1,"why":"Sintesi densa"},
+        {"q":"Per la verifica è utile…","opts":["Solo leggere","Fare quiz mirati","Saltare esercizi","Rinunciare"],"a":1,"why":"Pratica mirata"},
+    ]
+    writing = {"prompt": f"Scrivi un saggio breve (120–180 parole) che spieghi '{step.get('title','il concetto')}' con un esempio e un controesempio.", "min":120, "max":180, "rubric":["Definizione corretta","Esempio e controesempio","Chiarezza e lessico", "Collegamenti"]}
+    return {"guided": guided, "quiz": quiz, "writing": writing}
+
+async def agenerate_exercises_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str,
+                                 fallback: bool = True) -> dict:
+    """fallback=False solleva LLMUnavailable invece di restituire gli esercizi demo (es. per non metterli in cache)."""
+    if DEMO_MODE or aclient is None:
+        return demo_exercises(plan_context, step_idx)
 
     steps = plan_context.get("steps") or []
     step = steps[step_idx] if 0 <= step_idx < len(steps) else {}
-    ctx = json.dumps({k: plan_context.get(k) for k in ("overview", "steps")}, ensure_ascii=False)
-    prompt = EXERCISE_PROMPT.format(
-        plan_context=ctx,
+    fields = dict(
         step_idx=step_idx,
         level=level,
         goal_mode=goal_mode,
         step_title=step.get("title",""),
         step_outline=json.dumps(step.get("theory_outline", []), ensure_ascii=False)
     )
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role":"user","content":prompt}],
-        temperature=0.2
+    ctx = build_step_context(plan_context, step_idx, context_budget(EXERCISE_PROMPT, **fields))
+    prompt = await asyncio.to_thread(_with_sources, EXERCISE_PROMPT.format(plan_context=ctx, **fields),
+                                     plan_context, _step_query(step))
+    try:
+        txt = await _achat(prompt, 0.2, json_mode=True, kind="exercises")
+        return await _structured(txt, EXERCISES, f"Esercizi per lo step {step_idx}: {step.get('title','')} (livello {level})")
+    except LLMUnavailable:
+        if not fallback:
+            raise
+        return demo_exercises(plan_context, step_idx)
+
+def generate_exercises_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str,
+                          fallback: bool = True) -> dict:
+    return run_sync(agenerate_exercises_ai(plan_context, step_idx, level, goal_mode, fallback))
+
+def demo_explanation(plan_context: dict, step_idx: int) -> str:
+    """Spiegazione locale (modalità demo o provider non disponibile)."""
+    step = (plan_context.get("steps") or [{}])[step_idx] if step_idx < len(plan_context.get("steps",[])) else {}
+    title = step.get("title","Concetto")
+    bullets = step.get("theory_outline", [])
+    pts = "\n".join([f"- {b}" for b in bullets])
+    return (
+        f"### {title}\n\n"
+        f"Obiettivo: comprendere a fondo il tema e saperlo applicare.\n\n"
+        f"Idee chiave:\n{pts}\n\n"
+        f"Approfondimenti: definizioni chiare, esempio concreto, mito da sfatare.\n\n"
+        f"Mini-check: 1) definisci il concetto 2) fai un esempio 3) indica un limite."
     )
-    txt = resp.choices[0].message.content
-    start, end = txt.find("{"), txt.rfind("}")
-    data = json.loads(txt[start:end+1]) if start!=-1 and end!=-1 else json.loads(txt)
-    return data
-
-def explain_step_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str) -> str:
-    if DEMO_MODE or client is None:
-        step = (plan_context.get("steps") or [{}])[step_idx] if step_idx < len(plan_context.get("steps",[])) else {}
-        title = step.get("title","Concetto")
-        bullets = step.get("theory_outline", [])
-        pts = "\n".join([f"- {b}" for b in bullets])
-        return (
-            f"### {title}\n\n"
-            f"Obiettivo: comprendere a fondo il tema e saperlo applicare.\n\n"
-            f"Idee chiave:\n{pts}\n\n"
-            f"Approfondimenti: definizioni chiare, esempio concreto, mito da sfatare.\n\n"
-            f"Mini-check: 1) definisci il concetto 2) fai un esempio 3) indica un limite."
-        )
 
+def _explain_prompt(plan_context: dict, step_idx: int, level: str, goal_mode: str) -> str:
     steps = plan_context.get("steps") or []
     step = steps[step_idx] if 0 <= step_idx < len(steps) else {}
-    ctx = json.dumps({k: plan_context.get(k) for k in ("overview", "steps")}, ensure_ascii=False)
-    prompt = EXPLAIN_PROMPT.format(
-        plan_context=ctx,
+    fields = dict(
         step_idx=step_idx,
         level=level,
         goal_mode=goal_mode,
         step_title=step.get("title",""),
         step_outline=json.dumps(step.get("theory_outline", []), ensure_ascii=False)
     )
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role":"user","content":prompt}],
-        temperature=0.2
+    ctx = build_step_context(plan_context, step_idx, context_budget(EXPLAIN_PROMPT, **fields))
+    return _with_sources(EXPLAIN_PROMPT.format(plan_context=ctx, **fields), plan_context, _step_query(step))
+
+async def aexplain_step_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str,
+                           fallback: bool = True) -> str:
+    """fallback=False solleva LLMUnavailable invece di restituire la spiegazione demo."""
+    if DEMO_MODE or aclient is None:
+        return demo_explanation(plan_context, step_idx)
+    try:
+        prompt = await asyncio.to_thread(_explain_prompt, plan_context, step_idx, level, goal_mode)
+        return (await _achat(prompt, 0.2, kind="explain")).strip()
+    except LLMUnavailable:
+        if not fallback:
+            raise
+        return demo_explanation(plan_context, step_idx)
+
+def explain_step_ai(plan_context: dict, step_idx: int, level: str, goal_mode: str, fallback: bool = True) -> str:
+    return run_sync(aexplain_step_ai(plan_context, step_idx, level, goal_mode, fallback))
+
+def explain_step_ai_stream(plan_context: dict, step_idx: int, level: str, goal_mode: str, fallback: bool = True):
+    """Come explain_step_ai ma restituisce un generatore di delta Markdown (per st.write_stream).
+
+    Il chiamante ricompone il testo e lo salva in cache solo a stream completato (con fallback=False
+    un provider non disponibile solleva LLMUnavailable, così il testo demo non finisce in cache).
+    """
+    if DEMO_MODE or aclient is None:
+        yield demo_explanation(plan_context, step_idx)
+        return
+    yield from _stream_or_fallback(
+        _astream(_explain_prompt(plan_context, step_idx, level, goal_mode), 0.2, kind="explain"),
+        lambda: demo_explanation(plan_context, step_idx), fallback
     )
-    return resp.choices[0].message.content.strip()
 
-def generate_plan_from_textbook(topic, target_level, textbook_text):
-    """Placeholder: mix topic+level+textbook to produce a plan structure."""
-    if not textbook_text:  # fallback
-        return generate_plan(topic, target_level, 30)
-    # Simple scaffold
-    return {
-        "overview": f"Piano per '{topic}' (livello {target_level}) basato sul libro caricato.",
-        "steps": [
-            {"title":"Contenuti fondamentali", "objective":"Capire i concetti base",
-             "theory_outline":[f"Cap. 1-2 del testo: {topic}"],
-             "practice_tasks":[ "Esercizi di fine capitolo 1", "Quiz su definizioni" ],
-             "suggested_resources":[ "Appunti dal libro", "Video introduttivo" ]},
-            {"title":"Applicazioni e problemi", "objective":"Applicare le tecniche principali",
-             "theory_outline":[ "Cap. 3-4: tecniche e metodi"],
-             "practice_tasks":[ "Problemi selezionati cap. 3", "1 progetto breve" ],
-             "suggested_resources":[ "Esempi svolti del testo" ]},
-        ],
-        "review_strategy":[ "Ripasso dopo 2 giorni", "Ripasso dopo 1 settimana" ]
-    }
+# ========================= GENERAZIONE BATCH =========================
+# Più step in una sola chiamata: il contesto del piano viene inviato una volta sola per batch.
+# La dimensione del batch segue i token di output realmente osservati per step, sotto un tetto.
+BATCH_OUTPUT_TOKEN_CAP = int(os.getenv("BATCH_OUTPUT_TOKEN_CAP", "8000"))
+BATCH_MAX_STEPS = int(os.getenv("BATCH_MAX_STEPS", "8"))
+_BATCH_KINDS = {
+    # kind di ai_cache -> (template, campo dell'item, stima iniziale token/step)
+    "explain_md": (BATCH_EXPLAIN_PROMPT, "explanation_md", EXPLAIN_OUTPUT_TOKENS),
+    "exercises_json": (BATCH_EXERCISE_PROMPT, "exercises", EXERCISES_OUTPUT_TOKENS),
+}
+_out_tokens = {k: float(v[2]) for k, v in _BATCH_KINDS.items()}  # media mobile dei token di output per step
+
+def batch_size(kind: str) -> int:
+    """Quanti step per chiamata stanno sotto BATCH_OUTPUT_TOKEN_CAP (con margine del 25%)."""
+    return max(1, min(BATCH_MAX_STEPS, int(BATCH_OUTPUT_TOKEN_CAP // (_out_tokens[kind] * 1.25))))
+
+def _observe_output(kind: str, tokens_per_step: float):
+    _out_tokens[kind] = 0.7 * _out_tokens[kind] + 0.3 * tokens_per_step
+
+def _batch_targets(plan_context: dict, indices: list[int]) -> str:
+    steps = plan_context.get("steps") or []
+    return json.dumps([
+        {"idx": i, **{k: steps[i][k] for k in ("title", "objective", "theory_outline") if k in steps[i]}}
+        for i in indices
+    ], ensure_ascii=False)
+
+async def _abatch_once(plan_context: dict, indices: list[int], kind: str, level: str, goal_mode: str) -> dict:
+    """Una chiamata per `indices`: ritorna {step_idx: contenuto} per gli item validi (anche parziali)."""
+    template, field, _ = _BATCH_KINDS[kind]
+    targets = _batch_targets(plan_context, indices)
+    fields = dict(level=level, goal_mode=goal_mode, targets=targets)
+    # il budget di contesto non dipende dal numero di step nel batch
+    budget = context_budget(template, total=PROMPT_TOKEN_BUDGET + estimate_tokens(targets), **fields)
+    prompt = template.format(plan_context=build_step_context(plan_context, None, budget), **fields)
+    steps = plan_context.get("steps") or []
+    # estratti condivisi dal batch: budget e k crescono con gli step, fino al doppio del singolo step
+    scale = min(2, len(indices))
+    prompt = await asyncio.to_thread(_with_sources, prompt, plan_context,
+                                     " ".join(_step_query(steps[i]) for i in indices),
+                                     SOURCE_PROMPT_TOKENS * scale, SOURCE_TOP_K * scale)
+    text = await _achat(prompt, 0.2, json_mode=True, kind="batch", max_tokens=BATCH_OUTPUT_TOKEN_CAP)
+    doc = repair_json(text)  # una risposta troncata conserva gli item completi
+    items = doc.get("items") if isinstance(doc, dict) else None
+    out = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict) or item.get("step_idx") not in indices:
+            continue
+        value = item.get(field)
+        if kind == "explain_md" and isinstance(value, str) and value.strip():
+            out[item["step_idx"]] = value.strip()
+        elif kind == "exercises_json" and isinstance(value, dict) and not EXERCISES.validate(value):
+            out[item["step_idx"]] = value
+    if out:
+        _observe_output(kind, estimate_tokens(text) / len(out))
+    if len(out) < len(indices):
+        # risposta incompleta (spesso per il tetto di output): i prossimi batch saranno più piccoli
+        _observe_output(kind, _out_tokens[kind] * len(indices) / max(1, len(out)))
+    return out
+
+async def agenerate_batch(plan_context: dict, step_indices, kind: str, level: str, goal_mode: str) -> dict:
+    """Genera spiegazioni ("explain_md") o esercizi ("exercises_json") per più step.
+
+    Ritorna {step_idx: contenuto | Exception}: gli step mancanti o non validi nella risposta
+    batch vengono rigenerati singolarmente; un batch fallito del tutto passa ai singoli step.
+    Nessun fallback demo (il risultato è pensato per ai_cache).
+    """
+    indices = list(dict.fromkeys(step_indices))
+    single = aexplain_step_ai if kind == "explain_md" else agenerate_exercises_ai
+    if DEMO_MODE or aclient is None or len(indices) <= 1:
+        res = await agather([single(plan_context, i, level, goal_mode, fallback=False) for i in indices])
+        return dict(zip(indices, res))
+    size = batch_size(kind)
+    chunks = [indices[i:i + size] for i in range(0, len(indices), size)]
+    results = {}
+    for chunk, res in zip(chunks, await agather([_abatch_once(plan_context, c, kind, level, goal_mode) for c in chunks])):
+        if isinstance(res, LLMUnavailable):
+            results.update({i: res for i in chunk})  # il provider non risponde: inutile riprovare step per step
+        elif not isinstance(res, Exception):
+            results.update(res)
+    missing = [i for i in indices if i not in results]
+    res = await agather([single(plan_context, i, level, goal_mode, fallback=False) for i in missing])
+    results.update(zip(missing, res))
+    return results
+
+def generate_batch(plan_context: dict, step_indices, kind: str, level: str, goal_mode: str) -> dict:
+    return run_sync(agenerate_batch(plan_context, step_indices, kind, level, goal_mode))
+
+def generate_plan_from_textbook(topic, target_level, textbook_text, goal_mode: str = "misto",
+                                textbook_hash: str | None = None):
+    """Piano basato sul libro caricato: i blocchi pertinenti dell'indice (o l'inizio del testo estratto)
+    entrano nel prompt come riferimento."""
+    return generate_plan(topic, target_level, 30, goal_mode, source_text=textbook_text or None,
+                         textbook_hash=textbook_hash)
@@ -1,14 +1,21 @@
 import os
 import json
+import random
 from pathlib import Path
 from datetime import date
 import streamlit as st
-from ai import generate_plan, tutor_answer, generate_exercises_ai, explain_step_ai
+from concept_map import render_map, map_size, map_tiles, MAP_TILE_SIZE
+from ai import (generate_plan, generate_plan_from_textbook, tutor_answer, tutor_answer_stream,
+                explain_step_ai, explain_step_ai_stream, demo_explanation, demo_exercises, LLMUnavailable)
+from jobs import schedule_plan_content, job_state, job_error, pending_count, claim, release, cancel_plan
 from db import (
-    upsert_user, save_plan, list_plans,
+    upsert_user, save_plan, list_plan_summaries, get_plan, get_plan_count,
     get_progress_map, set_progress, update_plan_topic, delete_plan, update_plan_json,
-    get_ai_cache, set_ai_cache
+    get_ai_cache, set_ai_cache, set_plan_textbook, list_tutor_turns, clear_tutor_session,
+    get_step_meta, set_step_meta, get_agenda
 )
+from ingest import ingest_textbook
+from attachments import store_upload, thumbnail, thumbnail_pending
 
 # ========================= PAGE CONFIG =========================
 st.set_page_config(page_title="Synapse — Impara facilmente", page_icon="🧠", layout="wide")
@@ -116,30 +123,43 @@ section[data-testid="stSidebar"] .planbar::before{ display:none !important; }
 """, unsafe_allow_html=True)
 
 # ========================= Helpers =========================
-def plan_completion_percent(plan) -> int:
-    """Calcola la % di completamento di un piano."""
-    pj = plan.get("plan_json")
-    if isinstance(pj, str):
-        try:
-            pj = json.loads(pj)
-        except Exception:
-            pj = {}
-    steps = (pj or {}).get("steps", [])
-    if not steps:
+def plan_completion_percent(counts: dict | None) -> int:
+    """Calcola la % di completamento di un piano dai contatori aggregati (campo "counts" di list_plan_summaries / get_plan_count)."""
+    total = (counts or {}).get("total", 0)
+    if not total:
         return 0
-    pm = get_progress_map(plan["id"])
-    done = sum(1 for i in range(len(steps)) if pm.get(i, "to-do") == "done")
-    return int((done / len(steps)) * 100)
-
-# --- meta per step (solo in memoria per ora) ---
-st.session_state.setdefault("step_meta", {})  # { plan_id: { step_idx: {due_date:str, notes:str, attachments:list[str]} } }
-def get_step_meta(plan_id: int, step_idx: int) -> dict:
-    return st.session_state["step_meta"].get(plan_id, {}).get(step_idx, {})
-def set_step_meta(plan_id: int, step_idx: int, meta: dict):
-    store = st.session_state["step_meta"].setdefault(plan_id, {})
-    cur = store.get(step_idx, {})
-    cur.update(meta)
-    store[step_idx] = cur
+    return int((counts.get("done", 0) / total) * 100)
+
+PREGEN_POLL_SECONDS = float(os.getenv("PREGEN_POLL_SECONDS", "2"))
+
+def fragment(func):
+    """Sezione che si riesegue da sola: un'interazione al suo interno non riesegue l'intero script.
+
+    Senza st.fragment (Streamlit vecchio) la funzione resta normale e ogni click riesegue tutto.
+    """
+    return st.fragment(func) if hasattr(st, "fragment") else func
+
+def rerun_fragment():
+    """Riesegue solo il fragment corrente (tutta la pagina se non supportato)."""
+    try:
+        st.rerun(scope="fragment")
+    except TypeError:
+        st.rerun()
+
+def ai_placeholder(plan: dict, plan_json: dict, step_idx: int, kind: str, label: str) -> bool:
+    """Segnaposto per un contenuto AI non ancora pronto (generato in background da jobs.py).
+
+    Ritorna True se la generazione è fallita: il chiamante mostra il contenuto demo (non salvato in cache).
+    """
+    if job_state(plan["id"], step_idx, kind) != "error":
+        st.info(f"⏳ {label} in preparazione...")
+        return False
+    st.warning(f"{label}: generazione non riuscita ({job_error(plan['id'], step_idx, kind)}), mostro la versione base")
+    if st.button("Riprova", key=f"retry_{kind}_{step_idx}"):
+        schedule_plan_content(plan["id"], plan_json, plan.get("level", "beginner"), "misto",
+                              step_indices=[step_idx], kinds=(kind,), retry=True)
+        st.rerun()
+    return True
 
 # --- helpers “AI” locali (placeholder) ---
 def propose_exercises_for_step(step):
@@ -148,14 +168,6 @@ def propose_exercises_for_step(step):
         return [f"Esercizio guidato: {base[0]}", "Quiz 5 domande (MCQ)", "Riassunto in 120 parole"]
     return ["Applica il concetto a un caso reale", "3 problemi progressivi con soluzione", "10 flashcards"]
 
-def generate_concept_map(plan_json, step_idx=None):
-    steps = plan_json.get("steps", [])
-    nodes = [{"id": f"s{i}", "label": steps[i].get("title","")} for i in range(len(steps))]
-    edges = [{"from": f"s{i}", "to": f"s{i+1}"} for i in range(max(0, len(steps)-1))]
-    if step_idx is not None and 0 <= step_idx < len(nodes):
-        nodes[step_idx]["label"] = "⭐ " + nodes[step_idx]["label"]
-    return {"nodes": nodes, "edges": edges}
-
 # --- helper aggiuntivi: spiegazioni, esercizi dettagliati e mappa come immagine ---
 def _level_tone(level: str) -> str:
     return {
@@ -210,189 +222,28 @@ def propose_detailed_exercises(step: dict, level: str, step_idx: int):
         }
     ]
 
-def build_concept_map_image(plan_json, step_idx=None):
-    steps = plan_json.get("steps", [])
-    nodes = [{"id": f"s{i}", "label": steps[i].get("title","")} for i in range(len(steps))]
-    edges = [{"from": f"s{i}", "to": f"s{i+1}"} for i in range(max(0, len(steps)-1))]
-    if step_idx is not None and 0 <= step_idx < len(nodes):
-        nodes[step_idx]["label"] = "⭐ " + nodes[step_idx]["label"]
-    cm = {"nodes": nodes, "edges": edges}
-    # genera SVG lineare semplice
-    padding, node_w, node_h, gap = 20, 220, 48, 40
-    width = padding*2 + max(1,len(nodes)) * (node_w + gap) - gap
-    height = padding*2 + node_h
-    pos = {n['id']: (padding + i*(node_w+gap), padding) for i,n in enumerate(nodes)}
-    parts = [f"<svg xmlns='http://www.w3.org/2000/svg' width='{width}' height='{height}' viewBox='0 0 {width} {height}'>",
-             "<style>.node{fill:#1f1f28;stroke:#6b6b7a;stroke-width:1.2;rx:10;ry:10} .text{fill:#e6e6f0;font-size:14px;font-family:Inter,Segoe UI,Arial} .edge{stroke:#8a8aa5;stroke-width:1.2;marker-end:url(#arrow)}</style>",
-             "<defs><marker id='arrow' markerWidth='10' markerHeight='6' refX='9' refY='3' orient='auto' markerUnits='strokeWidth'><path d='M0,0 L10,3 L0,6 z' fill='#8a8aa5'/></marker></defs>"]
-    for e in edges:
-        x1,y1 = pos[e['from']]
-        x2,y2 = pos[e['to']]
-        parts.append(f"<line class='edge' x1='{x1+node_w}' y1='{y1+node_h/2}' x2='{x2}' y2='{y2+node_h/2}' />")
-    for n in nodes:
-        x,y = pos[n['id']]
-        label = (n.get('label') or '').replace('&','&amp;')
-        parts.append(f"<rect class='node' x='{x}' y='{y}' width='{node_w}' height='{node_h}' />")
-        parts.append(f"<text class='text' x='{x+10}' y='{y+28}'>"+label+"</text>")
-    parts.append("</svg>")
-    return "".join(parts)
-
-def concept_map_png(plan_json, step_idx=None):
-    steps = plan_json.get("steps", [])
-    nodes = [{"id": f"s{i}", "label": steps[i].get("title","")} for i in range(len(steps))]
-    edges = [{"from": f"s{i}", "to": f"s{i+1}"} for i in range(max(0, len(steps)-1))]
-    if step_idx is not None and 0 <= step_idx < len(nodes):
-        nodes[step_idx]["label"] = "⭐ " + nodes[step_idx]["label"]
-
-    try:
-        from PIL import Image, ImageDraw, ImageFont
-    except Exception:
-        return None
-
-    padding, node_w, node_h, gap = 20, 260, 64, 28
-    cols = 3
-    rows = (len(nodes) + cols - 1) // cols if nodes else 1
-    width = padding*2 + cols * node_w + (cols-1) * gap
-    height = padding*2 + rows * node_h + (rows-1) * gap
-
-    img = Image.new("RGB", (width, height), (24, 24, 32))
-    dr = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.load_default()
-    except Exception:
-        font = None
-
-    positions = {}
-    for idx, n in enumerate(nodes):
-        r = idx // cols
-        c = idx % cols
-        x = padding + c * (node_w + gap)
-        y = padding + r * (node_h + gap)
-        positions[n["id"]] = (x, y)
-
-    def round_rect(x, y, w, h, r=10, outline=(107,107,122)):
-        dr.rounded_rectangle([x, y, x+w, y+h], radius=r, outline=outline, width=2, fill=(31,31,40))
-
-    for e in edges:
-        x1,y1 = positions[e['from']]
-        x2,y2 = positions[e['to']]
-        cx1, cy1 = x1 + node_w, y1 + node_h/2
-        cx2, cy2 = x2, y2 + node_h/2
-        dr.line([(cx1, cy1), (cx2, cy2)], fill=(138,138,165), width=2)
-        dr.polygon([(cx2-8, cy2-4), (cx2, cy2), (cx2-8, cy2+4)], fill=(138,138,165))
-
-    for n in nodes:
-        x,y = positions[n['id']]
-        round_rect(x, y, node_w, node_h)
-        label = n.get('label') or ''
-        dr.text((x+10, y+node_h/2-6), label, font=font, fill=(230,230,240))
-
-    from io import BytesIO
-    bio = BytesIO()
-    img.save(bio, format="PNG")
-    bio.seek(0)
-    return bio
-
-def concept_map_radial_png(plan_json, topic: str, step_idx: int | None = None):
-    try:
-        from PIL import Image, ImageDraw, ImageFont
-    except Exception:
-        return None
-    steps = plan_json.get("steps", [])
-    labels = [s.get("title","") for s in steps]
-    if step_idx is not None and 0<=step_idx<len(labels):
-        labels[step_idx] = "⭐ " + labels[step_idx]
-
-    w,h = 900, 600
-    img = Image.new("RGB", (w,h), (24,24,32))
-    dr = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.load_default()
-    except Exception:
-        font = None
-
-    cx, cy = w//2, h//2
-    # nodo centrale
-    cw, ch = 260, 70
-    dr.rounded_rectangle([cx-cw//2, cy-ch//2, cx+cw//2, cy+ch//2], radius=12, fill=(31,31,40), outline=(107,107,122), width=2)
-    dr.text((cx-cw//2+10, cy-8), topic, font=font, fill=(230,230,240))
-
-    import math
-    r = min(w,h)//2 - 120
-    n = max(1, len(labels))
-    box_w, box_h = 220, 58
-    for i, label in enumerate(labels):
-        ang = (2*math.pi*i)/n - math.pi/2
-        x = int(cx + r*math.cos(ang)) - box_w//2
-        y = int(cy + r*math.sin(ang)) - box_h//2
-        dr.line([(cx,cy), (x+box_w//2, y+box_h//2)], fill=(138,138,165), width=2)
-        dr.rounded_rectangle([x,y,x+box_w,y+box_h], radius=10, fill=(31,31,40), outline=(107,107,122), width=2)
-        dr.text((x+10, y+box_h//2-8), label, font=font, fill=(230,230,240))
-
-    from io import BytesIO
-    bio = BytesIO(); img.save(bio, format="PNG"); bio.seek(0)
-    return bio
-
-def concept_map_flow_png(plan_json, header: str | None = None):
-    """Mappa concettuale gerarchica a blocchi (stile libro scolastico)."""
-    try:
-        from PIL import Image, ImageDraw, ImageFont
-    except Exception:
-        return None
-    steps = plan_json.get("steps", [])
-    labels = [s.get("title","") for s in steps]
-    # suddividi in 3-4 fasce
-    tiers = []
-    if labels:
-        tiers.append(labels[:2])
-        mid = max(2, len(labels)//3)
-        tiers.append(labels[2:2+mid])
-        tiers.append(labels[2+mid:])
-    else:
-        tiers = [["Introduzione"],["Sviluppo"],["Sintesi"]]
-
-    w,h = 1000, 900
-    img = Image.new("RGB", (w,h), (255,255,255))
-    dr = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.load_default()
-    except Exception:
-        font = None
-
-    # colori e stile
-    col_box = (255, 247, 235)
-    col_border = (210, 150, 90)
-    col_head = (236, 170, 70)
-    col_text = (40, 40, 40)
-
-    # header
-    if header:
-        dr.rounded_rectangle([20,20,w-20,70], radius=8, fill=col_head)
-        dr.text((30,40), header, fill=(255,255,255), font=font)
-
-    top = 100
-    for t, row in enumerate(tiers):
-        if not row: continue
-        y = top + t*220
-        cols = len(row)
-        box_w, box_h = 280, 80
-        gap = (w - 80 - cols*box_w)//(cols-1) if cols>1 else 0
-        xs = [40 + i*(box_w+gap) for i in range(cols)]
-        centers = []
-        for i, label in enumerate(row):
-            x = xs[i]
-            dr.rounded_rectangle([x,y,x+box_w,y+box_h], radius=12, fill=col_box, outline=col_border, width=2)
-            dr.text((x+10,y+25), label, fill=col_text, font=font)
-            centers.append((x+box_w//2, y+box_h))
-        # connettori verticali con fascia successiva
-        if t < len(tiers)-1 and tiers[t+1]:
-            next_y = top + (t+1)*220
-            for cx,cy in centers:
-                dr.line([(cx, cy), (cx, next_y-20)], fill=col_border, width=2)
-
-    from io import BytesIO
-    bio = BytesIO(); img.save(bio, format="PNG"); bio.seek(0)
-    return bio
+# Mappa concettuale: un solo motore con cache in memoria e su disco (concept_map.render_map)
+LINEAR_MAP_MAX = 8  # oltre, la riga singola diventa illeggibile: layout a strati
+
+def _map_layout(plan_json: dict) -> str:
+    return "linear" if len(plan_json.get("steps", [])) <= LINEAR_MAP_MAX else "layered"
+
+def concept_map_svg(plan_json: dict, step_idx: int | None = None, viewport=None) -> str:
+    return render_map(plan_json, _map_layout(plan_json), step_idx, fmt="svg", viewport=viewport).decode("utf-8")
+
+def show_concept_map(plan_json: dict, step_idx: int | None = None):
+    """Mappa intera se sta in un tile; oltre, a tile di MAP_TILE_SIZE px riga per riga (ognuno in cache)."""
+    layout = _map_layout(plan_json)
+    w, h = map_size(plan_json, layout, step_idx)
+    if max(w, h) <= MAP_TILE_SIZE:
+        st.image(concept_map_svg(plan_json, step_idx), use_container_width=True)
+        return
+    tiles = map_tiles(plan_json, layout, step_idx)
+    for y in sorted({t[1] for t in tiles}):
+        row = [t for t in tiles if t[1] == y]
+        for col, viewport in zip(st.columns([t[2] for t in row], gap="small"), row):
+            with col:
+                st.image(concept_map_svg(plan_json, step_idx, viewport), use_container_width=True)
 
 # ========================= SHARE (read-only semplice) =========================
 read_only = False
@@ -409,8 +260,12 @@ if "share" in qp:
 # =========================================================
 APP_DIR = Path(__file__).parent
 LOGO_PATH = APP_DIR / "static" / "logo.png"
+SIDEBAR_PAGE_SIZE = int(os.getenv("SIDEBAR_PAGE_SIZE", "30"))
 
-with st.sidebar:
+# Fragment: rinomina, paginazione e digitazione rieseguono solo la sidebar; selezione,
+# eliminazione e login cambiano la pagina principale e rieseguono tutto (st.rerun()).
+@fragment
+def render_sidebar():
     st.markdown("<div style='text-align:center; margin-top:-18px; margin-bottom:-2px;'>", unsafe_allow_html=True)
     if LOGO_PATH.exists():
         st.image(str(LOGO_PATH), width=46)
@@ -424,6 +279,7 @@ with st.sidebar:
         email = st.text_input("Email", placeholder="tu@esempio.com", key="sb_email")
         if st.button("Continua", key="sb_continue") and email:
             st.session_state["user"] = upsert_user(email)
+            st.rerun()  # il login cambia anche la pagina principale
 
     if "user" in st.session_state or read_only:
         if not read_only:
@@ -441,12 +297,16 @@ with st.sidebar:
         # Titolo I tuoi piani (markdown → niente linee)
         st.markdown("<p class='sidebar-title'>I tuoi piani</p>", unsafe_allow_html=True)
 
-        # Elenco piani
+        # Elenco piani (una pagina alla volta, paginazione keyset)
+        st.session_state.setdefault("plans_cursor", [None])  # pila di after_id: una voce per pagina
+        has_next_page = False
         if read_only and "user" not in st.session_state:
             plans_sidebar = []
         else:
             uid = st.session_state["user"]["id"] if "user" in st.session_state else None
-            plans_sidebar = list_plans(uid) if uid else []
+            plans_sidebar = list_plan_summaries(uid, st.session_state["plans_cursor"][-1], SIDEBAR_PAGE_SIZE + 1) if uid else []
+            has_next_page = len(plans_sidebar) > SIDEBAR_PAGE_SIZE
+            plans_sidebar = plans_sidebar[:SIDEBAR_PAGE_SIZE]
 
         if plans_sidebar and "selected_plan_id" not in st.session_state:
             st.session_state["selected_plan_id"] = plans_sidebar[0]["id"]
@@ -460,7 +320,7 @@ with st.sidebar:
         st.markdown("<div class='plans-stack'>", unsafe_allow_html=True)
 
         for p in plans_sidebar:
-            pct = plan_completion_percent(p)
+            pct = plan_completion_percent(p["counts"])
             selected = (p["id"] == st.session_state.get("selected_plan_id"))
             icon = "📘" if selected else "📁"
             row_class = "planbar selected" if selected else "planbar"
@@ -503,7 +363,7 @@ with st.sidebar:
                     if st.button("✖️", key=f"cancel_{p['id']}", type="secondary", help="Cancel"):
                         st.session_state["rename_target"] = None
                         st.session_state["rename_value"] = ""
-                        st.rerun()
+                        rerun_fragment()
                     st.markdown("</div>", unsafe_allow_html=True)
             elif not read_only:
                 with c_edit:
@@ -511,7 +371,7 @@ with st.sidebar:
                     if st.button("✏️", key=f"ed_{p['id']}", type="secondary", help="Rename"):
                         st.session_state["rename_target"] = p["id"]
                         st.session_state["rename_value"] = p["topic"]
-                        st.rerun()
+                        rerun_fragment()
                     st.markdown("</div>", unsafe_allow_html=True)
                 with c_del:
                     st.markdown("<div class='icon-round'>", unsafe_allow_html=True)
@@ -525,6 +385,18 @@ with st.sidebar:
 
         st.markdown("</div>", unsafe_allow_html=True)  # chiusura .plans-stack
 
+        if has_next_page or len(st.session_state["plans_cursor"]) > 1:
+            c_prev, c_next = st.columns(2)
+            if len(st.session_state["plans_cursor"]) > 1 and c_prev.button("◀", key="plans_prev", use_container_width=True):
+                st.session_state["plans_cursor"].pop()
+                rerun_fragment()
+            if has_next_page and c_next.button("▶", key="plans_next", use_container_width=True):
+                st.session_state["plans_cursor"].append(plans_sidebar[-1]["id"])
+                rerun_fragment()
+
+with st.sidebar:
+    render_sidebar()
+
 # Se non loggato e non in share read-only, fermati qui
 if "user" not in st.session_state and not read_only:
     st.info("Accedi (a sinistra) per creare o gestire i tuoi piani.")
@@ -536,21 +408,24 @@ user = st.session_state.get("user")
 # POPUP conferma eliminazione
 # =========================================================
 if st.session_state.get("show_delete_modal") and st.session_state.get("delete_target") and not read_only:
-    all_plans = list_plans(user["id"])
-    plan_to_del = next((x for x in all_plans if x["id"] == st.session_state["delete_target"]), None)
+    plan_to_del = get_plan(st.session_state["delete_target"])
     plan_name = plan_to_del["topic"] if plan_to_del else "this plan"
 
+    def _after_delete():
+        delete_plan(st.session_state["delete_target"])
+        remaining = list_plan_summaries(user["id"], limit=1)
+        st.session_state["selected_plan_id"] = remaining[0]["id"] if remaining else None
+        st.session_state["plans_cursor"] = [None]
+        st.session_state["delete_target"] = None
+        st.session_state["show_delete_modal"] = False
+
     if hasattr(st, "dialog"):
         @st.dialog("Conferma eliminazione")
         def _confirm_delete_dialog():
             st.error(f"Eliminare '{plan_name}'? L'azione è definitiva.")
             col_ok, col_cancel = st.columns(2)
             if col_ok.button("OK, elimina", type="primary", key="dialog_del_ok"):
-                delete_plan(st.session_state["delete_target"])
-                remaining = [x for x in all_plans if x["id"] != st.session_state["delete_target"]]
-                st.session_state["selected_plan_id"] = remaining[0]["id"] if remaining else None
-                st.session_state["delete_target"] = None
-                st.session_state["show_delete_modal"] = False
+                _after_delete()
                 st.rerun()
             if col_cancel.button("Annulla", key="dialog_del_cancel"):
                 st.session_state["delete_target"] = None
@@ -561,11 +436,7 @@ if st.session_state.get("show_delete_modal") and st.session_state.get("delete_ta
         st.warning(f"Eliminare '{plan_name}'? L'azione è definitiva.")
         col_ok, col_cancel = st.columns(2)
         if col_ok.button("OK, elimina", type="primary", key="fallback_del_ok"):
-            delete_plan(st.session_state["delete_target"])
-            remaining = [x for x in all_plans if x["id"] != st.session_state["delete_target"]]
-            st.session_state["selected_plan_id"] = remaining[0]["id"] if remaining else None
-            st.session_state["delete_target"] = None
-            st.session_state["show_delete_modal"] = False
+            _after_delete()
             st.rerun()
         if col_cancel.button("Annulla", key="fallback_del_cancel"):
             st.session_state["delete_target"] = None
@@ -587,32 +458,48 @@ if st.session_state.get("show_generator", False) and not read_only:
     goals = st.text_area("Quale risultato vuoi ottenere? (opzionale)", placeholder="Esame, progetto, voto massimo, ecc.")
     st.markdown("**Opzionale: libro (PDF)** — verrà usato per arricchire il piano")
     textbook = st.file_uploader("Carica PDF", type=["pdf"], accept_multiple_files=False)
+    textbook_job = None
+    if textbook is not None:
+        # estrazione avviata subito, in un processo separato, mentre si compila il resto del form
+        ingest_jobs = st.session_state.setdefault("_ingest_jobs", {})
+        upload_key = (textbook.name, textbook.size)
+        if upload_key not in ingest_jobs:
+            ingest_jobs[upload_key] = ingest_textbook(textbook)
+        textbook_job = ingest_jobs[upload_key]
 
     cgen, ccancel = st.columns([2, 1])
     if cgen.button("Genera e salva", type="primary", use_container_width=True):
         if not topic.strip():
             st.error("Inserisci un argomento.")
         else:
-            textbook_text = None
-            if textbook is not None:
+            textbook_info = None
+            if textbook_job is not None:
                 try:
-                    import fitz  # PyMuPDF
-                    doc = fitz.open(stream=textbook.read(), filetype="pdf")
-                    parts = [page.get_text() for page in doc]
-                    textbook_text = "\n".join(parts)[:20000]
+                    with st.spinner("Leggo il PDF..."):
+                        textbook_info = textbook_job.result()
                 except Exception as e:
+                    st.session_state["_ingest_jobs"].pop((textbook.name, textbook.size), None)
                     st.warning(f"Impossibile leggere il PDF: {e}")
 
             with st.spinner("Preparo il piano..."):
-                plan = generate_plan(topic, level, 30, "misto")
-                if textbook_text:
+                if textbook_info and textbook_info["text"].strip():
+                    plan = generate_plan_from_textbook(topic, level, textbook_info["text"], "misto",
+                                                       textbook_hash=textbook_info["hash"])
                     try:
                         if "steps" in plan and plan["steps"]:
                             plan["steps"][0].setdefault("suggested_resources", []).append("Textbook (uploaded)")
                     except Exception:
                         pass
+                else:
+                    plan = generate_plan(topic, level, 30, "misto")
+                if textbook_info:
+                    plan["textbook_hash"] = textbook_info["hash"]  # spiegazioni/esercizi/tutor recuperano dal libro
                 saved = save_plan(user["id"], topic, level, goals, plan)
+                if textbook_info:
+                    set_plan_textbook(saved["id"], textbook_info["hash"])
+                schedule_plan_content(saved["id"], plan, level, "misto")
                 st.session_state["selected_plan_id"] = saved["id"]
+                st.session_state["plans_cursor"] = [None]
             st.session_state["show_generator"] = False
             st.success("Piano salvato.")
             st.rerun()
@@ -626,13 +513,11 @@ if st.session_state.get("show_generator", False) and not read_only:
 # =========================================================
 # Mostra dettagli del piano selezionato
 # =========================================================
-plans = list_plans(st.session_state["user"]["id"]) if "user" in st.session_state else []
 current_plan = None
-if st.session_state.get("selected_plan_id"):
-    for _p in plans:
-        if _p["id"] == st.session_state["selected_plan_id"]:
-            current_plan = _p
-            break
+if st.session_state.get("selected_plan_id") and "user" in st.session_state:
+    _p = get_plan(st.session_state["selected_plan_id"])
+    if _p and _p["user_id"] == st.session_state["user"]["id"]:
+        current_plan = _p
 
 if not current_plan:
     st.info("Seleziona o crea un piano (a sinistra) per vedere i dettagli.")
@@ -655,6 +540,8 @@ if isinstance(plan_json, str):
         plan_json = json.loads(plan_json)
     except Exception:
         plan_json = {}
+if current_plan.get("textbook_hash"):  # piani salvati prima che l'hash entrasse nel plan_json
+    plan_json.setdefault("textbook_hash", current_plan["textbook_hash"])
 
 # Se il piano ha pochi step, espandilo automaticamente una sola volta
 st.session_state.setdefault("_expanded_plans", {})
@@ -663,10 +550,18 @@ if not read_only:
     minimal_steps = len((plan_json or {}).get("steps", []))
     if not _expanded and minimal_steps and minimal_steps < 7:
         with st.spinner("Espando il piano per maggior dettaglio..."):
-            new_plan = generate_plan(current_plan["topic"], current_plan.get("level","beginner"), 30, "misto")
+            new_plan = generate_plan(current_plan["topic"], current_plan.get("level","beginner"), 30, "misto", use_cache=False,
+                                     textbook_hash=plan_json.get("textbook_hash"))
+            if plan_json.get("textbook_hash"):
+                new_plan["textbook_hash"] = plan_json["textbook_hash"]
             if (new_plan or {}).get("steps") and len(new_plan["steps"]) > minimal_steps:
-                update_plan_json(current_plan["id"], new_plan)
+                cancel_plan(current_plan["id"])
+                update_plan_json(current_plan["id"], new_plan)  # rimappa la cache degli step invariati
                 plan_json = new_plan
+                st.session_state.get("ai_explain", {}).pop(current_plan["id"], None)
+                st.session_state.get("ai_exercises", {}).pop(current_plan["id"], None)
+                # dopo il remap mancano solo gli step nuovi o modificati: accoda solo quelli
+                schedule_plan_content(current_plan["id"], new_plan, current_plan.get("level","beginner"), "misto")
         st.session_state["_expanded_plans"][current_plan["id"]] = True
 
 st.caption(plan_json.get("overview", ""))
@@ -675,9 +570,10 @@ st.caption(plan_json.get("overview", ""))
 progress_map = get_progress_map(current_plan["id"])
 steps = plan_json.get("steps", [])
 
-total_steps = len(steps)
-done_count  = sum(1 for i in range(total_steps) if progress_map.get(i, "to-do") == "done")
-doing_count = sum(1 for i in range(total_steps) if progress_map.get(i, "to-do") == "doing")
+plan_counts_cur = get_plan_count(current_plan["id"])
+total_steps = plan_counts_cur["total"]
+done_count  = plan_counts_cur["done"]
+doing_count = plan_counts_cur["doing"]
 todo_count  = total_steps - done_count - doing_count
 completion  = (done_count / total_steps) if total_steps else 0.0
 
@@ -690,45 +586,61 @@ with c4:
     st.progress(completion, text=f"{int(completion*100)}%")
 
 # ---------------- TODAY panel (in base alle due_date) ----------------
-today_list, overdue_list = [], []
-for idx, s in enumerate(steps):
-    m = get_step_meta(current_plan["id"], idx)
-    d = m.get("due_date")
-    if not d:
-        continue
-    try:
-        dd = date.fromisoformat(d)
-        if dd == date.today():
-            today_list.append((idx, s))
-        elif dd < date.today():
-            overdue_list.append((idx, s))
-    except Exception:
-        pass
+# agenda dell'utente su tutti i suoi piani; chi guarda un link pubblico vede solo questo piano
+today_iso = date.today().isoformat()
+if "user" in st.session_state:
+    agenda = get_agenda(st.session_state["user"]["id"], today_iso)
+else:
+    agenda = get_agenda(current_plan["user_id"], today_iso, plan_id=current_plan["id"])
+today_list = [a for a in agenda if not a["overdue"]]
+overdue_list = [a for a in agenda if a["overdue"]]
+
+def agenda_line(a: dict) -> str:
+    where = "" if a["plan_id"] == current_plan["id"] else f" · {a['topic']}"
+    return f"- Step {a['step_idx']+1}: {a['title']}{where}"
 
 if today_list or overdue_list:
     st.write("### Oggi")
     if today_list:
         st.markdown("**Scadenza oggi**")
-        for (idx, s) in today_list:
-            st.markdown(f"- Step {idx+1}: {s.get('title','')}")
+        for a in today_list:
+            st.markdown(agenda_line(a))
     if overdue_list:
         st.markdown("**In ritardo**")
-        for (idx, s) in overdue_list:
-            st.markdown(f"- Step {idx+1}: {s.get('title','')}")
+        for a in overdue_list:
+            st.markdown(agenda_line(a))
     st.divider()
 
 # ---------------- Steps render ----------------
 EMOJI = {"to-do": "🔴", "doing": "🟡", "done": "🟢"}
 
-upload_dir = Path("static/uploads")
-upload_dir.mkdir(parents=True, exist_ok=True)
+# Navigatore: contenuto completo solo per lo step aperto, gli altri della pagina come intestazione
+STEP_PAGE_SIZE = int(os.getenv("STEP_PAGE_SIZE", "8"))
+st.session_state.setdefault("open_step", {})  # { plan_id: step_idx aperto }
+
+# Spiegazioni ed esercizi mancanti: generati in parallelo in background, una volta per piano/sessione
+st.session_state.setdefault("_pregen_plans", set())
+if current_plan["id"] not in st.session_state["_pregen_plans"]:
+    schedule_plan_content(current_plan["id"], plan_json, current_plan.get("level", "beginner"), "misto")
+    st.session_state["_pregen_plans"].add(current_plan["id"])
+
+# Quando un risultato arriva, riesegui la pagina per riempire il segnaposto
+_pending_at_start = pending_count(current_plan["id"])
+if _pending_at_start and hasattr(st, "fragment"):
+    @st.fragment(run_every=PREGEN_POLL_SECONDS)
+    def _pregen_watcher():
+        if pending_count(current_plan["id"]) < _pending_at_start:
+            st.rerun()
+    _pregen_watcher()
 
-for i, step in enumerate(steps):
+# Ogni step è un fragment: stato, quiz, note e pulsanti rieseguono solo il proprio step
+@fragment
+def render_step(i: int, step: dict):
     cur = progress_map.get(i, "to-do")
     badge = EMOJI.get(cur, "🔴")
     title = f"{badge} Passo {i+1}: {step.get('title','')}"
 
-    with st.expander(title, expanded=(i == 0)):
+    with st.expander(title, expanded=True):
         st.markdown("**Obiettivo**: " + step.get("objective", ""))
 
         if step.get("theory_outline"):
@@ -736,24 +648,50 @@ for i, step in enumerate(steps):
             for b in step["theory_outline"]:
                 st.markdown(f"- {b}")
 
-        # Spiegazione dettagliata (AI) – generazione automatica e cache per piano/passo
+        # Spiegazione dettagliata (AI) – pre-generata in background, cache per piano/passo
         st.session_state.setdefault("ai_explain", {})
         plan_expl = st.session_state["ai_explain"].setdefault(current_plan["id"], {})
+        streamed = False
         if i not in plan_expl:
             cached = get_ai_cache(current_plan["id"], i, "explain_md")
-            if cached is None:
-                with st.spinner("Creo spiegazione dettagliata..."):
-                    md = explain_step_ai(
-                        plan_json,
-                        i,
-                        current_plan.get("level","beginner"),
-                        "misto"
-                    )
-                set_ai_cache(current_plan["id"], i, "explain_md", md)
-                plan_expl[i] = md
-            else:
+            if cached is not None:
                 plan_expl[i] = cached
-        st.markdown(plan_expl[i])
+            elif claim(current_plan["id"], i, "explain_md"):
+                # step aperto: stream diretto (conta il primo token, non la generazione intera)
+                args = (plan_json, i, current_plan.get("level","beginner"), "misto")
+                # resta un errore finché la spiegazione non è in cache: anche se lo stream viene interrotto
+                # da StopException/RerunException di Streamlit (BaseException, non Exception)
+                error = RuntimeError("spiegazione interrotta prima del salvataggio")
+                try:
+                    if hasattr(st, "write_stream"):
+                        md = st.write_stream(explain_step_ai_stream(*args, fallback=False))
+                    else:
+                        with st.spinner("Creo spiegazione dettagliata..."):
+                            md = explain_step_ai(*args, fallback=False)
+                        st.markdown(md)
+                    md = (md or "").strip()
+                    set_ai_cache(current_plan["id"], i, "explain_md", md)
+                    error = None
+                    plan_expl[i] = md
+                except LLMUnavailable as e:
+                    # la versione demo si mostra ma non si salva: al prossimo giro si riprova
+                    error = e
+                    st.warning(f"Spiegazione dettagliata non disponibile ({e}), mostro la versione base")
+                    st.markdown(demo_explanation(plan_json, i))
+                except Exception as e:
+                    # ogni altro errore (DB, rete) arriva a chi aspetta con il suo messaggio
+                    error = e
+                    raise
+                finally:
+                    # sblocca le altre sessioni in attesa dello stesso contenuto
+                    release(current_plan["id"], i, "explain_md", error)
+                streamed = True
+        if streamed:
+            pass  # già mostrata durante lo streaming
+        elif i in plan_expl:
+            st.markdown(plan_expl[i])
+        elif ai_placeholder(current_plan, plan_json, i, "explain_md", "Spiegazione dettagliata"):
+            st.markdown(demo_explanation(plan_json, i))
         if step.get("practice_tasks"):
             st.markdown("**Pratica**")
             for t in step["practice_tasks"]:
@@ -798,12 +736,14 @@ for i, step in enumerate(steps):
         if not read_only:
             uploads = st.file_uploader("Allega immagini", type=["png","jpg","jpeg"], accept_multiple_files=True, key=f"up_{i}")
             if uploads:
+                # il file_uploader ripresenta gli stessi file a ogni rerun: ognuno va in archivio una volta
+                stored = st.session_state.setdefault("_stored_uploads", {})
                 for up in uploads:
-                    pth = upload_dir / f"{current_plan['id']}_{i}_{up.name}"
+                    up_key = getattr(up, "file_id", None) or (up.name, up.size)
                     try:
-                        with open(pth, "wb") as f:
-                            f.write(up.read())
-                        saved_files.append(str(pth))
+                        if up_key not in stored:
+                            stored[up_key] = store_upload(up)
+                        saved_files.append(stored[up_key])
                     except Exception as e:
                         st.warning(f"Caricamento fallito: {e}")
                 saved_files = list(dict.fromkeys(saved_files))
@@ -811,37 +751,44 @@ for i, step in enumerate(steps):
         if saved_files:
             st.caption("Allegati")
             gcols = st.columns(min(4, len(saved_files)))
+            thumb_size = "small" if len(gcols) > 1 else "large"
+            waiting = []
             for idx, fp in enumerate(saved_files):
                 with gcols[idx % len(gcols)]:
                     try:
-                        st.image(fp, use_container_width=True)
+                        thumb = thumbnail(fp, thumb_size)
+                        if thumb:
+                            st.image(thumb, use_container_width=True)
+                        else:
+                            st.caption(f"{Path(fp).name}: anteprima in preparazione")
+                            waiting.append(fp)
                     except Exception:
-                        st.text(Path(fp).name)
+                        try:  # miniatura non disponibile (es. Pillow assente): originale
+                            st.image(fp, use_container_width=True)
+                        except Exception:
+                            st.text(Path(fp).name)
+            # Quando una miniatura in attesa è pronta, riesegui per mostrarla al posto del segnaposto
+            if waiting and hasattr(st, "fragment"):
+                @st.fragment(run_every=PREGEN_POLL_SECONDS)
+                def _thumb_watcher():
+                    if not all(thumbnail_pending(fp, thumb_size) for fp in waiting):
+                        st.rerun()
+                _thumb_watcher()
 
-        # Esercizi (AI) – generazione automatica e rendering inline
+        # Esercizi (AI) – pre-generati in background e rendering inline
         st.session_state.setdefault("ai_exercises", {})
         plan_ex = st.session_state["ai_exercises"].setdefault(current_plan["id"], {})
+        data = plan_ex.get(i)
         if i not in plan_ex:
             cached = get_ai_cache(current_plan["id"], i, "exercises_json")
-            if cached is None:
-                with st.spinner("Creo esercizi con AI..."):
-                    data = generate_exercises_ai(
-                        plan_json,
-                        i,
-                        current_plan.get("level","beginner"),
-                        "misto"
-                    )
-                plan_ex[i] = data
-                try:
-                    set_ai_cache(current_plan["id"], i, "exercises_json", json.dumps(data, ensure_ascii=False))
-                except Exception:
-                    pass
-            else:
+            if cached is not None:
                 try:
                     plan_ex[i] = json.loads(cached)
                 except Exception:
                     plan_ex[i] = {}
-        data = plan_ex.get(i)
+                data = plan_ex[i]
+            elif ai_placeholder(current_plan, plan_json, i, "exercises_json", "Esercizi"):
+                data = demo_exercises(plan_json, i)
         if data:
             st.markdown(f"**{data['guided']['title']}**")
             for sidx, stext in enumerate(data['guided']['steps'], start=1):
@@ -866,13 +813,66 @@ for i, step in enumerate(steps):
         if not read_only:
             if st.button("Salva passo", key=f"sv_{i}"):
                 set_progress(current_plan["id"], i, status)
-                set_step_meta(current_plan["id"], i, {
+                set_step_meta(current_plan["id"], {i: {
                     "due_date": due.isoformat() if isinstance(due, date) else None,
                     "notes": st.session_state.get(f"note_{i}", meta.get("notes","")),
                     "attachments": saved_files
-                })
+                }})
                 st.success("Salvato")
-                st.rerun()
+                st.rerun()  # stato e scadenze cambiano riepilogo, pannello Oggi e sidebar: rerun completo
+
+def render_step_header(i: int, step: dict):
+    """Riga compatta per uno step chiuso: nessuna lettura di cache né widget pesanti."""
+    cur = progress_map.get(i, "to-do")
+    c_title, c_open = st.columns([8, 1])
+    c_title.markdown(f"{EMOJI.get(cur, '🔴')} **Passo {i+1}:** {step.get('title','')}")
+    if step.get("objective"):
+        c_title.caption(step["objective"])
+    if c_open.button("Apri", key=f"open_{i}", use_container_width=True):
+        st.session_state["open_step"][current_plan["id"]] = i
+        rerun_fragment()
+
+@fragment
+def step_navigator():
+    if not steps:
+        return
+    open_idx = min(st.session_state["open_step"].get(current_plan["id"], 0), len(steps) - 1)
+    page = open_idx // STEP_PAGE_SIZE
+    first, last = page * STEP_PAGE_SIZE, min(len(steps), (page + 1) * STEP_PAGE_SIZE)
+
+    labels = [f"{EMOJI.get(progress_map.get(i, 'to-do'), '🔴')} Passo {i+1}: {s.get('title','')}" for i, s in enumerate(steps)]
+    c_prev, c_pick, c_next = st.columns([1, 6, 1])
+    picked = c_pick.selectbox("Vai al passo", range(len(steps)), index=open_idx,
+                              format_func=lambda i: labels[i], key=f"step_nav_{current_plan['id']}_{open_idx}",
+                              label_visibility="collapsed")
+    target = picked
+    if c_prev.button("◀", key="steps_prev", disabled=page == 0, use_container_width=True):
+        target = first - STEP_PAGE_SIZE
+    if c_next.button("▶", key="steps_next", disabled=last >= len(steps), use_container_width=True):
+        target = last
+    if target != open_idx:
+        st.session_state["open_step"][current_plan["id"]] = target
+        rerun_fragment()
+
+    st.caption(f"Passi {first+1}–{last} di {len(steps)}")
+    for i in range(first, last):
+        if i == open_idx:
+            render_step(i, steps[i])
+        else:
+            render_step_header(i, steps[i])
+
+step_navigator()
+
+# ---------------- Concept map ----------------
+@fragment
+def concept_map_panel():
+    # resa solo su richiesta; lo step aperto è evidenziato
+    if st.checkbox("🗺️ Mostra la mappa concettuale", key=f"show_map_{current_plan['id']}"):
+        open_idx = min(st.session_state["open_step"].get(current_plan["id"], 0), len(steps) - 1)
+        show_concept_map(plan_json, open_idx)
+
+if steps:
+    concept_map_panel()
 
 # ---------------- Review strategy ----------------
 if plan_json.get("review_strategy"):
@@ -881,13 +881,36 @@ if plan_json.get("review_strategy"):
         st.markdown(f"- {b}")
 
 # ---------------- Tutor chat ----------------
-st.write("### Chiedi a Synapse (Tutor)")
-q = st.text_input("La tua domanda su questo piano")
-if st.button("Chiedi"):
-    if not q.strip():
-        st.error("Scrivi una domanda.")
+@fragment
+def tutor_box():
+    st.write("### Chiedi a Synapse (Tutor)")
+    # conversazione per piano e utente; chi guarda un link pubblico senza login ne ha una per sessione
+    if "user" in st.session_state:
+        tutor_uid = st.session_state["user"]["id"]
     else:
-        with st.spinner("Elaboro..."):
-            answer = tutor_answer(plan_json, q)
-        st.info(q)
-        st.success(answer)
+        tutor_uid = st.session_state.setdefault("anon_tutor_id", -random.randint(1, 2**31))
+    history = list_tutor_turns(current_plan["id"], tutor_uid)
+    if history:
+        for turn in history:
+            st.markdown(f"**Tu:** {turn['question']}")
+            st.markdown(turn["answer"])
+        if st.button("Nuova conversazione"):
+            clear_tutor_session(current_plan["id"], tutor_uid)
+            rerun_fragment()
+    q = st.text_input("La tua domanda su questo piano")
+    if st.button("Chiedi"):
+        if not q.strip():
+            st.error("Scrivi una domanda.")
+        else:
+            st.info(q)
+            if hasattr(st, "write_stream"):
+                try:
+                    st.write_stream(tutor_answer_stream(plan_json, q, plan_id=current_plan["id"], user_id=tutor_uid))
+                except LLMUnavailable as e:
+                    st.warning(f"Risposta interrotta ({e}). Riprova tra poco.")
+            else:
+                with st.spinner("Elaboro..."):
+                    answer = tutor_answer(plan_json, q, plan_id=current_plan["id"], user_id=tutor_uid)
+                st.success(answer)
+
+tutor_box()
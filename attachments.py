@@ -0,0 +1,144 @@
+# attachments.py
+"""Allegati degli step: archivio indirizzato per contenuto e miniature in cache.
+
+Un file caricato viene letto a blocchi al massimo due volte: una per l'hash SHA-256 e, solo se
+l'oggetto non è già in archivio, una per scriverlo (file temporaneo + rename atomico).
+Le miniature (THUMB_SIZES) sono generate una volta sola in un pool di processi e poi servite dal disco,
+così la galleria non spedisce al browser gli originali a piena risoluzione.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import Future, ProcessPoolExecutor
+
+ATTACH_DIR = Path(os.getenv("ATTACH_DIR", "static/uploads"))
+OBJECTS_DIR = ATTACH_DIR / "objects"
+THUMBS_DIR = ATTACH_DIR / "thumbs"
+THUMB_SIZES = {"small": 320, "large": 960}  # lato lungo in px
+THUMB_QUALITY = 82
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+_CHUNK = 1 << 20  # 1 MiB
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_pending: dict[str, Future] = {}  # percorso miniatura -> generazione in corso (o fallita)
+_pending_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: il processo di Streamlit ha molti thread, fork non è sicuro
+            _pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _chunks(upload):
+    upload.seek(0)
+    while True:
+        block = upload.read(_CHUNK)
+        if not block:
+            return
+        yield block
+
+
+def store_upload(upload) -> str:
+    """Salva il file caricato nell'archivio e ne ritorna il percorso (stesso contenuto, stesso percorso).
+
+    Avvia subito anche le miniature, così sono pronte quando la galleria le chiede.
+    """
+    h = hashlib.sha256()
+    for block in _chunks(upload):
+        h.update(block)
+    digest = h.hexdigest()
+    dest = OBJECTS_DIR / digest[:2] / f"{digest}{Path(upload.name).suffix.lower()}"
+    if not dest.exists():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dest.parent, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in _chunks(upload):
+                    f.write(block)
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+    for size in THUMB_SIZES:
+        _schedule(str(dest), size)
+    return str(dest)
+
+
+def make_thumbnail(src: str, dest: str, max_side: int) -> str:
+    """Gira nel processo di lavoro: JPEG con lato lungo <= max_side, trasparenze su fondo bianco."""
+    from PIL import Image, ImageOps
+    with Image.open(src) as img:
+        img.draft("RGB", (max_side, max_side))  # JPEG: decodifica direttamente a scala ridotta
+        thumb = ImageOps.exif_transpose(img)
+        thumb.thumbnail((max_side, max_side))
+        if thumb.mode != "RGB":
+            rgba = thumb.convert("RGBA")
+            thumb = Image.new("RGB", rgba.size, (255, 255, 255))
+            thumb.paste(rgba, mask=rgba.split()[-1])
+        tmp = f"{dest}.{os.getpid()}.part"
+        thumb.save(tmp, "JPEG", quality=THUMB_QUALITY, optimize=True)
+    os.replace(tmp, dest)
+    return dest
+
+
+def _thumb_path(src: str, size: str) -> Path:
+    # oggetti in archivio: il nome è già l'hash; allegati precedenti all'archivio: hash del percorso
+    path = Path(src)
+    stem = path.stem if path.parent.parent == OBJECTS_DIR else hashlib.sha256(src.encode("utf-8")).hexdigest()
+    return THUMBS_DIR / size / f"{stem}.jpg"
+
+
+def _schedule(src: str, size: str) -> Future | None:
+    """Accoda la miniatura se manca; None se è già su disco. Una generazione fallita non viene ritentata."""
+    dest = _thumb_path(src, size)
+    key = str(dest)
+    with _pending_lock:
+        fut = _pending.get(key)
+        if fut is not None:
+            return fut
+        if dest.exists():
+            return None
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            fut = _get_pool().submit(make_thumbnail, src, key, THUMB_SIZES[size])
+        except Exception as e:  # pool non disponibile (es. processo in chiusura)
+            fut = Future()
+            fut.set_exception(e)
+        _pending[key] = fut
+    fut.add_done_callback(lambda f: f.exception() is None and _pending.pop(key, None))
+    return fut
+
+
+def thumbnail(src: str, size: str = "small") -> str | None:
+    """Percorso della miniatura di `src`; None (senza attendere) se è ancora in generazione.
+
+    Se la miniatura non si può generare (Pillow assente, file illeggibile) solleva l'errore del
+    processo di lavoro: il chiamante ripiega sull'originale.
+    """
+    dest = _thumb_path(src, size)
+    if dest.exists():
+        return str(dest)
+    fut = _schedule(src, size)
+    if fut is None:
+        return str(dest)
+    if not fut.done():
+        return None
+    return fut.result()
+
+
+def thumbnail_pending(src: str, size: str = "small") -> bool:
+    """True finché la generazione della miniatura è in corso (per sapere quando ridisegnare)."""
+    with _pending_lock:
+        fut = _pending.get(str(_thumb_path(src, size)))
+    return fut is not None and not fut.done()
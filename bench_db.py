@@ -0,0 +1,330 @@
+# bench_db.py
+"""Micro-benchmark di db.py su un database sintetico con la forma di app.db.
+
+Popola (una volta, poi riusa) un database con migliaia di utenti, centinaia di migliaia di piani e
+milioni di righe in progresses e ai_cache, poi misura le funzioni di db.py a freddo e a caldo.
+Il database popolato (seed.db) resta intatto: ogni ripetizione lavora su una copia appena fatta,
+così le misure che scrivono non cambiano i dati delle esecuzioni successive.
+- cold: ogni chiamata apre una connessione nuova (cache di pagine SQLite vuota) su chiavi mai lette;
+- warm: pool di connessioni già aperto e un piccolo insieme di chiavi lette di continuo.
+La cache del sistema operativo non viene svuotata: i numeri a freddo sono un limite inferiore.
+
+Il risultato (p50/p99 in ms e operazioni al secondo, mediane su --repeat ripetizioni) è un JSON
+confrontabile tra commit:
+
+    python bench_db.py --scale full --out bench.json
+    python bench_db.py --scale full --baseline bench.json --max-regression 0.25
+
+Con --baseline l'uscita è 1 se il p50 o il p99 di una misura peggiora oltre la soglia relativa e
+anche oltre una soglia assoluta di rumore per fase (--noise-floor-ms a caldo, --cold-noise-floor-ms
+a freddo): le differenze di pochi microsecondi non contano.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import shutil
+import hashlib
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from statistics import median
+
+SCALES = {
+    # utenti, piani, righe progresses, righe ai_cache
+    "small": {"users": 500, "plans": 10_000, "progresses": 100_000, "ai_cache": 50_000},
+    "full": {"users": 5_000, "plans": 200_000, "progresses": 2_000_000, "ai_cache": 2_000_000},
+}
+BLOB_POOL = 20_000   # contenuti distinti in ai_blobs (ai_cache li condivide, come in produzione)
+SEED_BATCH = 50_000  # righe per transazione durante il popolamento
+WARM_KEYS = 32
+KINDS = ("explain_md", "exercises_json")
+STATUSES = ("to-do", "doing", "done")
+WORDS = ("energia", "entropia", "sistema", "calore", "lavoro", "principio", "esempio", "definizione",
+         "equazione", "modello", "verifica", "esercizio", "concetto", "processo", "stato", "misura")
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _plan_json(rng: random.Random, steps: int) -> str:
+    return json.dumps({
+        "overview": _text(rng, 20),
+        "steps": [{"title": _text(rng, 4), "objective": _text(rng, 10),
+                   "theory_outline": [_text(rng, 5) for _ in range(3)]} for _ in range(steps)],
+    })
+
+
+def seed(db, params: dict, rng: random.Random):
+    """Popola le tabelle con INSERT in blocco su una connessione dedicata (trigger dei contatori
+    disattivati durante il caricamento, contatori ricalcolati una volta alla fine)."""
+    n_users, n_plans = params["users"], params["plans"]
+    per_plan = max(1, -(-params["progresses"] // n_plans))
+    ai_per_plan = max(1, -(-params["ai_cache"] // n_plans))
+    steps = max(8, per_plan, -(-ai_per_plan // len(KINDS)))
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute("PRAGMA synchronous=OFF")
+    triggers = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name='progresses'")]
+    for name in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+
+    def bulk(sql, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= SEED_BATCH:
+                with conn:
+                    conn.executemany(sql, batch)
+                batch.clear()
+        if batch:
+            with conn:
+                conn.executemany(sql, batch)
+
+    bulk("INSERT INTO users(id, email) VALUES(?, ?)", ((u, f"user{u}@bench.local") for u in range(1, n_users + 1)))
+    # pochi plan_json distinti riusati: il peso della riga è realistico senza generarne 200k
+    templates = [_plan_json(rng, steps) for _ in range(64)]
+    bulk(
+        "INSERT INTO plans(id, user_id, topic, level, goals, plan_json, step_count) VALUES(?, ?, ?, ?, '', ?, ?)",
+        ((p, rng.randint(1, n_users), _text(rng, 3), rng.choice(("beginner", "intermediate", "advanced")),
+          rng.choice(templates), steps) for p in range(1, n_plans + 1))
+    )
+
+    def progress_rows():
+        left = params["progresses"]
+        for p in range(1, n_plans + 1):
+            for s in range(min(per_plan, left)):
+                yield p, s, rng.choice(STATUSES)
+            left -= per_plan
+            if left <= 0:
+                return
+    bulk("INSERT INTO progresses(plan_id, step_idx, status) VALUES(?, ?, ?)", progress_rows())
+
+    blobs = [f"### {_text(rng, 4)}\n\n{_text(rng, 300)}" for _ in range(min(BLOB_POOL, params["ai_cache"]))]
+    hashes = []
+    with conn:
+        for content in blobs:
+            h = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            data = db._pack(content)
+            conn.execute("INSERT OR IGNORE INTO ai_blobs(hash, data, size) VALUES(?, ?, ?)", (h, data, len(data)))
+            hashes.append(h)
+    now = time.time()
+
+    def ai_rows():
+        left = params["ai_cache"]
+        for p in range(1, n_plans + 1):
+            for j in range(min(ai_per_plan, left)):
+                yield p, j // len(KINDS), KINDS[j % len(KINDS)], rng.choice(hashes), now - rng.uniform(0, 30 * 86400)
+            left -= ai_per_plan
+            if left <= 0:
+                return
+    bulk("INSERT INTO ai_cache(plan_id, step_idx, kind, content, blob_hash, last_access) VALUES(?, ?, ?, '', ?, ?)",
+         ai_rows())
+
+    with conn:
+        conn.execute(db._REFRESH_COUNTS_SQL.format(plan_id="plans.id"))
+    conn.execute("ANALYZE")
+    conn.close()
+    db._init_db()  # ricrea i trigger
+    return blobs
+
+
+def _reset_pool(db):
+    """Chiude le connessioni in pool: la prossima chiamata ne apre una nuova (a freddo)."""
+    while True:
+        try:
+            db._pool.get_nowait().close()
+        except db.queue.Empty:
+            return
+
+
+def _stats(samples: list[float], elapsed: float) -> dict:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"n": len(ordered), "p50_ms": round(pick(0.50), 4), "p99_ms": round(pick(0.99), 4),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4), "ops_per_s": round(len(ordered) / elapsed, 1)}
+
+
+def measure(db, call, cold_args: list, warm_args: list) -> dict:
+    out = {}
+    samples, elapsed = [], 0.0
+    for args in cold_args:
+        _reset_pool(db)
+        t = time.perf_counter()
+        call(*args)
+        samples.append(time.perf_counter() - t)
+        elapsed += samples[-1]
+    out["cold"] = _stats(samples, elapsed)
+    for args in warm_args[:WARM_KEYS]:  # riscaldamento: pool aperto e pagine in cache
+        call(*args)
+    samples = []
+    start = time.perf_counter()
+    for args in warm_args:
+        t = time.perf_counter()
+        call(*args)
+        samples.append(time.perf_counter() - t)
+    out["warm"] = _stats(samples, time.perf_counter() - start)
+    return out
+
+
+def _restore(db, bench_dir: Path):
+    """Riparte da una copia intatta del database popolato (connessioni in pool chiuse prima)."""
+    _reset_pool(db)
+    for suffix in ("-wal", "-shm"):
+        (bench_dir / f"app.db{suffix}").unlink(missing_ok=True)
+    shutil.copyfile(bench_dir / "seed.db", bench_dir / "app.db")
+
+
+def suites(db, params: dict, blobs: list[str], n: int, rng: random.Random) -> dict:
+    """{nome: (funzione, argomenti cold, argomenti warm)}: chiavi estratte una volta, uguali in ogni ripetizione."""
+    with db._db() as conn:
+        max_ai = conn.execute("SELECT MAX(rowid) FROM ai_cache").fetchone()[0]
+        ai_keys = [conn.execute("SELECT plan_id, step_idx, kind FROM ai_cache WHERE rowid=?", (rng.randint(1, max_ai),)).fetchone()
+                   for _ in range(2 * n)]
+        max_prog = conn.execute("SELECT MAX(id) FROM progresses").fetchone()[0]
+        prog_keys = [conn.execute("SELECT plan_id, step_idx FROM progresses WHERE id=?", (rng.randint(1, max_prog),)).fetchone()
+                     for _ in range(2 * n)]
+    ai_keys = [k for k in ai_keys if k]
+    prog_keys = [k for k in prog_keys if k]
+
+    def keysets(make):
+        cold = [make() for _ in range(n)]
+        hot = [make() for _ in range(WARM_KEYS)]
+        return cold, [rng.choice(hot) for _ in range(n)]
+
+    users = lambda: (rng.randint(1, params["users"]),)
+    plans = lambda: (rng.randint(1, params["plans"]),)
+    return {
+        "upsert_user": (db.upsert_user, *keysets(lambda: (f"user{users()[0]}@bench.local",))),
+        "list_plans": (db.list_plans, *keysets(users)),
+        "get_progress_map": (db.get_progress_map, *keysets(plans)),
+        "set_progress": (db.set_progress, *keysets(lambda: (*rng.choice(prog_keys), rng.choice(STATUSES)))),
+        "get_ai_cache": (db.get_ai_cache, *keysets(lambda: rng.choice(ai_keys))),
+        "set_ai_cache": (db.set_ai_cache, *keysets(lambda: (*rng.choice(ai_keys), rng.choice(blobs)))),
+    }
+
+
+def run(db, bench_dir: Path, cases: dict, repeat: int) -> dict:
+    """Ripete tutte le misure `repeat` volte, ognuna su una copia fresca; ritorna le mediane."""
+    runs = {name: {"cold": [], "warm": []} for name in cases}
+    for rep in range(repeat):
+        _restore(db, bench_dir)
+        for name, (call, cold, warm) in cases.items():
+            for phase, stats in measure(db, call, cold, warm).items():
+                runs[name][phase].append(stats)
+        print(f"ripetizione {rep + 1}/{repeat} completata", file=sys.stderr)
+    results = {}
+    for name, phases in runs.items():
+        results[name] = {
+            phase: {k: (stats[0][k] if k == "n" else round(median(s[k] for s in stats), 4)) for k in stats[0]}
+            for phase, stats in phases.items()
+        }
+        r = results[name]
+        print(f"{name:18s} cold p50 {r['cold']['p50_ms']:8.3f} ms  p99 {r['cold']['p99_ms']:8.3f} ms"
+              f"  | warm p50 {r['warm']['p50_ms']:8.3f} ms  p99 {r['warm']['p99_ms']:8.3f} ms"
+              f"  {r['warm']['ops_per_s']:10.1f} op/s", file=sys.stderr)
+    return results
+
+
+def compare(results: dict, baseline: dict, max_regression: float, noise_floor_ms: dict) -> list[str]:
+    """Misure peggiorate rispetto al baseline oltre la soglia relativa e oltre il rumore assoluto della
+    fase (noise_floor_ms = {"cold": ms, "warm": ms}): ["get_ai_cache warm p99 +40%", ...]."""
+    worse = []
+    for name, phases in results.items():
+        for phase, stats in phases.items():
+            old = baseline.get("results", {}).get(name, {}).get(phase)
+            if not old:
+                continue
+            for metric in ("p50_ms", "p99_ms"):
+                if (old[metric] > 0 and stats[metric] > old[metric] * (1 + max_regression)
+                        and stats[metric] - old[metric] > noise_floor_ms[phase]):
+                    worse.append(f"{name} {phase} {metric[:3]} {stats[metric] / old[metric] - 1:+.0%}")
+    return worse
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--scale", choices=SCALES, default="small")
+    ap.add_argument("--dir", default=".cache/bench", help="cartella del database sintetico (riusato tra le esecuzioni)")
+    ap.add_argument("--samples", type=int, default=1000, help="chiamate per misura e fase")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--reseed", action="store_true", help="ricrea il database anche se esiste")
+    ap.add_argument("--out", help="file JSON dei risultati (default: stdout)")
+    ap.add_argument("--baseline", help="JSON di un'esecuzione precedente da confrontare")
+    ap.add_argument("--repeat", type=int, default=5, help="ripetizioni (si riportano le mediane)")
+    ap.add_argument("--max-regression", type=float, default=0.25)
+    # peggioramento assoluto minimo perché una misura conti come regressione: a freddo il rumore
+    # (apertura connessione, I/O) è di ordini di grandezza più alto che a caldo
+    ap.add_argument("--noise-floor-ms", type=float, default=0.05, help="soglia di rumore a caldo (ms)")
+    ap.add_argument("--cold-noise-floor-ms", type=float, default=1.0, help="soglia di rumore a freddo (ms)")
+    args = ap.parse_args()
+
+    params = SCALES[args.scale]
+    out = Path(args.out).resolve() if args.out else None  # prima del chdir
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+    bench_dir = Path(args.dir).resolve()
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    marker = bench_dir / "seed.json"
+    spec = {**params, "seed": args.seed}
+    fresh = (args.reseed or not marker.exists() or not (bench_dir / "seed.db").exists()
+             or json.loads(marker.read_text()).get("spec") != spec)
+    for suffix in ("", "-wal", "-shm"):
+        (bench_dir / f"app.db{suffix}").unlink(missing_ok=True)
+    if fresh:
+        (bench_dir / "seed.db").unlink(missing_ok=True)
+        marker.unlink(missing_ok=True)
+    else:
+        shutil.copyfile(bench_dir / "seed.db", bench_dir / "app.db")
+    os.chdir(bench_dir)  # db.DB_PATH è relativo: db.py apre (e crea) bench_dir/app.db all'import
+    import db
+
+    rng = random.Random(args.seed)
+    seed_s = None
+    if fresh:
+        t = time.perf_counter()
+        blobs = seed(db, params, rng)
+        seed_s = round(time.perf_counter() - t, 1)
+        _reset_pool(db)
+        conn = sqlite3.connect(db.DB_PATH)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        shutil.copyfile(bench_dir / "app.db", bench_dir / "seed.db")
+        marker.write_text(json.dumps({"spec": spec, "seed_s": seed_s}))
+    else:
+        with db._db() as conn:
+            blobs = [db._unpack(r[0], None) for r in conn.execute("SELECT data FROM ai_blobs LIMIT ?", (BLOB_POOL,))]
+    report = {
+        "meta": {
+            "commit": _commit(), "scale": args.scale, "params": params, "samples": args.samples,
+            "repeat": args.repeat, "seeded_in_s": seed_s,
+            "db_mb": round((bench_dir / "seed.db").stat().st_size / 2**20, 1),
+            "sqlite": sqlite3.sqlite_version, "python": platform.python_version(), "platform": platform.platform(),
+        },
+        "results": run(db, bench_dir, suites(db, params, blobs, args.samples, rng), args.repeat),
+    }
+    text = json.dumps(report, indent=2)
+    if out:
+        out.write_text(text)
+    else:
+        print(text)
+    if baseline:
+        worse = compare(report["results"], json.loads(baseline.read_text()), args.max_regression,
+                        {"cold": args.cold_noise_floor_ms, "warm": args.noise_floor_ms})
+        for line in worse:
+            print(f"REGRESSIONE: {line}", file=sys.stderr)
+        sys.exit(1 if worse else 0)
+
+
+if __name__ == "__main__":
+    main()
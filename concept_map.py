@@ -0,0 +1,517 @@
+# concept_map.py
+"""Motore unico delle mappe concettuali: grafo → layout → scena → SVG/PNG, con cache.
+
+Il grafo (plan_graph) ha un nodo per step e archi arbitrari; un layout (linear, grid, radial,
+tiered, layered) lo trasforma in una scena (nodi e archi con coordinate) e i renderer SVG e PNG
+disegnano qualsiasi scena, con testo a capo dentro i nodi. Il layout "layered" scala a centinaia
+di nodi; l'SVG può essere ritagliato su un viewport (tile) per mappe grandi. I byte codificati
+sono in cache per (hash del grafo, layout, step evidenziato, dimensione, formato, viewport):
+in memoria (LRU) e su disco (LRU per mtime, entro MAP_DISK_CACHE_MB), così una mappa già vista non
+richiede un nuovo raster.
+"""
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+
+# Incrementa quando cambia la geometria o lo stile: invalida la cache su disco
+ENGINE_VERSION = 2
+MAP_CACHE_DIR = Path(os.getenv("MAP_CACHE_DIR", ".cache/maps"))
+MAP_CACHE_ITEMS = int(os.getenv("MAP_CACHE_ITEMS", "128"))
+MAP_DISK_CACHE_MB = float(os.getenv("MAP_DISK_CACHE_MB", "256"))  # oltre, via i file usati meno di recente
+MAP_TILE_SIZE = int(os.getenv("MAP_TILE_SIZE", "1024"))
+LAYERED_SWEEPS = 4        # passate di riduzione degli incroci (baricentro, giù e su)
+LAYERED_ROW_MAX = 8       # nodi per riga: uno strato più largo va a capo su più righe
+LAYERED_ASPECT = 1.5      # rapporto larghezza/altezza cercato quando si piegano le catene lunghe
+RELATED_LINKS_MAX = 2     # archi "correlati" in ingresso per step (oltre alla sequenza)
+CHAR_W, LINE_H = 7, 16    # metrica approssimata del font a 14px per l'a capo
+
+THEMES = {
+    "dark": {"bg": (24, 24, 32), "box": (31, 31, 40), "border": (107, 107, 122),
+             "edge": (138, 138, 165), "text": (230, 230, 240), "head": (123, 97, 255)},
+    "book": {"bg": (255, 255, 255), "box": (255, 247, 235), "border": (210, 150, 90),
+             "edge": (210, 150, 90), "text": (40, 40, 40), "head": (236, 170, 70)},
+}
+
+
+# ========================= GRAFO =========================
+_WORD_RE = re.compile(r"[^\W\d_]{5,}")
+_STOPWORDS = {"della", "delle", "dello", "degli", "nella", "nelle", "sulla", "sulle", "questo", "questa",
+              "introduzione", "concetti", "principi", "esercizi", "esempi", "sintesi", "ripasso", "parte"}
+
+def plan_graph(plan_json: dict, step_idx: int | None = None) -> dict:
+    """Grafo di un piano: sequenza degli step più archi tra step non consecutivi che condividono
+    termini (titolo e outline). Un indice invertito dei termini lo rende lineare nel testo."""
+    steps = (plan_json or {}).get("steps", [])
+    nodes = [{"id": f"s{i}", "label": s.get("title", "")} for i, s in enumerate(steps)]
+    edges = [{"from": f"s{i}", "to": f"s{i+1}"} for i in range(max(0, len(steps) - 1))]
+    last_seen: dict[str, int] = {}
+    for i, s in enumerate(steps):
+        text = " ".join([s.get("title", "")] + [str(x) for x in s.get("theory_outline") or []]).lower()
+        terms = {t for t in _WORD_RE.findall(text) if t not in _STOPWORDS}
+        linked = set()
+        for t in sorted(terms):
+            j = last_seen.get(t)
+            if j is not None and j < i - 1 and j not in linked and len(linked) < RELATED_LINKS_MAX:
+                linked.add(j)
+                edges.append({"from": f"s{j}", "to": f"s{i}", "kind": "related"})
+            last_seen[t] = i
+    if step_idx is not None and 0 <= step_idx < len(nodes):
+        nodes[step_idx]["label"] = "⭐ " + nodes[step_idx]["label"]
+        nodes[step_idx]["hl"] = True
+    return {"nodes": nodes, "edges": edges}
+
+
+# ========================= LAYOUT =========================
+# Ogni layout riceve il grafo e ritorna una scena:
+# {"width", "height", "theme", "header", "nodes": [{x, y, w, h, label, hl}],
+#  "edges": [(x1, y1, x2, y2, arrow, dashed)]}
+# linear/grid/radial/tiered seguono l'ordine degli step; layered usa anche gli archi arbitrari.
+
+def _node(x, y, w, h, label, hl=False) -> dict:
+    return {"x": x, "y": y, "w": w, "h": h, "label": label, "hl": hl}
+
+def _seq_edges(nodes: list[dict]) -> list[tuple]:
+    return [(a["x"] + a["w"], a["y"] + a["h"] / 2, b["x"], b["y"] + b["h"] / 2, True, False)
+            for a, b in zip(nodes, nodes[1:])]
+
+def layout_linear(graph, size=None, header=None) -> dict:
+    """Una riga orizzontale di nodi collegati in sequenza (per mappe piccole)."""
+    padding, node_w, node_h, gap = 20, 220, 48, 40
+    nodes = [_node(padding + i * (node_w + gap), padding, node_w, node_h, n["label"], n.get("hl", False))
+             for i, n in enumerate(graph["nodes"])]
+    width = padding * 2 + max(1, len(nodes)) * (node_w + gap) - gap
+    return {"width": width, "height": padding * 2 + node_h, "theme": "dark", "header": None,
+            "nodes": nodes, "edges": _seq_edges(nodes)}
+
+def layout_grid(graph, size=None, header=None, cols: int = 3) -> dict:
+    """Griglia a `cols` colonne, archi in sequenza di lettura."""
+    padding, node_w, node_h, gap = 20, 260, 64, 28
+    count = len(graph["nodes"])
+    rows = (count + cols - 1) // cols if count else 1
+    nodes = [_node(padding + (i % cols) * (node_w + gap), padding + (i // cols) * (node_h + gap),
+                   node_w, node_h, n["label"], n.get("hl", False)) for i, n in enumerate(graph["nodes"])]
+    return {"width": padding * 2 + cols * node_w + (cols - 1) * gap,
+            "height": padding * 2 + rows * node_h + (rows - 1) * gap,
+            "theme": "dark", "header": None, "nodes": nodes, "edges": _seq_edges(nodes)}
+
+def layout_radial(graph, size=None, header=None) -> dict:
+    """Argomento al centro, step in cerchio: il raggio cresce col numero di step (niente sovrapposizioni)."""
+    box_w, box_h = 220, 58
+    n = max(1, len(graph["nodes"]))
+    # arco minimo tra due centri consecutivi ≈ media delle dimensioni del box
+    r = max(180, int(n * ((box_w + box_h) / 2 + 10) / (2 * math.pi)))
+    w, h = size or (max(900, 2 * r + box_w + 40), max(600, 2 * r + box_h + 60))
+    cx, cy = w // 2, h // 2
+    cw, ch = 260, 70
+    nodes = [_node(cx - cw // 2, cy - ch // 2, cw, ch, header or "")]
+    edges = []
+    for i, gn in enumerate(graph["nodes"]):
+        ang = (2 * math.pi * i) / n - math.pi / 2
+        x = int(cx + r * math.cos(ang)) - box_w // 2
+        y = int(cy + r * math.sin(ang)) - box_h // 2
+        edges.append((cx, cy, x + box_w // 2, y + box_h // 2, False, False))
+        nodes.append(_node(x, y, box_w, box_h, gn["label"], gn.get("hl", False)))
+    return {"width": w, "height": h, "theme": "dark", "header": None, "nodes": nodes, "edges": edges}
+
+def layout_tiered(graph, size=None, header=None) -> dict:
+    """Mappa gerarchica a fasce (stile libro scolastico)."""
+    items = [(n["label"], n.get("hl", False)) for n in graph["nodes"]]
+    if items:
+        mid = max(2, len(items) // 3)
+        tiers = [items[:2], items[2:2 + mid], items[2 + mid:]]
+    else:
+        tiers = [[("Introduzione", False)], [("Sviluppo", False)], [("Sintesi", False)]]
+    w, h = size or (1000, 900)
+    nodes, edges = [], []
+    top, box_w, box_h = 100, 280, 80
+    for t, row in enumerate(tiers):
+        if not row:
+            continue
+        y = top + t * 220
+        cols = len(row)
+        gap = (w - 80 - cols * box_w) // (cols - 1) if cols > 1 else 0
+        for i, (label, hl) in enumerate(row):
+            x = 40 + i * (box_w + gap)
+            nodes.append(_node(x, y, box_w, box_h, label, hl))
+            if t < len(tiers) - 1 and tiers[t + 1]:
+                edges.append((x + box_w // 2, y + box_h, x + box_w // 2, top + (t + 1) * 220 - 20, False, False))
+    return {"width": w, "height": h, "theme": "book", "header": header, "nodes": nodes, "edges": edges}
+
+def layout_layered(graph, size=None, header=None) -> dict:
+    """Layout gerarchico a strati (stile Sugiyama) per grafi grandi con archi arbitrari.
+
+    1) cicli rotti invertendo gli archi all'indietro rispetto all'ordine dei nodi;
+    2) strato = cammino più lungo dalle sorgenti; 3) incroci ridotti con il baricentro dei
+    vicini (LAYERED_SWEEPS passate giù/su); 4) strati larghi a capo ogni LAYERED_ROW_MAX nodi,
+    altezza dei nodi dal testo a capo; 5) righe piegate in colonne se la mappa è troppo alta.
+    Costo O((V + E) · passate) più un ordinamento per strato.
+    """
+    node_w, gap_x, gap_y, padding = 220, 36, 56, 20
+    ids = [n["id"] for n in graph["nodes"]]
+    index = {nid: i for i, nid in enumerate(ids)}
+    preds = [[] for _ in ids]
+    succs = [[] for _ in ids]
+    edges_in = []
+    for e in graph["edges"]:
+        a, b = index.get(e["from"]), index.get(e["to"])
+        if a is None or b is None or a == b:
+            continue
+        u, v = (a, b) if a < b else (b, a)  # arco all'indietro: invertito solo per il layout
+        preds[v].append(u)
+        succs[u].append(v)
+        edges_in.append((a, b, e.get("kind") == "related"))
+
+    layer = [0] * len(ids)
+    for v in range(len(ids)):  # dopo l'inversione gli archi vanno tutti in avanti nell'indice
+        for u in preds[v]:
+            layer[v] = max(layer[v], layer[u] + 1)
+    layers: list[list[int]] = [[] for _ in range(max(layer, default=-1) + 1)]
+    for v in range(len(ids)):
+        layers[layer[v]].append(v)
+
+    rel = [0.0] * len(ids)  # posizione relativa nello strato (0..1)
+    def place(row):
+        for k, v in enumerate(row):
+            rel[v] = (k + 0.5) / len(row)
+    for row in layers:
+        place(row)
+    for _ in range(LAYERED_SWEEPS):
+        for rows, nbrs in ((layers[1:], preds), (layers[-2::-1], succs)):
+            for row in rows:
+                row.sort(key=lambda v: sum(rel[u] for u in nbrs[v]) / len(nbrs[v]) if nbrs[v] else rel[v])
+                place(row)
+
+    # righe: strati larghi vanno a capo; altezza della riga dal testo a capo più alto
+    rows = []
+    for row in layers:
+        for start in range(0, len(row), LAYERED_ROW_MAX):
+            chunk = row[start:start + LAYERED_ROW_MAX]
+            rows.append((chunk, max(_node_height(graph["nodes"][v]["label"], node_w) for v in chunk)))
+    max_cols = min(LAYERED_ROW_MAX, max((len(c) for c, _ in rows), default=1))
+    band_w = max_cols * node_w + (max_cols - 1) * gap_x
+    # catene lunghe (tipico di un piano: uno step per strato) piegate in colonne affiancate,
+    # con proporzioni vicine a LAYERED_ASPECT invece di una striscia alta migliaia di pixel
+    avg_h = (sum(h for _, h in rows) / len(rows) + gap_y) if rows else 1
+    per_band = max(6, math.ceil(math.sqrt(len(rows) * (band_w + gap_x * 2) / (LAYERED_ASPECT * avg_h))))
+    top = padding + (60 if header else 0)
+    nodes: list[dict] = [None] * len(ids)
+    band = [0] * len(ids)
+    bottom = top
+    for r, (chunk, row_h) in enumerate(rows):
+        b = r // per_band
+        if r % per_band == 0:
+            y = top
+        bx = padding + b * (band_w + gap_x * 2)
+        x0 = bx + (band_w - (len(chunk) * node_w + (len(chunk) - 1) * gap_x)) / 2
+        for k, v in enumerate(chunk):
+            gn = graph["nodes"][v]
+            nodes[v] = _node(x0 + k * (node_w + gap_x), y, node_w, _node_height(gn["label"], node_w),
+                             gn["label"], gn.get("hl", False))
+            band[v] = b
+        y += row_h + gap_y
+        bottom = max(bottom, y - gap_y)
+    edges = []
+    for a, b, dashed in edges_in:
+        na, nb = nodes[a], nodes[b]
+        if band[a] != band[b]:  # tra colonne: dal lato del nodo verso l'altra colonna
+            left, right = (na, nb) if band[a] < band[b] else (nb, na)
+            p, q = (left["x"] + node_w, left["y"] + left["h"] / 2), (right["x"], right["y"] + right["h"] / 2)
+            (x1, y1), (x2, y2) = (p, q) if left is na else (q, p)
+        elif na["y"] < nb["y"]:
+            x1, y1, x2, y2 = na["x"] + node_w / 2, na["y"] + na["h"], nb["x"] + node_w / 2, nb["y"]
+        else:
+            x1, y1, x2, y2 = na["x"] + node_w / 2, na["y"], nb["x"] + node_w / 2, nb["y"] + nb["h"]
+        edges.append((x1, y1, x2, y2, True, dashed))
+    bands = (len(rows) + per_band - 1) // per_band or 1
+    return {"width": padding * 2 + bands * band_w + (bands - 1) * gap_x * 2, "height": bottom + padding,
+            "theme": "dark", "header": header, "nodes": nodes, "edges": edges}
+
+LAYOUTS = {
+    "linear": layout_linear,
+    "grid": layout_grid,
+    "radial": layout_radial,
+    "tiered": layout_tiered,
+    "layered": layout_layered,
+}
+
+
+# ========================= TESTO =========================
+@lru_cache(maxsize=4096)
+def wrap_label(label: str, width_px: int, max_lines: int = 4) -> tuple[str, ...]:
+    """Testo a capo per parole entro la larghezza del nodo; l'ultima riga troncata con "…"."""
+    per_line = max(4, (width_px - 20) // CHAR_W)
+    lines, cur = [], ""
+    for word in (label or "").split():
+        while len(word) > per_line:  # parola più lunga della riga: spezzata
+            if cur:
+                lines.append(cur)
+                cur = ""
+            lines.append(word[:per_line])
+            word = word[per_line:]
+        if cur and len(cur) + 1 + len(word) > per_line:
+            lines.append(cur)
+            cur = word
+        else:
+            cur = f"{cur} {word}" if cur else word
+    if cur:
+        lines.append(cur)
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        lines[-1] = lines[-1][: per_line - 1].rstrip() + "…"
+    return tuple(lines) or ("",)
+
+def _node_height(label: str, width_px: int) -> int:
+    return max(48, 20 + LINE_H * len(wrap_label(label, width_px)))
+
+def _node_lines(n: dict) -> tuple[str, ...]:
+    return wrap_label(n["label"], int(n["w"]), max(1, (int(n["h"]) - 8) // LINE_H))
+
+
+# ========================= RENDER =========================
+def _hex(rgb) -> str:
+    return "#%02x%02x%02x" % rgb
+
+def _esc(text: str) -> str:
+    return (text or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _visible(box, viewport) -> bool:
+    x1, y1, x2, y2 = box
+    vx, vy, vw, vh = viewport
+    return x2 >= vx and x1 <= vx + vw and y2 >= vy and y1 <= vy + vh
+
+def to_svg(scene: dict, viewport: tuple[int, int, int, int] | None = None) -> bytes:
+    """SVG della scena; con viewport (x, y, w, h) solo la porzione visibile (nodi e archi fuori sono scartati)."""
+    th = THEMES[scene["theme"]]
+    vx, vy, w, h = viewport or (0, 0, scene["width"], scene["height"])
+    parts = [f"<svg xmlns='http://www.w3.org/2000/svg' width='{w}' height='{h}' viewBox='{vx} {vy} {w} {h}'>",
+             f"<style>.node{{fill:{_hex(th['box'])};stroke:{_hex(th['border'])};stroke-width:1.2}} "
+             f".hl{{stroke:{_hex(th['head'])};stroke-width:2.4}} "
+             f".text{{fill:{_hex(th['text'])};font-size:14px;font-family:Inter,Segoe UI,Arial}} "
+             f".edge{{stroke:{_hex(th['edge'])};stroke-width:1.2}} .arrow{{marker-end:url(#arrow)}} "
+             f".dash{{stroke-dasharray:5 4;opacity:.7}}</style>",
+             f"<defs><marker id='arrow' markerWidth='10' markerHeight='6' refX='9' refY='3' orient='auto' "
+             f"markerUnits='strokeWidth'><path d='M0,0 L10,3 L0,6 z' fill='{_hex(th['edge'])}'/></marker></defs>",
+             f"<rect x='{vx}' y='{vy}' width='{w}' height='{h}' fill='{_hex(th['bg'])}'/>"]
+    view = (vx, vy, w, h)
+    if scene.get("header") and _visible((20, 20, scene["width"] - 20, 70), view):
+        parts.append(f"<rect x='20' y='20' width='{scene['width'] - 40}' height='50' rx='8' fill='{_hex(th['head'])}'/>")
+        parts.append(f"<text class='text' x='30' y='50' style='fill:#fff'>{_esc(scene['header'])}</text>")
+    for x1, y1, x2, y2, arrow, dashed in scene["edges"]:
+        if viewport and not _visible((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), view):
+            continue
+        cls = "edge" + (" arrow" if arrow else "") + (" dash" if dashed else "")
+        parts.append(f"<line class='{cls}' x1='{x1}' y1='{y1}' x2='{x2}' y2='{y2}' />")
+    for n in scene["nodes"]:
+        if viewport and not _visible((n["x"], n["y"], n["x"] + n["w"], n["y"] + n["h"]), view):
+            continue
+        cls = "node hl" if n["hl"] else "node"
+        parts.append(f"<rect class='{cls}' x='{n['x']}' y='{n['y']}' width='{n['w']}' height='{n['h']}' rx='10' ry='10' />")
+        lines = _node_lines(n)
+        y0 = n["y"] + (n["h"] - LINE_H * len(lines)) / 2 + LINE_H - 4
+        parts.append(f"<text class='text' x='{n['x'] + 10}' y='{y0}'>" + "".join(
+            f"<tspan x='{n['x'] + 10}' dy='{0 if k == 0 else LINE_H}'>{_esc(line)}</tspan>" for k, line in enumerate(lines)
+        ) + "</text>")
+    parts.append("</svg>")
+    return "".join(parts).encode("utf-8")
+
+@lru_cache(maxsize=None)
+def _font():
+    """Font caricato una volta per processo."""
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default()
+    except Exception:
+        return None
+
+def _arrow_head(x1, y1, x2, y2, size: float = 8) -> list[tuple[float, float]]:
+    d = math.hypot(x2 - x1, y2 - y1) or 1.0
+    ux, uy = (x2 - x1) / d, (y2 - y1) / d
+    bx, by = x2 - ux * size, y2 - uy * size
+    return [(bx - uy * size / 2, by + ux * size / 2), (x2, y2), (bx + uy * size / 2, by - ux * size / 2)]
+
+def _dashed(dr, x1, y1, x2, y2, fill, dash: float = 6, gap: float = 5):
+    d = math.hypot(x2 - x1, y2 - y1)
+    if not d:
+        return
+    ux, uy = (x2 - x1) / d, (y2 - y1) / d
+    t = 0.0
+    while t < d:
+        e = min(d, t + dash)
+        dr.line([(x1 + ux * t, y1 + uy * t), (x1 + ux * e, y1 + uy * e)], fill=fill, width=2)
+        t = e + gap
+
+def to_png(scene: dict, viewport: tuple[int, int, int, int] | None = None) -> bytes | None:
+    try:
+        from PIL import Image, ImageDraw
+    except Exception:
+        return None
+    th = THEMES[scene["theme"]]
+    vx, vy, w, h = viewport or (0, 0, scene["width"], scene["height"])
+    img = Image.new("RGB", (int(w), int(h)), th["bg"])
+    dr = ImageDraw.Draw(img)
+    font = _font()
+    if scene.get("header"):
+        dr.rounded_rectangle([20 - vx, 20 - vy, scene["width"] - 20 - vx, 70 - vy], radius=8, fill=th["head"])
+        dr.text((30 - vx, 40 - vy), scene["header"], fill=(255, 255, 255), font=font)
+    view = (vx, vy, w, h)
+    for x1, y1, x2, y2, arrow, dashed in scene["edges"]:
+        if viewport and not _visible((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), view):
+            continue
+        x1, y1, x2, y2 = x1 - vx, y1 - vy, x2 - vx, y2 - vy
+        if dashed:
+            _dashed(dr, x1, y1, x2, y2, th["edge"])
+        else:
+            dr.line([(x1, y1), (x2, y2)], fill=th["edge"], width=2)
+        if arrow:
+            dr.polygon(_arrow_head(x1, y1, x2, y2), fill=th["edge"])
+    for n in scene["nodes"]:
+        if viewport and not _visible((n["x"], n["y"], n["x"] + n["w"], n["y"] + n["h"]), view):
+            continue
+        x, y, nw, nh = n["x"] - vx, n["y"] - vy, n["w"], n["h"]
+        dr.rounded_rectangle([x, y, x + nw, y + nh], radius=10, fill=th["box"],
+                             outline=th["head"] if n["hl"] else th["border"], width=3 if n["hl"] else 2)
+        lines = _node_lines(n)
+        y0 = y + (nh - LINE_H * len(lines)) / 2 + 2
+        for k, line in enumerate(lines):
+            dr.text((x + 10, y0 + k * LINE_H), line, font=font, fill=th["text"])
+    bio = BytesIO()
+    img.save(bio, format="PNG", optimize=False)
+    return bio.getvalue()
+
+RENDERERS = {"svg": to_svg, "png": to_png}
+
+
+# ========================= CACHE =========================
+_mem: "OrderedDict[str, bytes]" = OrderedDict()
+_scenes: "OrderedDict[str, dict]" = OrderedDict()  # scene già calcolate: i tile non rifanno il layout
+_mem_lock = threading.Lock()
+_disk_bytes: int | None = None  # occupazione stimata di MAP_CACHE_DIR (None: ancora da misurare)
+_disk_lock = threading.Lock()
+
+def _graph_key(graph: dict, layout: str, size, header) -> str:
+    raw = json.dumps([ENGINE_VERSION, graph, layout, list(size) if size else None, header],
+                     ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _lru_get(store: OrderedDict, key: str):
+    with _mem_lock:
+        value = store.get(key)
+        if value is not None:
+            store.move_to_end(key)
+        return value
+
+def _lru_put(store: OrderedDict, key: str, value):
+    with _mem_lock:
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > MAP_CACHE_ITEMS:
+            store.popitem(last=False)
+
+def _cache_get(key: str, fmt: str) -> bytes | None:
+    data = _lru_get(_mem, key)
+    if data is not None:
+        return data
+    path = MAP_CACHE_DIR / f"{key}.{fmt}"
+    try:
+        data = path.read_bytes()
+        os.utime(path)  # mtime = ultimo uso: l'evizione su disco segue la stessa LRU della memoria
+    except OSError:
+        return None
+    _lru_put(_mem, key, data)
+    return data
+
+def _disk_files() -> list[os.DirEntry]:
+    with os.scandir(MAP_CACHE_DIR) as it:
+        return [e for e in it if e.is_file() and not e.name.endswith(".tmp")]
+
+def _disk_evict(added: int):
+    """Conta i byte scritti e, oltre MAP_DISK_CACHE_MB, cancella i file con mtime più vecchio.
+
+    La directory si misura solo alla prima scrittura e quando si supera il limite (gli altri processi
+    scrivono nella stessa cartella: la stima si riallinea a ogni evizione).
+    """
+    global _disk_bytes
+    limit = int(MAP_DISK_CACHE_MB * 1024 * 1024)
+    with _disk_lock:
+        if _disk_bytes is None:
+            _disk_bytes = sum(e.stat().st_size for e in _disk_files())
+        else:
+            _disk_bytes += added
+        if _disk_bytes <= limit:
+            return
+        entries = []
+        for e in _disk_files():
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+        _disk_bytes = total
+
+def _cache_put(key: str, fmt: str, data: bytes):
+    _lru_put(_mem, key, data)
+    try:
+        MAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = MAP_CACHE_DIR / f"{key}.{fmt}.{os.getpid()}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, MAP_CACHE_DIR / f"{key}.{fmt}")  # scrittura atomica: mai file a metà
+        _disk_evict(len(data))
+    except OSError:
+        pass  # la cache su disco è un'ottimizzazione
+
+def _scene(graph: dict, layout: str, size, header) -> tuple[str, dict]:
+    gkey = _graph_key(graph, layout, size, header)
+    scene = _lru_get(_scenes, gkey)
+    if scene is None:
+        scene = LAYOUTS[layout](graph, size, header)
+        _lru_put(_scenes, gkey, scene)
+    return gkey, scene
+
+
+def render_map(plan_json: dict, layout: str = "grid", step_idx: int | None = None,
+               size: tuple[int, int] | None = None, fmt: str = "png", header: str | None = None,
+               viewport: tuple[int, int, int, int] | None = None, graph: dict | None = None) -> bytes | None:
+    """Mappa del piano nel layout e formato richiesti ("svg" o "png"); None se PNG senza Pillow.
+
+    `graph` sostituisce il grafo ricavato dal piano (es. mappe da un libro); `viewport` (x, y, w, h)
+    rende solo una porzione, vedi map_tiles.
+    """
+    graph = graph or plan_graph(plan_json, step_idx)
+    gkey, scene = _scene(graph, layout, size, header)
+    key = hashlib.sha256(f"{gkey}:{fmt}:{list(viewport) if viewport else ''}".encode()).hexdigest()
+    data = _cache_get(key, fmt)
+    if data is not None:
+        return data
+    data = RENDERERS[fmt](scene, viewport)
+    if data is not None:
+        _cache_put(key, fmt, data)
+    return data
+
+def map_size(plan_json: dict, layout: str = "layered", step_idx: int | None = None,
+             size: tuple[int, int] | None = None, header: str | None = None, graph: dict | None = None) -> tuple[int, int]:
+    scene = _scene(graph or plan_graph(plan_json, step_idx), layout, size, header)[1]
+    return int(math.ceil(scene["width"])), int(math.ceil(scene["height"]))
+
+def map_tiles(plan_json: dict, layout: str = "layered", step_idx: int | None = None,
+              tile: int = MAP_TILE_SIZE, header: str | None = None, graph: dict | None = None) -> list[tuple[int, int, int, int]]:
+    """Viewport (x, y, w, h) che coprono la mappa a tile di `tile` px, riga per riga: ogni tile si
+    rende (e si mette in cache) da solo con render_map(..., viewport=v)."""
+    w, h = map_size(plan_json, layout, step_idx, None, header, graph)
+    return [(x, y, min(tile, w - x), min(tile, h - y)) for y in range(0, h, tile) for x in range(0, w, tile)]
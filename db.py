@@ -1,12 +1,149 @@
 # db.py
+import os
+import re
 import json
+import queue
+import time
+import zlib
+import hashlib
 import sqlite3
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from pathlib import Path
 
 DB_PATH = Path("app.db")
 
+# Connessioni persistenti: un piccolo pool condiviso tra i thread di Streamlit
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+STATEMENT_CACHE = 128  # prepared statement riusati per connessione
+
+# Cache AI: TTL sull'ultimo accesso, quote in MB (0 = nessun limite), eviction LRU periodica
+AI_CACHE_TTL_DAYS = float(os.getenv("AI_CACHE_TTL_DAYS", "90"))
+AI_CACHE_MAX_MB = float(os.getenv("AI_CACHE_MAX_MB", "512"))
+AI_CACHE_USER_MAX_MB = float(os.getenv("AI_CACHE_USER_MAX_MB", "0"))
+AI_CACHE_EVICT_EVERY = int(os.getenv("AI_CACHE_EVICT_EVERY", "500"))  # scritture tra due eviction
+_TOUCH_INTERVAL_S = 3600  # last_access aggiornato al massimo una volta l'ora per riga
+
+# Lease di generazione: un solo processo alla volta genera lo stesso contenuto (single-flight)
+GEN_LEASE_TTL_S = float(os.getenv("GEN_LEASE_TTL_S", "120"))
+LEASE_OWNER = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+
+FTS_AVAILABLE = False  # impostato da _init_db se SQLite ha FTS5
+# Libri non associati a nessun piano: eliminati (con l'indice) dopo questo margine dal caricamento
+TEXTBOOK_GRACE_HOURS = float(os.getenv("TEXTBOOK_GRACE_HOURS", "24"))
+
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=POOL_SIZE)
+
 def _connect():
-    return sqlite3.connect(DB_PATH)
+    """Apre una nuova connessione con WAL e PRAGMA di performance."""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,          # la connessione passa da un thread all'altro via pool
+        cached_statements=STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@contextmanager
+def _db():
+    """Prende in prestito una connessione dal pool; commit/rollback automatici all'uscita."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+# Ricalcola done/doing di un piano contando solo gli step esistenti (step_idx < step_count)
+_REFRESH_COUNTS_SQL = """
+    UPDATE plans SET
+        done_count = (SELECT COUNT(*) FROM progresses p
+                      WHERE p.plan_id = plans.id AND p.status = 'done'
+                        AND p.step_idx >= 0 AND p.step_idx < COALESCE(plans.step_count, 0)),
+        doing_count = (SELECT COUNT(*) FROM progresses p
+                       WHERE p.plan_id = plans.id AND p.status = 'doing'
+                         AND p.step_idx >= 0 AND p.step_idx < COALESCE(plans.step_count, 0))
+    WHERE id = {plan_id}
+"""
+
+def _step_count(plan_json_obj) -> int:
+    steps = (plan_json_obj or {}).get("steps") if isinstance(plan_json_obj, dict) else None
+    return len(steps) if isinstance(steps, list) else 0
+
+def step_fingerprint(step: dict) -> str:
+    """Hash del contenuto di uno step (titolo + outline): cambia solo se lo step cambia davvero."""
+    step = step if isinstance(step, dict) else {}
+    raw = json.dumps([step.get("title", ""), step.get("theory_outline", [])], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def diff_steps(old_steps: list, new_steps: list) -> tuple[dict[int, int], list[int]]:
+    """Confronta due liste di step per fingerprint.
+
+    Ritorna ({old_idx: new_idx} per gli step invariati, anche se spostati, [new_idx nuovi o modificati]).
+    """
+    pool = defaultdict(deque)
+    for i, st in enumerate(old_steps or []):
+        pool[step_fingerprint(st)].append(i)
+    moves, changed = {}, []
+    for j, st in enumerate(new_steps or []):
+        olds = pool.get(step_fingerprint(st))
+        if olds:
+            moves[olds.popleft()] = j
+        else:
+            changed.append(j)
+    return moves, changed
+
+def _ensure_columns(c, table: str, columns: dict[str, str]):
+    """Aggiunge a `table` le colonne mancanti ({nome: ddl})."""
+    c.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in c.fetchall()}
+    for col, ddl in columns.items():
+        if col not in existing:
+            try:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}")
+            except sqlite3.OperationalError:
+                pass
+
+def _pack(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), 6)
+
+def _unpack(data: bytes | None, legacy: str | None) -> str:
+    """Decomprime un blob; le righe pre-compressione hanno ancora il testo in chiaro."""
+    return zlib.decompress(data).decode("utf-8") if data is not None else (legacy or "")
+
+def _begin_write(conn):
+    """Apre la transazione prendendo subito il lock di scrittura (BEGIN IMMEDIATE), se non è già aperta."""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+def _put_blob(conn, content: str) -> str:
+    """Salva il contenuto compresso una sola volta (indirizzato per sha256) e ne ritorna l'hash.
+
+    Blob e riferimento vanno scritti nella stessa transazione di scrittura, aperta qui: tra il controllo
+    di esistenza e l'inserimento del riferimento _gc_blobs di un'altra connessione non può cancellarlo.
+    """
+    _begin_write(conn)
+    h = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    if conn.execute("SELECT 1 FROM ai_blobs WHERE hash=?", (h,)).fetchone() is None:
+        data = _pack(content)
+        # content esplicito: nei database creati prima della compressione è NOT NULL senza default
+        conn.execute("INSERT OR IGNORE INTO ai_blobs(hash, content, data, size) VALUES(?, '', ?, ?)", (h, data, len(data)))
+    return h
 
 def _init_db():
     """Crea le tabelle se non esistono e aggiunge colonne opzionali in modo sicuro."""
@@ -30,6 +167,9 @@ def _init_db():
             plan_json TEXT NOT NULL,
             public_id TEXT,      -- opzionale: link pubblico
             extra TEXT,          -- opzionale: meta varie (JSON)
+            step_count INTEGER,  -- aggregati mantenuti (vedi _refresh_counts / trigger)
+            done_count INTEGER DEFAULT 0,
+            doing_count INTEGER DEFAULT 0,
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     """)
@@ -44,18 +184,139 @@ def _init_db():
         )
     """)
 
+    # metadati utente per step: scadenza, post-it, allegati (user_id = proprietario del piano, per l'agenda)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS step_meta (
+            plan_id INTEGER NOT NULL,
+            step_idx INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            due_date TEXT,
+            notes TEXT NOT NULL DEFAULT '',
+            attachments TEXT NOT NULL DEFAULT '[]',
+            updated_at REAL,
+            PRIMARY KEY (plan_id, step_idx)
+        )
+    """)
+
     # cache AI per risparmiare costi: spiegazioni, esercizi, ecc.
     c.execute("""
         CREATE TABLE IF NOT EXISTS ai_cache (
             plan_id INTEGER NOT NULL,
             step_idx INTEGER NOT NULL,
             kind TEXT NOT NULL,            -- es: 'explain_md', 'exercises_json', 'map_png_path'
-            content TEXT NOT NULL,        -- testo o path file
+            content TEXT NOT NULL,        -- testo o path file ('' se il testo è in ai_blobs)
+            blob_hash TEXT,               -- opzionale: puntatore al contenuto condiviso
+            last_access REAL,             -- epoch s, per TTL/LRU (vedi evict_ai_cache)
             PRIMARY KEY(plan_id, step_idx, kind),
             FOREIGN KEY(plan_id) REFERENCES plans(id)
         )
     """)
 
+    # contenuti condivisi indirizzati per hash (stesso testo = una sola riga tra piani/utenti)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS ai_blobs (
+            hash TEXT PRIMARY KEY,        -- sha256 del contenuto
+            content TEXT NOT NULL DEFAULT '',  -- legacy: testo in chiaro
+            data BLOB,                    -- testo compresso zlib
+            size INTEGER DEFAULT 0        -- byte occupati (compressi), per le quote
+        )
+    """)
+    # cache delle risposte LLM: chiave = hash(versione template, prompt, modello, temperatura)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            blob_hash TEXT NOT NULL,
+            model TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_access REAL,
+            FOREIGN KEY(blob_hash) REFERENCES ai_blobs(hash)
+        )
+    """)
+    # testi estratti dai PDF caricati, per hash del file (riusati se lo stesso file torna)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS textbooks (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            chars INTEGER NOT NULL DEFAULT 0,
+            pages_read INTEGER NOT NULL DEFAULT 0,
+            page_count INTEGER NOT NULL DEFAULT 0,
+            budget INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # indice full-text dei libri a blocchi (BM25 di FTS5): ai prompt arrivano solo i blocchi pertinenti.
+    # textbook_hash è indicizzato (un solo token esadecimale): il filtro per libro sta nella MATCH
+    global FTS_AVAILABLE
+    try:
+        old = c.execute("SELECT sql FROM sqlite_master WHERE name='textbook_chunks'").fetchone()
+        if old and "textbook_hash UNINDEXED" in old[0]:
+            # schema precedente: MATCH e bm25 giravano su tutti i libri; si ricopia nel nuovo indice
+            c.execute("ALTER TABLE textbook_chunks RENAME TO textbook_chunks_old")
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS textbook_chunks USING fts5(
+                text, textbook_hash, chunk_idx UNINDEXED, page UNINDEXED,
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        if old and "textbook_hash UNINDEXED" in old[0]:
+            c.execute("""
+                INSERT INTO textbook_chunks(text, textbook_hash, chunk_idx, page)
+                SELECT text, textbook_hash, chunk_idx, page FROM textbook_chunks_old
+                WHERE textbook_hash IN (SELECT hash FROM textbooks)
+            """)
+            c.execute("DROP TABLE textbook_chunks_old")
+        FTS_AVAILABLE = True
+    except sqlite3.OperationalError:  # SQLite compilato senza FTS5: niente retrieval
+        FTS_AVAILABLE = False
+
+    # risposte del tutor per piano, per domanda normalizzata (vedi ai.normalize_question)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS tutor_qa (
+            plan_id INTEGER NOT NULL,
+            qkey TEXT NOT NULL,
+            question TEXT NOT NULL,
+            data BLOB NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (plan_id, qkey)
+        )
+    """)
+
+    # conversazione col tutor per piano e utente: turni completi + riassunto dei turni già "piegati"
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS tutor_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plan_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tutor_turns_session ON tutor_turns(plan_id, user_id, id)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS tutor_sessions (
+            plan_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            summary TEXT NOT NULL DEFAULT '',
+            upto INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (plan_id, user_id)
+        )
+    """)
+
+    # lease di generazione in corso (single-flight tra processi): scadono da sole
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS gen_leases (
+            plan_id INTEGER NOT NULL,
+            step_idx INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (plan_id, step_idx, kind)
+        )
+    """)
+
     # 2) Aggiunta colonne opzionali solo se mancano (robusta)
     c.execute("PRAGMA table_info(plans)")
     cols = {row[1] for row in c.fetchall()}
@@ -69,6 +330,13 @@ def _init_db():
             c.execute("ALTER TABLE plans ADD COLUMN extra TEXT")
         except sqlite3.OperationalError:
             pass
+    _ensure_columns(c, "plans", {"step_count": "INTEGER", "done_count": "INTEGER DEFAULT 0", "doing_count": "INTEGER DEFAULT 0"})
+    _ensure_columns(c, "plans", {"textbook_hash": "TEXT"})
+    _ensure_columns(c, "textbooks", {"chunks": "INTEGER"})
+
+    _ensure_columns(c, "ai_cache", {"blob_hash": "TEXT", "last_access": "REAL"})
+    _ensure_columns(c, "ai_blobs", {"data": "BLOB", "size": "INTEGER DEFAULT 0"})
+    _ensure_columns(c, "llm_cache", {"last_access": "REAL"})
 
     # 3) Indici utili
     try:
@@ -79,6 +347,57 @@ def _init_db():
         c.execute("CREATE INDEX IF NOT EXISTS idx_plans_user_id ON plans(user_id)")
     except sqlite3.OperationalError:
         pass
+    c.execute("CREATE INDEX IF NOT EXISTS idx_step_meta_due ON step_meta(user_id, due_date)")
+
+    # 4) Contatori per piano: i trigger su progresses li tengono allineati
+    for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_progresses_counts_{event.lower()}
+            AFTER {event} ON progresses
+            BEGIN
+                {_REFRESH_COUNTS_SQL.format(plan_id=f"{ref}.plan_id")};
+            END
+        """)
+    # backfill dei piani creati prima delle colonne aggregate
+    backfill = c.execute("""
+        UPDATE plans SET step_count = CASE
+            WHEN json_valid(plan_json) THEN COALESCE(json_array_length(plan_json, '$.steps'), 0)
+            ELSE 0 END
+        WHERE step_count IS NULL
+    """)
+    if backfill.rowcount:
+        c.execute(_REFRESH_COUNTS_SQL.format(plan_id="plans.id"))
+
+    # 5) Cache AI: indici per LRU/GC e migrazione dei contenuti in chiaro verso blob compressi
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS idx_ai_cache_last_access ON ai_cache(last_access)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_cache_blob ON ai_cache(blob_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)",
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_blob ON llm_cache(blob_hash)",
+    ):
+        c.execute(ddl)
+    for h, content in c.execute("SELECT hash, content FROM ai_blobs WHERE data IS NULL").fetchall():
+        data = _pack(content)
+        c.execute("UPDATE ai_blobs SET data=?, size=?, content='' WHERE hash=?", (data, len(data), h))
+    for plan_id, step_idx, kind, content in c.execute(
+        "SELECT plan_id, step_idx, kind, content FROM ai_cache WHERE blob_hash IS NULL"
+    ).fetchall():
+        c.execute(
+            "UPDATE ai_cache SET blob_hash=?, content='' WHERE plan_id=? AND step_idx=? AND kind=?",
+            (_put_blob(conn, content), plan_id, step_idx, kind)
+        )
+    # righe senza last_access: accessi distinti in ordine di inserimento (rowid, o created_at per
+    # llm_cache), così la LRU non vede tutta la cache migrata come un'unica voce
+    now = time.time()
+    c.execute("""
+        UPDATE ai_cache SET last_access = ? - ((SELECT MAX(rowid) FROM ai_cache) - rowid) * 0.001
+        WHERE last_access IS NULL
+    """, (now,))
+    c.execute("""
+        UPDATE llm_cache SET last_access = MIN(?, COALESCE(CAST(strftime('%s', created_at) AS REAL), ?)
+                                                 - ((SELECT MAX(rowid) FROM llm_cache) - rowid) * 0.001)
+        WHERE last_access IS NULL
+    """, (now, now))
 
     conn.commit()
     conn.close()
@@ -90,32 +409,30 @@ _init_db()
 # ========================= USERS =========================
 def upsert_user(email: str):
     """Crea l'utente se non esiste e lo ritorna."""
-    conn = _connect(); c = conn.cursor()
-    c.execute("SELECT id, email FROM users WHERE email=?", (email,))
-    row = c.fetchone()
-    if not row:
-        c.execute("INSERT INTO users(email) VALUES(?)", (email,))
-        conn.commit()
+    with _db() as conn:
+        c = conn.cursor()
         c.execute("SELECT id, email FROM users WHERE email=?", (email,))
         row = c.fetchone()
-    conn.close()
+        if not row:
+            c.execute("INSERT OR IGNORE INTO users(email) VALUES(?)", (email,))
+            c.execute("SELECT id, email FROM users WHERE email=?", (email,))
+            row = c.fetchone()
     return {"id": row[0], "email": row[1]}
 
 
 # ========================= PLANS =========================
 def save_plan(user_id: int, topic: str, level: str, goals: str, plan_json_obj: dict):
     """Salva un nuovo piano e ritorna il record completo."""
-    conn = _connect(); c = conn.cursor()
     plan_json = json.dumps(plan_json_obj)
-    c.execute(
-        "INSERT INTO plans(user_id, topic, level, goals, plan_json) VALUES (?, ?, ?, ?, ?)",
-        (user_id, topic, level, goals or "", plan_json)
-    )
-    conn.commit()
-    plan_id = c.lastrowid
-    c.execute("SELECT id, user_id, topic, level, goals, plan_json FROM plans WHERE id=?", (plan_id,))
-    row = c.fetchone()
-    conn.close()
+    with _db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO plans(user_id, topic, level, goals, plan_json, step_count) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, topic, level, goals or "", plan_json, _step_count(plan_json_obj))
+        )
+        plan_id = c.lastrowid
+        c.execute("SELECT id, user_id, topic, level, goals, plan_json FROM plans WHERE id=?", (plan_id,))
+        row = c.fetchone()
     return {
         "id": row[0], "user_id": row[1], "topic": row[2], "level": row[3],
         "goals": row[4], "plan_json": json.loads(row[5]) if row[5] else {}
@@ -125,10 +442,11 @@ def list_plans(user_id: int | None):
     """Lista piani per utente. Se user_id è None ritorna [] (sicuro per view pubbliche)."""
     if user_id is None:
         return []
-    conn = _connect(); c = conn.cursor()
-    c.execute("SELECT id, user_id, topic, level, goals, plan_json FROM plans WHERE user_id=? ORDER BY id DESC", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with _db() as conn:
+        rows = conn.execute(
+            "SELECT id, user_id, topic, level, goals, plan_json FROM plans WHERE user_id=? ORDER BY id DESC",
+            (user_id,)
+        ).fetchall()
     plans = []
     for r in rows:
         try:
@@ -141,59 +459,570 @@ def list_plans(user_id: int | None):
         })
     return plans
 
+def list_plan_summaries(user_id: int | None, after_id: int | None = None, limit: int = 50) -> list[dict]:
+    """Pagina di piani (id, topic, level, contatori) senza leggere plan_json.
+
+    Paginazione keyset su idx_plans_user_id: passa come after_id l'ultimo id della pagina
+    precedente (ordine id DESC). Il costo dipende da limit, non dal numero totale di piani.
+    """
+    if user_id is None:
+        return []
+    sql = "SELECT id, step_count, done_count, doing_count, user_id, topic, level FROM plans WHERE user_id=?"
+    params: list = [user_id]
+    if after_id is not None:
+        sql += " AND id<?"
+        params.append(after_id)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(int(limit))
+    with _db() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [
+        {"id": r[0], "user_id": r[4], "topic": r[5], "level": r[6], "counts": _counts_row(r)}
+        for r in rows
+    ]
+
+def get_plan(plan_id: int) -> dict | None:
+    """Ritorna il piano completo (plan_json decodificato) o None se non esiste."""
+    with _db() as conn:
+        r = conn.execute(
+            "SELECT id, user_id, topic, level, goals, plan_json, textbook_hash FROM plans WHERE id=?", (plan_id,)
+        ).fetchone()
+    if not r:
+        return None
+    try:
+        pj = json.loads(r[5]) if isinstance(r[5], str) else (r[5] or {})
+    except Exception:
+        pj = {}
+    return {
+        "id": r[0], "user_id": r[1], "topic": r[2], "level": r[3],
+        "goals": r[4], "plan_json": pj, "textbook_hash": r[6]
+    }
+
+def _counts_row(r) -> dict:
+    return {"total": r[1] or 0, "done": r[2] or 0, "doing": r[3] or 0}
+
+def get_plan_count(plan_id: int) -> dict:
+    """Contatori {total, done, doing} di un singolo piano (es. vista condivisa)."""
+    with _db() as conn:
+        row = conn.execute(
+            "SELECT id, step_count, done_count, doing_count FROM plans WHERE id=?", (plan_id,)
+        ).fetchone()
+    return _counts_row(row) if row else {"total": 0, "done": 0, "doing": 0}
+
 def update_plan_topic(plan_id: int, new_topic: str):
-    conn = _connect(); c = conn.cursor()
-    c.execute("UPDATE plans SET topic=? WHERE id=?", (new_topic, plan_id))
-    conn.commit(); conn.close()
+    with _db() as conn:
+        conn.execute("UPDATE plans SET topic=? WHERE id=?", (new_topic, plan_id))
 
 def delete_plan(plan_id: int):
-    conn = _connect(); c = conn.cursor()
-    c.execute("DELETE FROM progresses WHERE plan_id=?", (plan_id,))
-    c.execute("DELETE FROM plans WHERE id=?", (plan_id,))
-    conn.commit(); conn.close()
+    with _db() as conn:
+        hashes = [r[0] for r in conn.execute("SELECT blob_hash FROM ai_cache WHERE plan_id=?", (plan_id,))]
+        conn.execute("DELETE FROM progresses WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM ai_cache WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM gen_leases WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM tutor_qa WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM tutor_turns WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM tutor_sessions WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM step_meta WHERE plan_id=?", (plan_id,))
+        conn.execute("DELETE FROM plans WHERE id=?", (plan_id,))
+        _gc_blobs(conn, hashes)
+        _gc_textbooks(conn)
 
-def update_plan_json(plan_id: int, plan_json_obj: dict):
-    """Aggiorna il JSON del piano (sovrascrive)."""
-    conn = _connect(); c = conn.cursor()
-    c.execute("UPDATE plans SET plan_json=? WHERE id=?", (json.dumps(plan_json_obj), plan_id))
-    conn.commit(); conn.close()
+def update_plan_json(plan_id: int, plan_json_obj: dict) -> list[int]:
+    """Aggiorna il JSON del piano (sovrascrive) preservando la cache AI degli step invariati.
+
+    La cache AI segue il fingerprint: rimappata sul nuovo indice per gli step solo spostati, eliminata per
+    quelli rimossi o modificati. Stato e metadati (note, scadenza, allegati) sono dati dell'utente: seguono
+    gli step spostati, restano sull'indice per quelli modificati e spariscono solo con l'indice.
+    Ritorna gli indici (nuovi) da rigenerare.
+    """
+    new_steps = (plan_json_obj or {}).get("steps") or []
+    with _db() as conn:
+        row = conn.execute("SELECT plan_json FROM plans WHERE id=?", (plan_id,)).fetchone()
+        try:
+            old_steps = (json.loads(row[0]) or {}).get("steps") or [] if row else []
+        except Exception:
+            old_steps = []
+        moves, changed = diff_steps(old_steps, new_steps)
+        # solo le righe degli step: quelle a livello di piano (step_idx fuori intervallo) non si toccano
+        in_range = "plan_id=? AND step_idx >= 0 AND step_idx < ?"
+        rows = conn.execute(
+            f"SELECT step_idx, kind, content, blob_hash, last_access FROM ai_cache WHERE {in_range}",
+            (plan_id, len(old_steps))
+        ).fetchall()
+        conn.execute(f"DELETE FROM ai_cache WHERE {in_range}", (plan_id, len(old_steps)))
+        conn.executemany(
+            "INSERT INTO ai_cache(plan_id, step_idx, kind, content, blob_hash, last_access) VALUES(?, ?, ?, ?, ?, ?)",
+            [(plan_id, moves[r[0]], r[1], r[2], r[3], r[4]) for r in rows if r[0] in moves]
+        )
+        _gc_blobs(conn, [r[3] for r in rows if r[0] not in moves])
+        # step spostati: al nuovo indice; step modificati sul posto: restano dove sono
+        kept = set(changed)
+        target = lambda idx: moves.get(idx, idx if idx in kept else None)
+        # lo stato segue lo step (i trigger ricalcolano i contatori del piano)
+        progress = conn.execute("SELECT step_idx, status FROM progresses WHERE plan_id=?", (plan_id,)).fetchall()
+        conn.execute("DELETE FROM progresses WHERE plan_id=?", (plan_id,))
+        conn.executemany(
+            "INSERT INTO progresses(plan_id, step_idx, status) VALUES(?, ?, ?)",
+            [(plan_id, target(r[0]), r[1]) for r in progress if target(r[0]) is not None]
+        )
+        meta = conn.execute(
+            "SELECT step_idx, user_id, due_date, notes, attachments, updated_at FROM step_meta WHERE plan_id=?", (plan_id,)
+        ).fetchall()
+        conn.execute("DELETE FROM step_meta WHERE plan_id=?", (plan_id,))
+        conn.executemany(
+            """
+            INSERT INTO step_meta(plan_id, step_idx, user_id, due_date, notes, attachments, updated_at)
+            VALUES(?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(plan_id, target(r[0]), *r[1:]) for r in meta if target(r[0]) is not None]
+        )
+        conn.execute(
+            "UPDATE plans SET plan_json=?, step_count=? WHERE id=?",
+            (json.dumps(plan_json_obj), _step_count(plan_json_obj), plan_id)
+        )
+        conn.execute(_REFRESH_COUNTS_SQL.format(plan_id="?"), (plan_id,))
+    return changed
 
 
 # ========================= AI CACHE =========================
+def _touch(conn, table: str, where: str, params: tuple, last_access):
+    """Aggiorna last_access solo se vecchio: le letture non diventano scritture ad ogni hit."""
+    now = time.time()
+    if last_access is None or last_access < now - _TOUCH_INTERVAL_S:
+        conn.execute(f"UPDATE {table} SET last_access=? WHERE {where}", (now, *params))
+
 def get_ai_cache(plan_id: int, step_idx: int, kind: str) -> str | None:
-    conn = _connect(); c = conn.cursor()
-    c.execute("SELECT content FROM ai_cache WHERE plan_id=? AND step_idx=? AND kind=?", (plan_id, step_idx, kind))
-    row = c.fetchone(); conn.close()
-    return row[0] if row else None
+    with _db() as conn:
+        row = conn.execute(
+            """
+            SELECT b.data, COALESCE(b.content, a.content), a.last_access, a.blob_hash, b.hash FROM ai_cache a
+            LEFT JOIN ai_blobs b ON b.hash = a.blob_hash
+            WHERE a.plan_id=? AND a.step_idx=? AND a.kind=?
+            """,
+            (plan_id, step_idx, kind)
+        ).fetchone()
+        if row and row[3] is not None and row[4] is None:
+            # punta a un blob che non esiste: la riga non vale nulla, va rigenerata
+            conn.execute("DELETE FROM ai_cache WHERE plan_id=? AND step_idx=? AND kind=?", (plan_id, step_idx, kind))
+            return None
+        if row:
+            _touch(conn, "ai_cache", "plan_id=? AND step_idx=? AND kind=?", (plan_id, step_idx, kind), row[2])
+    return _unpack(row[0], row[1]) if row else None
 
 def set_ai_cache(plan_id: int, step_idx: int, kind: str, content: str):
-    conn = _connect(); c = conn.cursor()
-    c.execute(
+    with _db() as conn:
+        h = _put_blob(conn, content)
+        conn.execute(
+            """
+            INSERT INTO ai_cache(plan_id, step_idx, kind, content, blob_hash, last_access)
+            VALUES(?, ?, ?, '', ?, ?)
+            ON CONFLICT(plan_id, step_idx, kind)
+            DO UPDATE SET content='', blob_hash=excluded.blob_hash, last_access=excluded.last_access
+            """,
+            (plan_id, step_idx, kind, h, time.time())
+        )
+    _maybe_evict()
+
+def get_llm_cache(key: str) -> str | None:
+    """Risposta LLM già ottenuta per la stessa richiesta (vedi ai._cache_key), condivisa tra piani."""
+    with _db() as conn:
+        row = conn.execute(
+            """
+            SELECT b.data, b.content, l.last_access, b.hash FROM llm_cache l
+            LEFT JOIN ai_blobs b ON b.hash = l.blob_hash WHERE l.key=?
+            """,
+            (key,)
+        ).fetchone()
+        if row and row[3] is None:
+            # chiave senza blob (scrittura persa): rimossa, così non resta a puntare nel vuoto
+            conn.execute("DELETE FROM llm_cache WHERE key=?", (key,))
+            return None
+        if row:
+            _touch(conn, "llm_cache", "key=?", (key,), row[2])
+    return _unpack(row[0], row[1]) if row else None
+
+def set_llm_cache(key: str, content: str, model: str | None = None):
+    with _db() as conn:
+        h = _put_blob(conn, content)
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache(key, blob_hash, model, last_access) VALUES(?, ?, ?, ?)",
+            (key, h, model, time.time())
+        )
+    _maybe_evict()
+
+_writes_since_evict = 0
+
+def _maybe_evict():
+    global _writes_since_evict
+    _writes_since_evict += 1
+    if AI_CACHE_EVICT_EVERY and _writes_since_evict >= AI_CACHE_EVICT_EVERY:
+        _writes_since_evict = 0
+        evict_ai_cache()
+
+def _gc_blobs(conn, hashes=None) -> int:
+    """Elimina i blob non più referenziati.
+
+    Con `hashes` (i riferimenti appena rimossi dalla transazione) controlla solo quelli, via indice;
+    senza, scansiona tutta la cache: solo da evict_ai_cache, fuori dai percorsi dell'utente.
+    """
+    if hashes is None:
+        return conn.execute("""
+            DELETE FROM ai_blobs
+            WHERE hash NOT IN (SELECT blob_hash FROM ai_cache WHERE blob_hash IS NOT NULL)
+              AND hash NOT IN (SELECT blob_hash FROM llm_cache)
+        """).rowcount
+    return conn.executemany("""
+        DELETE FROM ai_blobs WHERE hash=?
+          AND NOT EXISTS (SELECT 1 FROM ai_cache WHERE blob_hash=?)
+          AND NOT EXISTS (SELECT 1 FROM llm_cache WHERE blob_hash=?)
+    """, [(h, h, h) for h in set(hashes) if h]).rowcount
+
+def ai_cache_bytes(user_id: int | None = None) -> int:
+    """Byte occupati dai blob della cache: globali, o referenziati dai piani di un utente."""
+    with _db() as conn:
+        if user_id is None:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM ai_blobs").fetchone()[0]
+        return conn.execute("""
+            SELECT COALESCE(SUM(b.size), 0) FROM ai_blobs b WHERE b.hash IN (
+                SELECT a.blob_hash FROM ai_cache a JOIN plans p ON p.id = a.plan_id WHERE p.user_id=?
+            )
+        """, (user_id,)).fetchone()[0]
+
+def evict_ai_cache(batch: int = 200) -> dict:
+    """TTL + quote: elimina le voci meno usate di recente finché i limiti sono rispettati.
+
+    1) voci di ai_cache/llm_cache non lette da AI_CACHE_TTL_DAYS;
+    2) per ogni utente oltre AI_CACHE_USER_MAX_MB, le sue voci ai_cache in ordine LRU;
+    3) oltre AI_CACHE_MAX_MB globali, le voci LRU di entrambe le tabelle.
+    I blob non più referenziati vengono rimossi. Ritorna il conteggio delle righe eliminate.
+    """
+    stats = {"expired": 0, "user_quota": 0, "global_quota": 0, "blobs": 0}
+    with _db() as conn:
+        if AI_CACHE_TTL_DAYS:
+            cutoff = time.time() - AI_CACHE_TTL_DAYS * 86400
+            stats["expired"] += conn.execute("DELETE FROM ai_cache WHERE last_access < ?", (cutoff,)).rowcount
+            stats["expired"] += conn.execute("DELETE FROM llm_cache WHERE last_access < ?", (cutoff,)).rowcount
+        stats["blobs"] += _gc_blobs(conn)
+
+    if AI_CACHE_USER_MAX_MB:
+        limit = AI_CACHE_USER_MAX_MB * 1024 * 1024
+        with _db() as conn:
+            users = [r[0] for r in conn.execute("SELECT DISTINCT p.user_id FROM ai_cache a JOIN plans p ON p.id = a.plan_id")]
+        for uid in users:
+            while ai_cache_bytes(uid) > limit:
+                with _db() as conn:
+                    victims = conn.execute("""
+                        SELECT a.rowid, a.blob_hash FROM ai_cache a JOIN plans p ON p.id = a.plan_id
+                        WHERE p.user_id=? ORDER BY a.last_access, a.rowid LIMIT ?
+                    """, (uid, batch)).fetchall()
+                    deleted = conn.executemany("DELETE FROM ai_cache WHERE rowid=?", [(r[0],) for r in victims]).rowcount
+                    stats["user_quota"] += deleted
+                    stats["blobs"] += _gc_blobs(conn, [r[1] for r in victims])
+                if not deleted:
+                    break
+
+    if AI_CACHE_MAX_MB:
+        limit = AI_CACHE_MAX_MB * 1024 * 1024
+        while ai_cache_bytes() > limit:
+            with _db() as conn:
+                # al massimo `batch` voci per giro, le meno usate delle due tabelle (a parità, le più vecchie)
+                victims, hashes = {"ai_cache": [], "llm_cache": []}, []
+                for table, rid, h, _ in conn.execute("""
+                    SELECT 'ai_cache', rowid AS rid, blob_hash, last_access FROM ai_cache
+                    UNION ALL SELECT 'llm_cache', rowid, blob_hash, last_access FROM llm_cache
+                    ORDER BY last_access, rid LIMIT ?
+                """, (batch,)).fetchall():
+                    victims[table].append(rid)
+                    hashes.append(h)
+                deleted = 0
+                for table, rids in victims.items():
+                    if rids:
+                        deleted += conn.execute(
+                            f"DELETE FROM {table} WHERE rowid IN ({','.join('?' * len(rids))})", rids
+                        ).rowcount
+                stats["global_quota"] += deleted
+                stats["blobs"] += _gc_blobs(conn, hashes)
+            if not deleted:
+                break
+    return stats
+
+
+# ========================= TEXTBOOK =========================
+def get_textbook(file_hash: str, budget: int = 0) -> dict | None:
+    """Testo già estratto da un PDF (per hash del file). None se manca o se era stato estratto con
+    un budget di caratteri minore di quello richiesto senza arrivare alla fine del libro."""
+    with _db() as conn:
+        row = conn.execute(
+            "SELECT data, pages_read, page_count, budget FROM textbooks WHERE hash=?", (file_hash,)
+        ).fetchone()
+    if not row or (row[3] < budget and row[1] < row[2]):
+        return None
+    return {"hash": file_hash, "text": _unpack(row[0], None), "pages_read": row[1], "page_count": row[2]}
+
+def set_textbook(file_hash: str, text: str, pages_read: int, page_count: int, budget: int):
+    with _db() as conn:
+        conn.execute(
+            """
+            INSERT INTO textbooks(hash, data, chars, pages_read, page_count, budget) VALUES(?, ?, ?, ?, ?, ?)
+            ON CONFLICT(hash) DO UPDATE SET data=excluded.data, chars=excluded.chars,
+                pages_read=excluded.pages_read, page_count=excluded.page_count, budget=excluded.budget,
+                chunks=NULL
+            """,
+            (file_hash, _pack(text), len(text), pages_read, page_count, budget)
+        )
+
+def set_plan_textbook(plan_id: int, file_hash: str | None):
+    with _db() as conn:
+        conn.execute("UPDATE plans SET textbook_hash=? WHERE id=?", (file_hash, plan_id))
+        _gc_textbooks(conn)
+
+def _book_match(file_hash: str) -> str:
+    # filtro di colonna FTS5: solo i blocchi del libro, senza scorrere l'indice degli altri
+    return f'textbook_hash : "{file_hash}"'
+
+def _gc_textbooks(conn):
+    """Elimina i libri (e i loro blocchi) non più associati ad alcun piano.
+
+    Restano quelli caricati da meno di TEXTBOOK_GRACE_HOURS: un piano appena generato dal libro
+    potrebbe non essere ancora salvato.
+    """
+    orphans = [r[0] for r in conn.execute(
         """
-        INSERT INTO ai_cache(plan_id, step_idx, kind, content)
-        VALUES(?, ?, ?, ?)
-        ON CONFLICT(plan_id, step_idx, kind)
-        DO UPDATE SET content=excluded.content
+        SELECT hash FROM textbooks
+        WHERE created_at < datetime('now', ?)
+          AND hash NOT IN (SELECT textbook_hash FROM plans WHERE textbook_hash IS NOT NULL)
         """,
-        (plan_id, step_idx, kind, content)
-    )
-    conn.commit(); conn.close()
+        (f"-{TEXTBOOK_GRACE_HOURS} hours",)
+    )]
+    for file_hash in orphans:
+        if FTS_AVAILABLE:
+            conn.execute(
+                "DELETE FROM textbook_chunks WHERE rowid IN (SELECT rowid FROM textbook_chunks WHERE textbook_chunks MATCH ?)",
+                (_book_match(file_hash),)
+            )
+        conn.execute("DELETE FROM textbooks WHERE hash=?", (file_hash,))
+
+def textbook_indexed(file_hash: str) -> bool:
+    with _db() as conn:
+        row = conn.execute("SELECT chunks FROM textbooks WHERE hash=?", (file_hash,)).fetchone()
+    return bool(row and row[0] is not None)
+
+def index_textbook(file_hash: str, chunks: list[tuple[int, str]]):
+    """(Re)indicizza il libro: `chunks` è [(pagina, testo)] nell'ordine del libro."""
+    if not FTS_AVAILABLE:
+        return
+    with _db() as conn:
+        conn.execute(
+            "DELETE FROM textbook_chunks WHERE rowid IN (SELECT rowid FROM textbook_chunks WHERE textbook_chunks MATCH ?)",
+            (_book_match(file_hash),)
+        )
+        conn.executemany(
+            "INSERT INTO textbook_chunks(text, textbook_hash, chunk_idx, page) VALUES(?, ?, ?, ?)",
+            [(text, file_hash, i, page) for i, (page, text) in enumerate(chunks)]
+        )
+        conn.execute("UPDATE textbooks SET chunks=? WHERE hash=?", (len(chunks), file_hash))
+
+_TERM_RE = re.compile(r"\w{3,}")
+
+def search_textbook(file_hash: str, query: str, k: int = 4) -> list[dict]:
+    """I `k` blocchi del libro più pertinenti per `query` (BM25), come [{"chunk_idx", "page", "text"}].
+
+    La query è ridotta ai suoi termini (3+ caratteri) in OR: niente sintassi FTS dall'utente.
+    """
+    terms = list(dict.fromkeys(t.lower() for t in _TERM_RE.findall(query or "")))[:32]
+    if not FTS_AVAILABLE or not terms or k <= 0:
+        return []
+    match = _book_match(file_hash) + " AND (" + " OR ".join(f'"{t}"' for t in terms) + ")"
+    with _db() as conn:
+        rows = conn.execute(
+            """
+            SELECT chunk_idx, page, text FROM textbook_chunks
+            WHERE textbook_chunks MATCH ?
+            ORDER BY bm25(textbook_chunks, 1.0, 0.0) LIMIT ?
+            """,
+            (match, k)
+        ).fetchall()
+    return [{"chunk_idx": r[0], "page": r[1], "text": r[2]} for r in rows]
+
+
+# ========================= TUTOR =========================
+def get_tutor_answer(plan_id: int, qkey: str) -> str | None:
+    with _db() as conn:
+        row = conn.execute("SELECT data FROM tutor_qa WHERE plan_id=? AND qkey=?", (plan_id, qkey)).fetchone()
+        if row:
+            conn.execute("UPDATE tutor_qa SET hits=hits+1 WHERE plan_id=? AND qkey=?", (plan_id, qkey))
+    return _unpack(row[0], None) if row else None
+
+def tutor_questions(plan_id: int) -> list[str]:
+    """Chiavi (domande normalizzate) già risposte per il piano."""
+    with _db() as conn:
+        return [r[0] for r in conn.execute("SELECT qkey FROM tutor_qa WHERE plan_id=?", (plan_id,))]
+
+def set_tutor_answer(plan_id: int, qkey: str, question: str, answer: str):
+    with _db() as conn:
+        conn.execute(
+            """
+            INSERT INTO tutor_qa(plan_id, qkey, question, data) VALUES(?, ?, ?, ?)
+            ON CONFLICT(plan_id, qkey) DO UPDATE SET question=excluded.question, data=excluded.data
+            """,
+            (plan_id, qkey, question, _pack(answer))
+        )
+
+def get_tutor_session(plan_id: int, user_id: int) -> dict:
+    """{"summary", "upto", "turns"}: riassunto dei turni con id <= upto e turni successivi per intero."""
+    with _db() as conn:
+        row = conn.execute(
+            "SELECT summary, upto FROM tutor_sessions WHERE plan_id=? AND user_id=?", (plan_id, user_id)
+        ).fetchone()
+        summary, upto = row if row else ("", 0)
+        turns = conn.execute(
+            "SELECT id, question, answer FROM tutor_turns WHERE plan_id=? AND user_id=? AND id>? ORDER BY id",
+            (plan_id, user_id, upto)
+        ).fetchall()
+    return {"summary": summary, "upto": upto,
+            "turns": [{"id": t[0], "question": t[1], "answer": t[2]} for t in turns]}
+
+def list_tutor_turns(plan_id: int, user_id: int, limit: int = 6) -> list[dict]:
+    """Ultimi `limit` turni della conversazione, dal più vecchio."""
+    with _db() as conn:
+        rows = conn.execute(
+            "SELECT question, answer FROM tutor_turns WHERE plan_id=? AND user_id=? ORDER BY id DESC LIMIT ?",
+            (plan_id, user_id, limit)
+        ).fetchall()
+    return [{"question": r[0], "answer": r[1]} for r in reversed(rows)]
+
+def add_tutor_turn(plan_id: int, user_id: int, question: str, answer: str):
+    with _db() as conn:
+        conn.execute(
+            "INSERT INTO tutor_turns(plan_id, user_id, question, answer) VALUES(?, ?, ?, ?)",
+            (plan_id, user_id, question, answer)
+        )
+
+def set_tutor_summary(plan_id: int, user_id: int, summary: str, upto: int, prev_upto: int) -> bool:
+    """Salva il riassunto fino al turno `upto` solo se nel frattempo nessun altro lo ha aggiornato."""
+    with _db() as conn:
+        cur = conn.execute(
+            """
+            INSERT INTO tutor_sessions(plan_id, user_id, summary, upto) VALUES(?, ?, ?, ?)
+            ON CONFLICT(plan_id, user_id) DO UPDATE SET summary=excluded.summary, upto=excluded.upto
+            WHERE tutor_sessions.upto=?
+            """,
+            (plan_id, user_id, summary, upto, prev_upto)
+        )
+        return cur.rowcount == 1
+
+def clear_tutor_session(plan_id: int, user_id: int):
+    with _db() as conn:
+        conn.execute("DELETE FROM tutor_turns WHERE plan_id=? AND user_id=?", (plan_id, user_id))
+        conn.execute("DELETE FROM tutor_sessions WHERE plan_id=? AND user_id=?", (plan_id, user_id))
+
+
+# ========================= LEASE =========================
+def acquire_lease(plan_id: int, step_idx: int, kind: str, ttl: float = GEN_LEASE_TTL_S) -> bool:
+    """Prende (o rinnova) il lease di generazione per questo processo; False se è di un altro ancora valido."""
+    now = time.time()
+    with _db() as conn:
+        cur = conn.execute(
+            """
+            INSERT INTO gen_leases(plan_id, step_idx, kind, owner, expires_at) VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(plan_id, step_idx, kind) DO UPDATE
+            SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE gen_leases.owner=excluded.owner OR gen_leases.expires_at < ?
+            """,
+            (plan_id, step_idx, kind, LEASE_OWNER, now + ttl, now)
+        )
+        return cur.rowcount == 1
+
+def release_lease(plan_id: int, step_idx: int, kind: str):
+    with _db() as conn:
+        conn.execute(
+            "DELETE FROM gen_leases WHERE plan_id=? AND step_idx=? AND kind=? AND owner=?",
+            (plan_id, step_idx, kind, LEASE_OWNER)
+        )
 
 
 # ========================= PROGRESS =========================
 def get_progress_map(plan_id: int) -> dict[int, str]:
     """Ritorna {step_idx: status} per un plan."""
-    conn = _connect(); c = conn.cursor()
-    c.execute("SELECT step_idx, status FROM progresses WHERE plan_id=?", (plan_id,))
-    rows = c.fetchall(); conn.close()
+    with _db() as conn:
+        rows = conn.execute("SELECT step_idx, status FROM progresses WHERE plan_id=?", (plan_id,)).fetchall()
     return {int(r[0]): r[1] for r in rows}
 
 def set_progress(plan_id: int, step_idx: int, status: str):
     """Salva o aggiorna lo stato di uno step (to-do / doing / done)."""
-    conn = _connect(); c = conn.cursor()
-    c.execute("""
-        INSERT INTO progresses(plan_id, step_idx, status)
-        VALUES (?, ?, ?)
-        ON CONFLICT(plan_id, step_idx) DO UPDATE SET status=excluded.status
-    """, (plan_id, step_idx, status))
-    conn.commit(); conn.close()
+    with _db() as conn:
+        conn.execute("""
+            INSERT INTO progresses(plan_id, step_idx, status)
+            VALUES (?, ?, ?)
+            ON CONFLICT(plan_id, step_idx) DO UPDATE SET status=excluded.status
+        """, (plan_id, step_idx, status))
+
+
+# ========================= STEP META =========================
+_META_DEFAULTS = {"due_date": None, "notes": "", "attachments": []}
+
+def _meta_row(r) -> dict:
+    return {"due_date": r[0], "notes": r[1], "attachments": json.loads(r[2] or "[]")}
+
+def get_step_meta(plan_id: int, step_idx: int) -> dict:
+    """{"due_date": "YYYY-MM-DD" | None, "notes", "attachments"}; {} se lo step non ha metadati."""
+    with _db() as conn:
+        r = conn.execute(
+            "SELECT due_date, notes, attachments FROM step_meta WHERE plan_id=? AND step_idx=?", (plan_id, step_idx)
+        ).fetchone()
+    return _meta_row(r) if r else {}
+
+def set_step_meta(plan_id: int, metas: dict[int, dict]):
+    """Aggiorna i metadati di più step in una transazione: {step_idx: campi da cambiare}.
+
+    I campi assenti restano quelli salvati; user_id è preso dal piano.
+    """
+    if not metas:
+        return
+    idxs = list(metas)
+    with _db() as conn:
+        marks = ",".join("?" * len(idxs))
+        current = {
+            int(r[0]): _meta_row(r[1:]) for r in conn.execute(
+                f"SELECT step_idx, due_date, notes, attachments FROM step_meta WHERE plan_id=? AND step_idx IN ({marks})",
+                (plan_id, *idxs)
+            )
+        }
+        now = time.time()
+        rows = []
+        for i in idxs:
+            m = {**_META_DEFAULTS, **current.get(i, {}), **metas[i]}
+            rows.append((plan_id, i, m["due_date"] or None, m["notes"] or "",
+                         json.dumps(list(m["attachments"] or [])), now, plan_id))
+        conn.executemany(
+            """
+            INSERT INTO step_meta(plan_id, step_idx, user_id, due_date, notes, attachments, updated_at)
+            SELECT ?, ?, user_id, ?, ?, ?, ? FROM plans WHERE id=?
+            ON CONFLICT(plan_id, step_idx) DO UPDATE SET due_date=excluded.due_date, notes=excluded.notes,
+                attachments=excluded.attachments, updated_at=excluded.updated_at
+            """,
+            rows
+        )
+
+def get_agenda(user_id: int, today: str, plan_id: int | None = None) -> list[dict]:
+    """Step in scadenza oggi o in ritardo su tutti i piani dell'utente (o su uno solo), per scadenza.
+
+    Una sola lettura sull'indice (user_id, due_date); il titolo dello step viene dal plan_json.
+    """
+    sql = """
+        SELECT m.plan_id, m.step_idx, m.due_date, p.topic,
+               json_extract(p.plan_json, '$.steps[' || m.step_idx || '].title')
+        FROM step_meta m JOIN plans p ON p.id = m.plan_id
+        WHERE m.user_id=? AND m.due_date IS NOT NULL AND m.due_date <= ?
+    """
+    params: tuple = (user_id, today)
+    if plan_id is not None:
+        sql += " AND m.plan_id=?"
+        params += (plan_id,)
+    with _db() as conn:
+        rows = conn.execute(sql + " ORDER BY m.due_date, m.plan_id, m.step_idx", params).fetchall()
+    return [
+        {"plan_id": r[0], "step_idx": r[1], "due_date": r[2], "topic": r[3], "title": r[4] or "",
+         "overdue": r[2] < today}
+        for r in rows
+    ]
@@ -0,0 +1,101 @@
+# ingest.py
+"""Ingestione dei libri PDF caricati nel generatore.
+
+Il file viene letto a blocchi: prima solo per calcolarne l'hash (se lo stesso PDF è già stato
+estratto il testo arriva dalla cache in SQLite), poi, solo se serve, copiato su un file temporaneo
+che un processo separato apre in modo lazy, pagina per pagina, fermandosi al budget di caratteri.
+L'estrazione gira in un pool di processi: la UI non resta bloccata mentre l'utente compila il form.
+Il testo estratto viene diviso in blocchi e indicizzato (FTS5, db.index_textbook): i prompt ricevono
+solo i blocchi pertinenti. Estrazione e suddivisione stanno in pdf_text.py, senza import di db.py.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from db import get_textbook, set_textbook, textbook_indexed, index_textbook
+# il pool riceve pdf_text.extract_text: i processi di lavoro non importano db.py
+from pdf_text import TEXTBOOK_CHAR_BUDGET, extract_text, chunk_text
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+_CHUNK = 1 << 20  # 1 MiB
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: il processo di Streamlit ha molti thread, fork non è sicuro
+            _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _index(digest: str, text: str):
+    index_textbook(digest, chunk_text(text))
+
+
+def _chunks(upload):
+    upload.seek(0)
+    while True:
+        block = upload.read(_CHUNK)
+        if not block:
+            return
+        yield block
+
+
+def file_hash(upload) -> str:
+    """SHA-256 del file caricato, letto a blocchi (niente copia completa in memoria)."""
+    h = hashlib.sha256()
+    for block in _chunks(upload):
+        h.update(block)
+    return h.hexdigest()
+
+
+def ingest_textbook(upload, budget: int = TEXTBOOK_CHAR_BUDGET) -> Future:
+    """Avvia l'ingestione di un PDF caricato e ritorna subito un Future.
+
+    Il risultato è {"hash", "text", "pages_read", "page_count", "cached"}; un'estrazione fallita
+    (PDF illeggibile, PyMuPDF assente) arriva come eccezione del Future.
+    """
+    digest = file_hash(upload)
+    out: Future = Future()
+    cached = get_textbook(digest, budget)
+    if cached is not None:
+        if not textbook_indexed(digest):  # libri estratti prima dell'indice
+            _index(digest, cached["text"])
+        out.set_result({**cached, "cached": True})
+        return out
+
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="textbook_")
+    with os.fdopen(fd, "wb") as f:
+        for block in _chunks(upload):
+            f.write(block)
+
+    def _done(proc: Future):
+        try:
+            text, pages_read, page_count = proc.result()
+            set_textbook(digest, text, pages_read, page_count, budget)
+            _index(digest, text)
+            out.set_result({"hash": digest, "text": text, "pages_read": pages_read,
+                            "page_count": page_count, "cached": False})
+        except Exception as e:
+            out.set_exception(e)
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    try:
+        proc = _get_pool().submit(extract_text, path, budget)
+    except Exception as e:  # pool non disponibile (es. processo in chiusura)
+        os.unlink(path)
+        out.set_exception(e)
+        return out
+    proc.add_done_callback(_done)
+    return out
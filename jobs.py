@@ -0,0 +1,238 @@
+# jobs.py
+"""Pre-generazione in background dei contenuti AI per step (spiegazioni ed esercizi).
+
+Un unico pool di thread per processo: Streamlit riesegue app.py ad ogni interazione,
+ma i moduli importati restano in memoria, quindi il pool e lo stato dei job sono condivisi
+tra le sessioni.
+
+Single-flight: ogni (plan_id, step_idx, kind) ha al più una generazione in corso. Nel processo
+il registro _jobs la rappresenta (job in background o presa in carico dalla UI con claim);
+tra processi diversi fa da arbitro il lease in SQLite (db.acquire_lease).
+"""
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from ai import explain_step_ai, generate_exercises_ai, generate_batch, batch_size
+from db import get_ai_cache, set_ai_cache, get_plan, step_fingerprint, acquire_lease, release_lease
+
+PREGEN_CONCURRENCY = int(os.getenv("PREGEN_CONCURRENCY", "4"))
+LEASE_POLL_SECONDS = float(os.getenv("LEASE_POLL_SECONDS", "0.5"))
+KINDS = ("explain_md", "exercises_json")
+
+_executor = ThreadPoolExecutor(max_workers=PREGEN_CONCURRENCY, thread_name_prefix="pregen")
+_lock = threading.RLock()  # rientrante: cancel() invoca subito _done, che riprende il lock
+_jobs: dict[tuple[int, int, str], Future] = {}  # (plan_id, step_idx, kind) -> job in corso o fallito
+
+
+def _generate(plan_id: int, plan_json: dict, step_idx: int, kind: str, level: str, goal_mode: str):
+    """Genera un contenuto e lo salva in ai_cache (salta se nel frattempo è già presente).
+
+    Se un altro processo ha il lease aspetta il suo risultato invece di rigenerarlo; un lease
+    abbandonato scade e viene ripreso.
+    """
+    while True:
+        if get_ai_cache(plan_id, step_idx, kind) is not None:
+            return
+        if acquire_lease(plan_id, step_idx, kind):
+            break
+        time.sleep(LEASE_POLL_SECONDS)
+    try:
+        _generate_locked(plan_id, plan_json, step_idx, kind, level, goal_mode)
+    finally:
+        release_lease(plan_id, step_idx, kind)
+
+
+def _generate_locked(plan_id: int, plan_json: dict, step_idx: int, kind: str, level: str, goal_mode: str):
+    if get_ai_cache(plan_id, step_idx, kind) is not None:
+        return
+    fp = step_fingerprint(plan_json["steps"][step_idx])
+    # fallback=False: con il provider non disponibile il job fallisce invece di salvare i contenuti demo
+    if kind == "explain_md":
+        content = explain_step_ai(plan_json, step_idx, level, goal_mode, fallback=False)
+    else:
+        content = generate_exercises_ai(plan_json, step_idx, level, goal_mode, fallback=False)
+    _store(plan_id, step_idx, kind, content, fp)
+
+
+def _store(plan_id: int, step_idx: int, kind: str, content, fp: str):
+    # il piano può essere cambiato durante la generazione: non scrivere su uno step diverso
+    steps = ((get_plan(plan_id) or {}).get("plan_json") or {}).get("steps") or []
+    if step_idx < len(steps) and step_fingerprint(steps[step_idx]) == fp:
+        if kind == "exercises_json":
+            content = json.dumps(content, ensure_ascii=False)
+        set_ai_cache(plan_id, step_idx, kind, content)
+
+
+def _run_batch(plan_id: int, plan_json: dict, items: list[tuple[int, Future]], kind: str, level: str, goal_mode: str):
+    """Genera più step dello stesso tipo con una sola chiamata (ai.generate_batch).
+
+    Ogni step ha il proprio Future nel registro: quelli annullati nel frattempo (claim dalla UI,
+    cancel_plan) vengono saltati, gli step con lease di un altro processo ne attendono il risultato.
+    """
+    mine, foreign = [], []
+    try:
+        live = [(i, f) for i, f in items if f.set_running_or_notify_cancel()]
+        for i, f in live:
+            if get_ai_cache(plan_id, i, kind) is not None:
+                f.set_result(None)
+            elif acquire_lease(plan_id, i, kind):
+                mine.append((i, f))
+            else:
+                foreign.append((i, f))
+        try:
+            fps = {i: step_fingerprint(plan_json["steps"][i]) for i, _ in mine}
+            try:
+                results = generate_batch(plan_json, [i for i, _ in mine], kind, level, goal_mode) if mine else {}
+            except Exception as e:
+                results = {i: e for i, _ in mine}
+            for i, f in mine:
+                res = results.get(i, RuntimeError("step assente nella risposta"))
+                try:
+                    if isinstance(res, Exception):
+                        raise res
+                    _store(plan_id, i, kind, res, fps[i])
+                    f.set_result(None)
+                except Exception as e:
+                    f.set_exception(e)
+        finally:
+            for i, _ in mine:
+                release_lease(plan_id, i, kind)
+        for i, f in foreign:
+            try:
+                _generate(plan_id, plan_json, i, kind, level, goal_mode)
+                f.set_result(None)
+            except Exception as e:
+                f.set_exception(e)
+    except Exception as e:
+        # errore fuori dai singoli step (DB, fingerprint, lease): nessun Future deve restare in sospeso
+        for _, f in items:
+            if not f.done():
+                f.set_exception(e)
+
+
+def _done(key: tuple[int, int, str], fut: Future):
+    # i job riusciti escono dal registro (il contenuto è in ai_cache); quelli falliti restano per la UI
+    if fut.cancelled() or fut.exception() is None:
+        with _lock:
+            if _jobs.get(key) is fut:
+                del _jobs[key]
+
+
+def _queueable(cur: Future | None, retry: bool) -> bool:
+    return cur is None or (cur.done() and retry)
+
+
+def schedule_plan_content(plan_id: int, plan_json: dict, level: str, goal_mode: str = "misto",
+                          step_indices=None, kinds=KINDS, retry: bool = False) -> int:
+    """Accoda la generazione dei contenuti mancanti per gli step indicati (default: tutti).
+
+    Ritorna il numero di contenuti accodati, raggruppati in batch per tipo (ai.batch_size).
+    Non duplica job già in corso; i job falliti vengono riaccodati solo con retry=True.
+    """
+    steps = (plan_json or {}).get("steps") or []
+    indices = range(len(steps)) if step_indices is None else step_indices
+    queued = 0
+    for kind in kinds:
+        # letture su SQLite fuori da _lock: il registro resta bloccato solo per i controlli in memoria
+        with _lock:
+            candidates = [idx for idx in indices if _queueable(_jobs.get((plan_id, idx, kind)), retry)]
+        missing = [idx for idx in candidates if get_ai_cache(plan_id, idx, kind) is None]
+        items = []
+        with _lock:
+            for idx in missing:
+                key = (plan_id, idx, kind)
+                if not _queueable(_jobs.get(key), retry):
+                    continue  # accodato da un'altra sessione nel frattempo
+                fut = Future()
+                _jobs[key] = fut
+                items.append((idx, fut))
+        for idx, fut in items:
+            fut.add_done_callback(lambda f, key=(plan_id, idx, kind): _done(key, f))
+        # step vicini nello stesso batch: condividono il contesto e arrivano insieme nella UI
+        size = batch_size(kind)
+        for start in range(0, len(items), size):
+            _executor.submit(_run_batch, plan_id, plan_json, items[start:start + size], kind, level, goal_mode)
+        queued += len(items)
+    return queued
+
+
+def job_state(plan_id: int, step_idx: int, kind: str) -> str | None:
+    """'pending' se in corso, 'error' se fallito, None se non c'è alcun job."""
+    with _lock:
+        fut = _jobs.get((plan_id, step_idx, kind))
+    if fut is None:
+        return None
+    if not fut.done():
+        return "pending"
+    return "error" if not fut.cancelled() and fut.exception() is not None else None
+
+
+def job_error(plan_id: int, step_idx: int, kind: str) -> str | None:
+    with _lock:
+        fut = _jobs.get((plan_id, step_idx, kind))
+    if fut is None or not fut.done() or fut.cancelled() or fut.exception() is None:
+        return None
+    return str(fut.exception())
+
+
+def claim(plan_id: int, step_idx: int, kind: str) -> bool:
+    """Prende in carico un contenuto per generarlo subito (es. in streaming nella UI).
+
+    Ritorna False se è già in generazione (job in esecuzione, un'altra sessione o un altro
+    processo): il chiamante mostra il segnaposto e aspetta quel risultato. Con True il job in
+    coda viene annullato e la presa in carico resta "pending" fino a release().
+    """
+    key = (plan_id, step_idx, kind)
+    with _lock:
+        fut = _jobs.get(key)
+        if fut is not None and not fut.done() and getattr(fut, "claimed", False):
+            return False  # già presa in carico da un'altra sessione
+    # lease su SQLite fuori da _lock (il lease è per processo: le sessioni locali si escludono col registro)
+    if not acquire_lease(*key):
+        return False  # in generazione in un altro processo: il job locale (se c'è) ne attende il risultato
+    with _lock:
+        fut = _jobs.get(key)  # ricontrollo: il registro può essere cambiato durante la scrittura
+        busy = fut is not None and not fut.done()
+        if busy and getattr(fut, "claimed", False):
+            return False
+        if busy and not fut.cancel():
+            return False  # job già in esecuzione in questo processo
+        held = Future()
+        held.claimed = True
+        held.set_running_or_notify_cancel()
+        _jobs[key] = held
+    held.add_done_callback(lambda f: _done(key, f))
+    return True
+
+
+def release(plan_id: int, step_idx: int, kind: str, error: Exception | None = None):
+    """Chiude una presa in carico di claim(): libera il lease e sblocca chi aspetta."""
+    key = (plan_id, step_idx, kind)
+    release_lease(*key)
+    with _lock:
+        fut = _jobs.get(key)
+    if fut is not None and getattr(fut, "claimed", False) and not fut.done():
+        if error is None:
+            fut.set_result(None)
+        else:
+            fut.set_exception(error)
+
+
+def cancel_plan(plan_id: int) -> int:
+    """Annulla i job del piano ancora in coda e dimentica quelli terminati (es. prima di sostituirne gli step)."""
+    cancelled = 0
+    with _lock:
+        for key, fut in list(_jobs.items()):
+            if key[0] == plan_id and (fut.done() or fut.cancel()):
+                del _jobs[key]
+                cancelled += 1
+    return cancelled
+
+
+def pending_count(plan_id: int) -> int:
+    """Numero di job ancora in corso per il piano."""
+    with _lock:
+        return sum(1 for k, f in _jobs.items() if k[0] == plan_id and not f.done())
@@ -0,0 +1,59 @@
+# pdf_text.py
+"""Estrazione e suddivisione del testo dei PDF, senza accesso al database.
+
+extract_text gira nei processi di lavoro di ingest.py (spawn): il processo figlio importa solo questo
+modulo, non db.py, quindi non apre app.db e non ripete le migrazioni dello schema.
+"""
+import os
+
+from prompts import TEXTBOOK_PROMPT_TOKENS
+
+# Il testo estratto serve i prompt solo attraverso l'indice (blocchi scelti con BM25): basta che copra
+# una ventina di prompt pieni di estratti (~4 caratteri per token), non il libro intero
+TEXTBOOK_BUDGET_PROMPTS = 25
+TEXTBOOK_CHAR_BUDGET = int(os.getenv("TEXTBOOK_CHAR_BUDGET", str(TEXTBOOK_PROMPT_TOKENS * 4 * TEXTBOOK_BUDGET_PROMPTS)))
+CHUNK_CHARS = int(os.getenv("TEXTBOOK_CHUNK_CHARS", "1200"))
+CHUNK_OVERLAP = int(os.getenv("TEXTBOOK_CHUNK_OVERLAP", "200"))
+
+
+def extract_text(path: str, budget: int = TEXTBOOK_CHAR_BUDGET) -> tuple[str, int, int]:
+    """Testo delle prime pagine fino a `budget` caratteri: (testo, pagine lette, pagine totali).
+
+    Gira nel processo di lavoro: PyMuPDF carica solo le pagine effettivamente lette.
+    Le pagine sono separate da un form feed, che chunk_text usa per numerarle.
+    """
+    import fitz  # PyMuPDF
+    parts, total = [], 0
+    with fitz.open(path) as doc:
+        for i in range(doc.page_count):
+            text = doc.load_page(i).get_text()
+            parts.append(text)
+            total += len(text) + 1
+            if total >= budget:
+                return "\f".join(parts)[:budget], i + 1, doc.page_count
+        return "\f".join(parts), doc.page_count, doc.page_count
+
+
+def chunk_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> list[tuple[int, str]]:
+    """Divide il testo in blocchi di ~`size` caratteri su confini di paragrafo: [(pagina, testo)].
+
+    Ogni blocco riprende l'ultimo paragrafo del precedente se è più corto di `overlap`, così una
+    definizione a cavallo di due blocchi resta trovabile; i paragrafi troppo lunghi vengono spezzati.
+    """
+    paras = []  # (pagina, paragrafo)
+    for page, page_text in enumerate(text.split("\f"), start=1):
+        for para in page_text.split("\n\n"):
+            para = " ".join(para.split())
+            for start in range(0, len(para), size):
+                paras.append((page, para[start:start + size]))
+    chunks, cur, cur_len = [], [], 0
+    for page, para in paras:
+        if cur and cur_len + len(para) > size:
+            chunks.append((cur[0][0], "\n".join(p for _, p in cur)))
+            tail = cur[-1]
+            cur, cur_len = ([tail], len(tail[1])) if len(tail[1]) <= overlap else ([], 0)
+        cur.append((page, para))
+        cur_len += len(para) + 1
+    if cur:
+        chunks.append((cur[0][0], "\n".join(p for _, p in cur)))
+    return chunks
@@ -1,3 +1,23 @@
+import os
+import re
+
+# Versione dei template: incrementala quando cambia il significato dei prompt o il parsing
+# delle risposte, così la cache LLM condivisa (llm_cache) non riusa risposte vecchie.
+PROMPTS_VERSION = 1
+
+# Budget di input (token stimati) per i prompt su singolo step / tutor, contesto incluso
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text: str) -> int:
+    """Stima locale dei token (stile BPE): ~4 caratteri per token nelle parole, 1 per simbolo."""
+    return sum((len(t) + 3) // 4 if (t[0].isalnum() or t[0] == "_") else 1 for t in _TOKEN_RE.findall(text or ""))
+
+def context_budget(template: str, total: int = PROMPT_TOKEN_BUDGET, **fields) -> int:
+    """Token rimasti per {plan_context}: budget totale meno il template compilato senza contesto."""
+    return max(0, total - estimate_tokens(template.format(plan_context="", **fields)))
+
 PLAN_PROMPT = """Sei Synapse, un designer dell'apprendimento.
 Obiettivo: crea un piano di studio in italiano, molto dettagliato, realmente didattico per l'argomento: "{topic}".
 Livello dell'utente: {level}. Tempo al giorno: {time_per_day} minuti. Modalità: {goal_mode} (misto, equilibrio tra liceo ed università).
@@ -18,6 +38,9 @@ TUTOR_PROMPT = """Sei Synapse, un tutor di supporto.
 Contesto (estratto del piano di studio in JSON):
 {plan_context}
 
+Conversazione finora:
+{conversation}
+
 Domanda dell'utente:
 {question}
 
@@ -25,9 +48,26 @@ Regole:
 - Rispondi solo con informazioni utili per questo piano e livello.
 - Sii conciso, mostra mini-esempi, proponi una micro‑azione successiva.
 - Se l'utente sembra incerto, offri una domanda di verifica rapida.
+- Se la domanda riprende la conversazione ("e poi?", "fammi un altro esempio"), rispondi nel suo filo.
 Scrivi sempre in italiano.
 """
 
+# Memoria del tutor (token stimati): riassunto + ultimi turni entro TUTOR_HISTORY_TOKENS, di cui il
+# riassunto al massimo TUTOR_SUMMARY_TOKENS; il resto del budget del prompt resta al contesto del piano
+TUTOR_HISTORY_TOKENS = int(os.getenv("TUTOR_HISTORY_TOKENS", "700"))
+TUTOR_SUMMARY_TOKENS = int(os.getenv("TUTOR_SUMMARY_TOKENS", "250"))
+
+TUTOR_SUMMARY_PROMPT = """Sei Synapse. Aggiorna il riassunto di una conversazione di tutoraggio.
+Riassunto attuale:
+{summary}
+
+Nuovi scambi da integrare:
+{turns}
+
+Scrivi il riassunto aggiornato in italiano, al massimo {max_words} parole: argomenti chiesti, dubbi dello
+studente ancora aperti, esempi o definizioni già dati a cui potrebbe riferirsi. Solo il testo, niente titoli.
+"""
+
 EXERCISE_PROMPT = """Sei Synapse, un generatore di esercizi in italiano.
 Contesto piano (JSON, ridotto):
 {plan_context}
@@ -70,3 +110,91 @@ Produci una spiegazione DIDATTICA molto dettagliata in Markdown con questa strut
 Evita frasi vaghe; usa esempi e definizioni tecniche dove servono.
 Importante: non inserire biografia/contesto storico se il titolo/outline dello step non lo richiede.
 """
+
+# Libro caricato: blocchi recuperati dall'indice (db.search_textbook), mai il testo intero.
+# Il piano ne riceve di più (TEXTBOOK_PROMPT_TOKENS), spiegazioni, esercizi e tutor meno (SOURCE_PROMPT_TOKENS).
+TEXTBOOK_PROMPT_TOKENS = int(os.getenv("TEXTBOOK_PROMPT_TOKENS", "4000"))
+SOURCE_PROMPT_TOKENS = int(os.getenv("SOURCE_PROMPT_TOKENS", "1200"))
+SOURCE_TOP_K = int(os.getenv("SOURCE_TOP_K", "4"))
+
+TEXTBOOK_SECTION = """
+Materiale di riferimento: estratti del libro di testo caricato dall'utente ([p. N] = pagina).
+Segui la sua struttura (capitoli, terminologia, esempi) per ordinare e nominare i passi, e cita i capitoli
+nelle risorse suggerite quando possibile.
+---
+{textbook}
+---
+"""
+
+SOURCES_SECTION = """
+Estratti pertinenti del libro di testo dell'utente ([p. N] = pagina). Usa la sua terminologia e le sue
+notazioni; se citi un passaggio indica la pagina. Non inventare contenuti attribuendoli al libro.
+---
+{sources}
+---
+"""
+
+FIX_FRAGMENT_PROMPT = """Sei Synapse. Una parte di un JSON che hai generato non rispetta lo schema.
+Contesto: {context}
+
+Percorso del frammento: {path}
+Schema atteso del frammento (JSON Schema semplificato):
+{schema}
+
+Frammento attuale (può mancare o essere incompleto):
+{fragment}
+
+Errori: {errors}
+
+Restituisci SOLO un oggetto JSON della forma {{"value": <frammento corretto>}}, in italiano, senza altro testo.
+"""
+
+# Batch: più step in una sola chiamata, stesso contesto del piano condiviso tra gli step.
+# Stima iniziale dei token di output per step (poi adattata in ai.py su quanto osservato)
+EXPLAIN_OUTPUT_TOKENS = 900
+EXERCISES_OUTPUT_TOKENS = 700
+
+BATCH_EXPLAIN_PROMPT = """Sei Synapse, un docente che spiega in modo chiaro e rigoroso in italiano.
+Piano di studio (JSON, ridotto):
+{plan_context}
+
+Livello: {level} | Modalità: {goal_mode}
+Step da spiegare (JSON: indice, titolo, obiettivo, outline):
+{targets}
+
+Per OGNI step indicato produci una spiegazione DIDATTICA dettagliata in Markdown con questa struttura:
+- Chi/che cos'è (se pertinente) in 1-2 righe
+- Obiettivo didattico esplicito
+- Idee chiave (punti ricchi con definizioni + mini esempi)
+- Approfondimenti e note (incluso lessico tecnico, miti da sfatare)
+- Collegamenti (storici, concettuali o applicativi)
+- Mini-check (3 domande rapide a risposta breve)
+
+Evita frasi vaghe e ripetizioni tra uno step e l'altro; non inserire biografia/contesto storico se lo step non lo richiede.
+Restituisci SOLO un JSON della forma:
+{{"items": [{{"step_idx": <indice>, "explanation_md": string}}, ...]}}
+con un elemento per ciascuno step indicato, nello stesso ordine.
+"""
+
+BATCH_EXERCISE_PROMPT = """Sei Synapse, un generatore di esercizi in italiano.
+Piano di studio (JSON, ridotto):
+{plan_context}
+
+Livello: {level} | Modalità: {goal_mode}
+Step target (JSON: indice, titolo, obiettivo, outline):
+{targets}
+
+Per OGNI step indicato crea esercizi mirati con questa struttura:
+{{
+  "guided": {{"title": string, "steps": [string, ...]}},
+  "quiz": [{{"q": string, "opts": [string,string,string,string], "a": 0-3, "why": string}}, ... 5 domande],
+  "writing": {{"prompt": string, "min": 120, "max": 180, "rubric": [string, ...]}}
+}}
+
+Vincoli:
+- Usa il linguaggio del piano e SOLO concetti pertinenti al titolo/outline di ciascuno step.
+- Non ripetere le stesse domande tra step diversi.
+Restituisci SOLO un JSON della forma:
+{{"items": [{{"step_idx": <indice>, "exercises": {{...}}}}, ...]}}
+con un elemento per ciascuno step indicato, nello stesso ordine.
+"""
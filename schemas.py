@@ -0,0 +1,228 @@
+# schemas.py
+"""Schemi delle risposte strutturate (piano, esercizi), validatore e riparazione JSON locale.
+
+Gli schemi sono un sottoinsieme di JSON Schema (type, properties, required, items,
+minItems, maxItems, minimum, maximum) compilato una volta all'import.
+"""
+import re
+import json
+
+_STR = {"type": "string"}
+_STR_LIST = {"type": "array", "items": _STR}
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "required": ["overview", "steps"],
+    "properties": {
+        "overview": _STR,
+        "steps": {
+            "type": "array", "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["title"],
+                "properties": {
+                    "title": _STR,
+                    "objective": _STR,
+                    "theory_outline": _STR_LIST,
+                    "theory_explanations": _STR_LIST,
+                    "practice_tasks": _STR_LIST,
+                    "suggested_resources": _STR_LIST,
+                },
+            },
+        },
+        "review_strategy": _STR_LIST,
+    },
+}
+
+EXERCISES_SCHEMA = {
+    "type": "object",
+    "required": ["guided", "quiz", "writing"],
+    "properties": {
+        "guided": {
+            "type": "object",
+            "required": ["title", "steps"],
+            "properties": {"title": _STR, "steps": _STR_LIST},
+        },
+        "quiz": {
+            "type": "array", "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["q", "opts", "a"],
+                "properties": {
+                    "q": _STR,
+                    "opts": {"type": "array", "items": _STR, "minItems": 4, "maxItems": 4},
+                    "a": {"type": "integer", "minimum": 0, "maximum": 3},
+                    "why": _STR,
+                },
+            },
+        },
+        "writing": {
+            "type": "object",
+            "required": ["prompt", "min", "max"],
+            "properties": {
+                "prompt": _STR,
+                "min": {"type": "integer", "minimum": 0},
+                "max": {"type": "integer", "minimum": 0},
+                "rubric": _STR_LIST,
+            },
+        },
+    },
+}
+
+_TYPES = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+}
+
+
+class Schema:
+    """Validatore compilato: i sotto-schemi sono costruiti una volta sola."""
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.type = spec["type"]
+        self.required = tuple(spec.get("required", ()))
+        self.properties = {k: Schema(v) for k, v in spec.get("properties", {}).items()}
+        self.items = Schema(spec["items"]) if "items" in spec else None
+
+    def validate(self, value, path: tuple = ()) -> list[tuple[tuple, str]]:
+        """Ritorna [(percorso, errore)], es. (("quiz", 2, "a"), "massimo 3"); [] se valido."""
+        if not _TYPES[self.type](value):
+            return [(path, f"atteso {self.type}")]
+        errs = []
+        if self.type == "object":
+            for k in self.required:
+                if k not in value:
+                    errs.append((path + (k,), "campo mancante"))
+            for k, sub in self.properties.items():
+                if k in value:
+                    errs.extend(sub.validate(value[k], path + (k,)))
+        elif self.type == "array":
+            if len(value) < self.spec.get("minItems", 0):
+                errs.append((path, f"almeno {self.spec['minItems']} elementi"))
+            if "maxItems" in self.spec and len(value) > self.spec["maxItems"]:
+                errs.append((path, f"al massimo {self.spec['maxItems']} elementi"))
+            if self.items:
+                for i, v in enumerate(value):
+                    errs.extend(self.items.validate(v, path + (i,)))
+        elif self.type == "integer":
+            if "minimum" in self.spec and value < self.spec["minimum"]:
+                errs.append((path, f"minimo {self.spec['minimum']}"))
+            if "maximum" in self.spec and value > self.spec["maximum"]:
+                errs.append((path, f"massimo {self.spec['maximum']}"))
+        return errs
+
+    def at(self, path: tuple) -> "Schema":
+        """Sotto-schema al percorso indicato."""
+        node = self
+        for part in path:
+            node = node.items if isinstance(part, int) else node.properties[part]
+        return node
+
+
+PLAN = Schema(PLAN_SCHEMA)
+EXERCISES = Schema(EXERCISES_SCHEMA)
+
+
+def format_path(path: tuple) -> str:
+    return "$" + "".join(f"[{p}]" if isinstance(p, int) else f".{p}" for p in path)
+
+
+def fragment_path(path: tuple) -> tuple:
+    """Il frammento minimo da rigenerare: il primo elemento di array o campo di primo livello."""
+    for i, part in enumerate(path):
+        if isinstance(part, int):
+            return path[: i + 1]
+    return path[:1]
+
+
+def get_at(doc, path: tuple):
+    for part in path:
+        try:
+            doc = doc[part]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return doc
+
+
+def set_at(doc, path: tuple, value):
+    for part in path[:-1]:
+        doc = doc[part]
+    last = path[-1]
+    if isinstance(last, int) and last >= len(doc):
+        doc.append(value)
+    else:
+        doc[last] = value
+
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def repair_json(text: str):
+    """Ricava un oggetto JSON da una risposta imperfetta, senza chiamare il modello.
+
+    Gestisce recinti Markdown, prosa prima/dopo il JSON, virgole finali e documenti troncati
+    (taglia all'ultimo valore completo e chiude parentesi aperte). Ritorna None se non ci riesce.
+    """
+    if not text:
+        return None
+    t = _FENCE_RE.sub("", text.strip())
+    start = t.find("{")
+    if start == -1:
+        return None
+    t = t[start:]
+    try:
+        return json.JSONDecoder().raw_decode(t)[0]
+    except ValueError:
+        pass
+
+    out, stack = [], []
+    safe = (0, ())  # (lunghezza di out, pila) all'ultimo punto in cui il documento è coerente
+    in_str = esc = False
+    for ch in t:
+        if in_str:
+            out.append(ch)
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+            continue
+        if ch == '"':
+            in_str = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append(ch)
+            out.append(ch)
+            safe = (len(out), tuple(stack))
+        elif ch in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()  # virgola finale
+            if not stack:
+                break
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break  # documento chiuso: ignora la prosa successiva
+            safe = (len(out), tuple(stack))
+        elif ch == ",":
+            safe = (len(out), tuple(stack))
+            out.append(ch)
+        else:
+            out.append(ch)
+
+    if stack or in_str:
+        n, open_ = safe
+        out = out[:n]
+        while out and (out[-1].isspace() or out[-1] == ","):
+            out.pop()
+        out.extend("}" if c == "{" else "]" for c in reversed(open_))
+    try:
+        return json.loads("".join(out))
+    except ValueError:
+        return None
@@ -0,0 +1,30 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+# db.py apre (e migra) app.db relativo alla cartella corrente già all'import: mai quello del repo
+os.chdir(tempfile.mkdtemp(prefix="tests_"))
+
+
+def _drain(db):
+    while True:
+        try:
+            db._pool.get_nowait().close()
+        except db.queue.Empty:
+            return
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Modulo db su un database vuoto per test."""
+    import db as db_mod
+    _drain(db_mod)
+    monkeypatch.setattr(db_mod, "DB_PATH", tmp_path / "app.db")
+    db_mod._init_db()
+    yield db_mod
+    _drain(db_mod)
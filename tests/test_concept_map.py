@@ -0,0 +1,62 @@
+# tests/test_concept_map.py
+import re
+
+import concept_map
+
+
+def _plan(n):
+    return {"steps": [{"title": f"Step {i} sul tema {i % 7}", "theory_outline": [f"concetto {i}"]} for i in range(n)]}
+
+
+def test_map_tiles_cover_layered_map_exactly():
+    plan = _plan(120)
+    w, h = concept_map.map_size(plan, "layered")
+    tiles = concept_map.map_tiles(plan, "layered", tile=512)
+    assert w > 512 or h > 512  # la mappa richiede davvero più tile
+
+    for x, y, tw, th in tiles:
+        assert 0 <= x < w and 0 <= y < h
+        assert 0 < tw <= 512 and 0 < th <= 512
+        assert x + tw <= w and y + th <= h
+    assert sum(tw * th for _, _, tw, th in tiles) == w * h  # unione senza buchi...
+    corners = {(x, y) for x, y, _, _ in tiles}
+    assert len(corners) == len(tiles)  # ...né sovrapposizioni (griglia a passo fisso)
+    assert all(x % 512 == 0 and y % 512 == 0 for x, y in corners)
+
+
+def test_tile_svg_uses_its_viewport():
+    plan = _plan(60)
+    x, y, tw, th = concept_map.map_tiles(plan, "layered", tile=400)[-1]
+    svg = concept_map.render_map(plan, "layered", fmt="svg", viewport=(x, y, tw, th)).decode("utf-8")
+    assert re.search(rf"viewBox='{x} {y} {tw} {th}'", svg)
+
+
+def _graph(n, edges):
+    return {"nodes": [{"id": f"n{i}", "label": f"Nodo {i}"} for i in range(n)],
+            "edges": [{"from": f"n{a}", "to": f"n{b}"} for a, b in edges]}
+
+
+def test_layout_layered_assigns_longest_path_layers_and_breaks_cycles():
+    # diamante 0 → {1, 2} → 3, più un arco all'indietro 3 → 0 che chiude un ciclo
+    scene = concept_map.layout_layered(_graph(4, [(0, 1), (0, 2), (1, 3), (2, 3), (3, 0)]))
+    y = [n["y"] for n in scene["nodes"]]
+    assert y[0] < y[1] == y[2] < y[3]
+    assert len(scene["edges"]) == 5
+
+
+def test_layout_layered_barycenter_removes_crossing():
+    # 0 → 3 e 1 → 2: nell'ordine degli indici i due archi si incrociano
+    nodes = concept_map.layout_layered(_graph(4, [(0, 3), (1, 2)]))["nodes"]
+    assert nodes[0]["x"] < nodes[1]["x"]
+    assert nodes[3]["x"] < nodes[2]["x"]
+
+
+def test_layout_layered_wraps_wide_layers_without_overlaps():
+    n = concept_map.LAYERED_ROW_MAX * 2 + 3
+    scene = concept_map.layout_layered(_graph(n + 1, [(0, i) for i in range(1, n + 1)]))
+    boxes = [(b["x"], b["y"], b["x"] + b["w"], b["y"] + b["h"]) for b in scene["nodes"]]
+    assert len({b["y"] for b in scene["nodes"][1:]}) == 3  # strato largo su tre righe
+    for i, a in enumerate(boxes):
+        assert 0 <= a[0] and a[2] <= scene["width"] and 0 <= a[1] and a[3] <= scene["height"]
+        for b in boxes[i + 1:]:
+            assert a[2] <= b[0] or b[2] <= a[0] or a[3] <= b[1] or b[3] <= a[1]
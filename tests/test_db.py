@@ -0,0 +1,112 @@
+# tests/test_db.py
+from db import diff_steps
+
+
+def _plan(db, steps):
+    user = db.upsert_user("test@example.com")
+    return db.save_plan(user["id"], "Topic", "beginner", "", {"steps": steps})["id"]
+
+
+def _steps(*titles):
+    return [{"title": t, "theory_outline": [f"{t} 1", f"{t} 2"]} for t in titles]
+
+
+def test_update_plan_json_keeps_user_data_of_edited_step(db):
+    plan_id = _plan(db, _steps("A", "B", "C"))
+    db.set_progress(plan_id, 1, "done")
+    db.set_step_meta(plan_id, {1: {"notes": "ripassare", "due_date": "2026-01-10"}})
+    db.set_ai_cache(plan_id, 1, "explain_md", "spiegazione di B")
+    db.set_tutor_answer(plan_id, "che cosa", "Che cosa?", "Risposta")
+
+    steps = _steps("A", "B", "C")
+    steps[1]["theory_outline"].append("B 3")
+    assert db.update_plan_json(plan_id, {"steps": steps}) == [1]
+
+    assert db.get_progress_map(plan_id)[1] == "done"
+    assert db.get_step_meta(plan_id, 1)["notes"] == "ripassare"
+    assert db.get_step_meta(plan_id, 1)["due_date"] == "2026-01-10"
+    assert db.get_ai_cache(plan_id, 1, "explain_md") is None  # contenuto AI da rigenerare
+    assert db.get_tutor_answer(plan_id, "che cosa") == "Risposta"
+    assert db.get_plan_count(plan_id)["done"] == 1
+
+
+def test_update_plan_json_moves_and_drops(db):
+    plan_id = _plan(db, _steps("A", "B", "C"))
+    db.set_progress(plan_id, 0, "done")
+    db.set_progress(plan_id, 2, "doing")
+    db.set_ai_cache(plan_id, 0, "explain_md", "spiegazione di A")
+    db.set_ai_cache(plan_id, -1, "overview", "panoramica")  # riga a livello di piano
+
+    # A va in fondo, C (ultimo indice) sparisce
+    assert db.update_plan_json(plan_id, {"steps": _steps("B", "A")}) == []
+
+    assert db.get_progress_map(plan_id) == {1: "done"}
+    assert db.get_ai_cache(plan_id, 1, "explain_md") == "spiegazione di A"
+    assert db.get_ai_cache(plan_id, 0, "explain_md") is None
+    assert db.get_ai_cache(plan_id, -1, "overview") == "panoramica"
+
+
+def test_evict_ai_cache_global_quota_stops_at_limit(db, monkeypatch):
+    plan_id = _plan(db, _steps("A"))
+    for i in range(30):
+        db.set_ai_cache(plan_id, 0, f"kind_{i}", f"{i}:" + "".join(f"{(i * 7919 + j) ** 3:x}" for j in range(60)))
+    with db._db() as conn:  # come dopo la migrazione: tutte le voci con lo stesso accesso
+        conn.execute("UPDATE ai_cache SET last_access=1")
+    total = db.ai_cache_bytes()
+    monkeypatch.setattr(db, "AI_CACHE_TTL_DAYS", 0)
+    monkeypatch.setattr(db, "AI_CACHE_MAX_MB", total / 2 / 1024 / 1024)
+
+    stats = db.evict_ai_cache(batch=4)
+
+    assert 0 < stats["global_quota"] < 30
+    assert db.ai_cache_bytes() <= total / 2
+    assert db.get_ai_cache(plan_id, 0, "kind_29") is not None  # le più recenti (rowid) restano
+    assert db.get_ai_cache(plan_id, 0, "kind_0") is None
+
+
+def test_delete_plan_collects_only_its_unreferenced_blobs(db):
+    first, second = _plan(db, _steps("A")), _plan(db, _steps("A"))
+    db.set_ai_cache(first, 0, "explain_md", "condiviso")
+    db.set_ai_cache(second, 0, "explain_md", "condiviso")
+    db.set_ai_cache(first, 0, "exercises_json", "solo del primo")
+
+    db.delete_plan(first)
+    assert db.get_ai_cache(second, 0, "explain_md") == "condiviso"
+    with db._db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM ai_blobs").fetchone()[0] == 1
+
+    db.delete_plan(second)
+    assert db.ai_cache_bytes() == 0
+
+
+def test_get_llm_cache_drops_only_dangling_keys(db):
+    db.set_llm_cache("k", "risposta")
+    assert db.get_llm_cache("k") == "risposta"
+    assert db.get_llm_cache("assente") is None
+    with db._db() as conn:
+        conn.execute("DELETE FROM ai_blobs")
+    assert db.get_llm_cache("k") is None
+    with db._db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] == 0
+
+
+def test_diff_steps_reordered_steps_are_moves():
+    old = _steps("A", "B", "C")
+    moves, changed = diff_steps(old, [old[2], old[0], old[1]])
+    assert moves == {2: 0, 0: 1, 1: 2}
+    assert changed == []
+
+
+def test_diff_steps_edited_and_new_steps_are_changed():
+    old = _steps("A", "B", "C")
+    edited = dict(old[1], theory_outline=["B nuovo"])
+    moves, changed = diff_steps(old, [old[0], edited, {"title": "D"}])
+    assert moves == {0: 0}
+    assert changed == [1, 2]
+
+
+def test_diff_steps_ignores_fields_outside_fingerprint_and_pairs_duplicates():
+    old = _steps("A", "A")
+    renamed_objective = [dict(s, objective="diverso") for s in old]
+    assert diff_steps(old, renamed_objective) == ({0: 0, 1: 1}, [])
+    assert diff_steps(old, old[:1]) == ({0: 0}, [])
@@ -0,0 +1,30 @@
+# tests/test_pdf_text.py
+from pdf_text import chunk_text
+
+
+def test_chunk_text_numbers_pages_from_form_feeds():
+    chunks = chunk_text("primo paragrafo\fsecondo paragrafo\f\fquarto", size=20, overlap=0)
+    assert chunks == [(1, "primo paragrafo"), (2, "secondo paragrafo"), (4, "quarto")]
+
+
+def test_chunk_text_respects_size_and_overlaps_short_tails():
+    paras = [f"paragrafo {i} " + "x" * 30 for i in range(6)]
+    chunks = chunk_text("\n\n".join(paras), size=100, overlap=50)
+    assert all(len(text) <= 100 + 50 for _, text in chunks)
+    for (_, prev), (_, cur) in zip(chunks, chunks[1:]):
+        assert cur.split("\n")[0] == prev.split("\n")[-1]  # l'ultimo paragrafo si ripete
+    covered = {p for _, text in chunks for p in text.split("\n")}
+    assert covered == set(paras)
+
+
+def test_chunk_text_splits_long_paragraphs_without_repeating_them():
+    chunks = chunk_text("breve\n\n" + "y" * 250 + "\n\nfine", size=100, overlap=20)
+    pieces = [p for _, text in chunks for p in text.split("\n")]
+    assert all(len(p) <= 100 for p in pieces)
+    assert all(len(text) <= 100 + 20 + 1 for _, text in chunks)  # blocco + ripresa breve
+    assert sum(p.count("y") for p in pieces) == 250  # pezzi più lunghi di overlap: mai ripetuti
+    assert pieces.count("breve") == 2 and pieces[-1] == "fine"
+
+
+def test_chunk_text_normalizes_whitespace():
+    assert chunk_text("  molte   parole\n su  righe  ", size=100) == [(1, "molte parole su righe")]
@@ -0,0 +1,53 @@
+# tests/test_schemas.py
+from schemas import EXERCISES, PLAN, fragment_path, get_at, repair_json, set_at
+
+
+def test_repair_json_strips_fences_and_prose():
+    text = 'Ecco il piano:\n```json\n{"overview": "ok", "steps": [{"title": "A"}]}\n```\nBuono studio!'
+    assert repair_json(text) == {"overview": "ok", "steps": [{"title": "A"}]}
+
+
+def test_repair_json_drops_trailing_commas():
+    assert repair_json('{"a": [1, 2, ], "b": {"c": 3,},}') == {"a": [1, 2], "b": {"c": 3}}
+
+
+def test_repair_json_truncated_keeps_complete_values():
+    text = '{"overview": "ok", "steps": [{"title": "A", "objective": "x"}, {"title": "B", "objective": "tronc'
+    assert repair_json(text) == {"overview": "ok", "steps": [{"title": "A", "objective": "x"}, {"title": "B"}]}
+
+
+def test_repair_json_truncated_inside_nested_array():
+    assert repair_json('{"quiz": [{"q": "1", "opts": ["a", "b"') == {"quiz": [{"q": "1", "opts": ["a"]}]}
+
+
+def test_repair_json_keeps_braces_inside_strings():
+    assert repair_json('{"a": "x } y", "b": "{\\"z\\"') == {"a": "x } y"}
+
+
+def test_repair_json_gives_up_without_object():
+    assert repair_json("") is None
+    assert repair_json("nessun json qui") is None
+
+
+def test_validate_reports_paths():
+    errs = PLAN.validate({"overview": "ok", "steps": [{"title": "A"}, {"objective": "x"}]})
+    assert errs == [(("steps", 1, "title"), "campo mancante")]
+    quiz = {"q": "?", "opts": ["a", "b", "c", "d"], "a": 7}
+    errs = EXERCISES.validate({"guided": {"title": "t", "steps": []}, "quiz": [quiz],
+                               "writing": {"prompt": "p", "min": 1, "max": 2}})
+    assert errs == [(("quiz", 0, "a"), "massimo 3")]
+
+
+def test_fragment_path_stops_at_first_array_item():
+    assert fragment_path(("quiz", 2, "a")) == ("quiz", 2)
+    assert fragment_path(("steps", 0, "theory_outline", 3)) == ("steps", 0)
+    assert fragment_path(("writing", "min")) == ("writing",)
+
+
+def test_set_at_replaces_or_appends():
+    doc = {"quiz": [{"q": "1"}, {"q": "2"}]}
+    set_at(doc, ("quiz", 1), {"q": "nuova"})
+    set_at(doc, ("quiz", 2), {"q": "aggiunta"})
+    set_at(doc, ("writing",), {"prompt": "p"})
+    assert doc == {"quiz": [{"q": "1"}, {"q": "nuova"}, {"q": "aggiunta"}], "writing": {"prompt": "p"}}
+    assert get_at(doc, ("quiz", 5, "q")) is None